@@ -3,10 +3,22 @@
 import os
 import sys
 import time
+import shlex
 import argparse
+import traceback
+import multiprocessing
+from despydb import desdbi
 from databaseapps.objectcatalog import ObjectCatalog as ObjectCatalog
 from databaseapps.objectcatalog import Timing as Timing
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.AdaptiveBatcher import AdaptiveBatcher
+from databaseapps.WorkQueue import WorkQueue, Heartbeat
+from databaseapps.PoolTasks import PoolTasks
 
+# arguments of the file list, and the connection of a worker process reused
+# for every catalog it ingests
+listargs = None
+workerdbh = None
 
 
 def checkParam(args, param, required):
@@ -24,24 +36,12 @@ def printinfo(msg):
     print(time.strftime(ObjectCatalog.debugDateFormat) + " - " + msg)
 
 
-if __name__ == '__main__':
+def ingestFile(args, dbh=None, create=True):
+    """ Ingest the catalog given in args, returning the exit code. dbh is an
+        open connection to use, and create whether the temp table is created.
 
-    hduList = None
+    """
     runtime = Timing('Full ingestion')
-    parser = argparse.ArgumentParser(description='Ingest objects from a fits catalog')
-    parser.add_argument('-request', action='store')
-    parser.add_argument('-filename', action='store')
-    parser.add_argument('-filetype', action='store')
-    parser.add_argument('-temptable', action='store')
-    parser.add_argument('-targettable', action='store')
-    parser.add_argument('-fitsheader', action='store')
-    parser.add_argument('-dump', action='store')
-    parser.add_argument('-section', '-s', help='db section in the desservices file')
-    parser.add_argument('-des_services', help='desservices file')
-
-    args, unknown_args = parser.parse_known_args()
-    args = vars(args)
-
     request = checkParam(args, 'request', True)
     filename = checkParam(args, 'filename', True)
     filetype = checkParam(args, 'filetype', True)
@@ -53,7 +53,7 @@ if __name__ == '__main__':
     section = checkParam(args, 'section', False)
 
     if request == None or filename == None or filetype == None or targettable == None:
-        exit(1)
+        return 1
     printinfo(runtime.report("INIT"))
     objectcat = ObjectCatalog(
         request=request,
@@ -64,14 +64,235 @@ if __name__ == '__main__':
         fitsheader=fitsheader,
         dumponly=dump,
         services=services,
-        section=section
+        section=section,
+        ledger=args['ledger'],
+        dbh=dbh
     )
     printinfo(runtime.report("READ %s" % str(objectcat.getNumObjects())))
 
-    objectcat.createIngestTable()
-    printinfo(runtime.report("CREATE"))
+    (isloaded, code) = objectcat.isLoaded()
+    if isloaded:
+        return code
+
+    if create:
+        objectcat.createIngestTable()
+        printinfo(runtime.report("CREATE"))
     objectcat.executeIngest()
     printinfo(runtime.report("LOAD %s" % str(objectcat.getNumObjects())))
     printinfo("catalogIngest load of " + str(objectcat.getNumObjects()) +
               " objects from " + filename + " completed")
     printinfo(runtime.end())
+    return 0
+
+
+def openWorker(services, section):
+    global workerdbh
+    workerdbh = desdbi.DesDbi(services, section)
+
+
+def ingestListed(filename):
+    """ Ingest one catalog of the file list, returning the file, its exit code
+        and the time it took
+
+    """
+    PoolTasks.started(filename)
+    fileargs = dict(listargs)
+    fileargs['filename'] = filename
+    start = time.time()
+    try:
+        code = ingestFile(fileargs, workerdbh, False)
+    except:
+        se = sys.exc_info()
+        e = se[1]
+        tb = se[2]
+        print("Exception raised:", e)
+        print("Traceback: ")
+        traceback.print_tb(tb)
+        print(" ")
+        code = 1
+    if code != 0:
+        # the connection is used for the next catalog, whose commit would
+        # otherwise also commit the rows inserted before the failure
+        workerdbh.rollback()
+    sys.stdout.flush()
+    return filename, code, time.time() - start
+
+
+def waitListed(tasks):
+    """ Yield the (file, exit code, time) of the catalogs ingested by the pool
+        of tasks as they end. A catalog whose worker process died has failed,
+        its time being that since it was submitted.
+
+    """
+    submitted = dict([(filename, time.time()) for filename in tasks.pending.keys()])
+    while len(tasks) > 0:
+        for filename, result in tasks.wait():
+            if result is None:
+                printinfo("Worker process ingesting %s died" % filename)
+                result = filename, 1, time.time() - submitted[filename]
+            yield result
+
+
+def runFileList(args):
+    """ Ingest all the catalogs of a file list into the same temp table with
+        jobs worker processes, each ingesting one catalog after the other over
+        a single connection. Returns the number of catalogs which failed.
+
+    """
+    global listargs, workerdbh
+    f = open(args['filelist'], 'r')
+    files = [shlex.split(line, comments=True) for line in f.readlines()]
+    f.close()
+    files = [words[0] for words in files if len(words) > 0]
+    if len(files) == 0:
+        printinfo("No catalogs in " + args['filelist'])
+        return 0
+    start = time.time()
+
+    # the temp table is created once, for all the catalogs
+    dbh = desdbi.DesDbi(args['des_services'], args['section'])
+    fileargs = dict(args)
+    fileargs['filename'] = files[0]
+    for param in ['request', 'filetype', 'targettable']:
+        if checkParam(fileargs, param, True) is None:
+            return len(files)
+    ObjectCatalog(request=args['request'], filetype=args['filetype'], datafile=files[0],
+                  temptable=args['temptable'], targettable=args['targettable'],
+                  fitsheader=args['fitsheader'], dumponly=args['dump'], services=args['des_services'],
+                  section=args['section'], dbh=dbh).createIngestTable()
+
+    listargs = args
+    failed = 0
+    worktime = 0.
+    tasks = None
+    if args['jobs'] <= 1:
+        workerdbh = dbh
+        results = (ingestListed(filename) for filename in files)
+    else:
+        # the tasks are polled, so that a worker process which dies fails its
+        # catalog instead of hanging the run
+        dbh.close()
+        PoolTasks.open()
+        pool = multiprocessing.Pool(args['jobs'], openWorker, (args['des_services'], args['section']))
+        tasks = PoolTasks(pool)
+        for filename in files:
+            tasks.submit(filename, ingestListed, (filename,))
+        results = waitListed(tasks)
+    try:
+        for filename, code, seconds in results:
+            worktime += seconds
+            if code != 0:
+                failed += 1
+            printinfo("Catalog %s %s in %.2f seconds" % (filename, ["completed", "failed"][code != 0], seconds))
+    finally:
+        if tasks is not None:
+            tasks.shutdown()
+            PoolTasks.close()
+        else:
+            dbh.close()
+    elapsed = time.time() - start
+    printinfo("Ingested %i of %i catalogs in %.2f seconds (%.2f seconds per catalog, %.2f seconds ingesting)" %
+              (len(files) - failed, len(files), elapsed, elapsed / len(files), worktime))
+    return failed
+
+
+def runQueue(parser, args):
+    """ Ingest the catalogs claimed from a work queue shared with other hosts,
+        each job holding the arguments of one catalog (overriding those of the
+        command line). Returns the number of catalogs which failed.
+
+    """
+    failed = 0
+    queue = WorkQueue(args['queue'], lease=args['lease'])
+    if args['job_list'] is not None:
+        f = open(args['job_list'], 'r')
+        lines = [line.strip() for line in f.readlines() if len(shlex.split(line, comments=True)) > 0]
+        f.close()
+        added = queue.add(lines)
+        printinfo("Added %i catalogs to the queue %s" % (added, args['queue']))
+
+    for jobid, line in queue.jobs(args['poll']):
+        jobargs = vars(parser.parse_known_args(shlex.split(line, comments=True))[0])
+        fileargs = dict(args)
+        for key, value in jobargs.items():
+            if value != parser.get_default(key):
+                fileargs[key] = value
+        # keep the lease of the catalog while it is ingested, and commit
+        # nothing once it is lost
+        heartbeat = Heartbeat(queue, jobid)
+        heartbeat.start()
+        ObjectCatalog.lease = heartbeat
+        try:
+            code = ingestFile(fileargs)
+        except:
+            se = sys.exc_info()
+            e = se[1]
+            tb = se[2]
+            print("Exception raised:", e)
+            print("Traceback: ")
+            traceback.print_tb(tb)
+            print(" ")
+            code = 1
+        ObjectCatalog.lease = None
+        heartbeat.end()
+        if heartbeat.lost.is_set():
+            # the catalog is now another worker's job, which records its end
+            printinfo("Lost the lease of catalog job %i, not recording it as complete" % (jobid))
+            failed += 1
+            continue
+        queue.complete(jobid, code)
+        if code != 0:
+            failed += 1
+    printinfo("Catalogs in the queue: " + ', '.join(["%i %s" % (n, st) for st, n in sorted(queue.counts().items())]))
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Ingest objects from a fits catalog')
+    parser.add_argument('-request', action='store')
+    parser.add_argument('-filename', action='store')
+    parser.add_argument('-filetype', action='store')
+    parser.add_argument('-temptable', action='store')
+    parser.add_argument('-targettable', action='store')
+    parser.add_argument('-fitsheader', action='store')
+    parser.add_argument('-dump', action='store',
+                        help='directory to write sqlldr data and control files to, instead of inserting the rows')
+    parser.add_argument('-dump_parts', type=int, default=1,
+                        help='number of data files the rows are split into in dump mode')
+    parser.add_argument('-sqlldr', action='store_true',
+                        help='in dump mode, load the files with parallel direct path sqlldr')
+    parser.add_argument('-batch_memory', type=int, default=256,
+                        help='MB of bind buffer a single insert batch may use')
+    parser.add_argument('-filelist',
+                        help='file with one catalog per line, all loaded into the same temp table by this process')
+    parser.add_argument('-jobs', type=int, default=1,
+                        help='number of processes ingesting the catalogs of -filelist')
+    parser.add_argument('-range_jobs', type=int, default=1,
+                        help='number of processes sharing the rows of a large catalog, each inserting a range of them')
+    parser.add_argument('-section', '-s', help='db section in the desservices file')
+    parser.add_argument('-des_services', help='desservices file')
+    parser.add_argument('-ledger', help='ingest ledger table, used to skip files which are already loaded')
+    parser.add_argument('-metadata_cache', help='local file used to cache the ingest metadata across runs')
+    parser.add_argument('-metadata_ttl', type=int, help='seconds for which entries of the metadata cache file are used')
+    parser.add_argument('-queue', help='SQLite work queue file shared by the hosts ingesting catalogs')
+    parser.add_argument('-job_list', help='file with the arguments of one catalog per line, added to the queue')
+    parser.add_argument('-lease', type=int, default=600,
+                        help='seconds a catalog claimed from the queue is held without a heartbeat')
+    parser.add_argument('-poll', type=float,
+                        help='seconds to wait for jobs whose lease may expire when the queue is empty')
+
+    args, unknown_args = parser.parse_known_args()
+    args = vars(args)
+    MetadataCache.configure(args['metadata_cache'], args['metadata_ttl'])
+    ObjectCatalog.dump_parts = args['dump_parts']
+    ObjectCatalog.run_sqlldr = args['sqlldr']
+    AdaptiveBatcher.memory_cap = args['batch_memory'] * 1024 * 1024
+    ObjectCatalog.range_jobs = args['range_jobs']
+
+    # the number of failed catalogs could wrap around as an exit status
+    if args['queue'] is not None:
+        exit(1 if runQueue(parser, args) > 0 else 0)
+    if args['filelist'] is not None:
+        exit(1 if runFileList(args) > 0 else 0)
+    exit(ingestFile(args))
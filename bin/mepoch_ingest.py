@@ -1,15 +1,26 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import time
+import shlex
 from despydb import desdbi
 import argparse
 import traceback
+from databaseapps.Ingest import Ingest
+from databaseapps.FitsIngest import FitsIngest
+from databaseapps.IdMap import IdMap
+from databaseapps.AdaptiveBatcher import AdaptiveBatcher
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.IngestLedger import IngestLedger
 from databaseapps.CoaddCatalog import CoaddCatalog
 from databaseapps.CoaddHealpix import CoaddHealpix
+from databaseapps.CoordHealpix import CoordHealpix
 from databaseapps.Mangle import Mangle
 from databaseapps.Wavg import Wavg
 from databaseapps.Extinction import Extinction
+from databaseapps.StageScheduler import StageScheduler, Stage
+from databaseapps.WorkQueue import WorkQueue, Heartbeat
 
 
 def checkParam(args, param, required):
@@ -46,16 +57,384 @@ def getfilelist(file):
     return files
 
 
-if __name__ == '__main__':
+def listfiles(filelist):
+    """ Get the file names from a list file, or an empty list if there is none
+
+    """
+    if filelist is None:
+        return []
+    return [f[0] for f in getfilelist(filelist)]
 
-    # var to hold to COADD_OBJECT_ID's
-    coaddObjectIdDict = {}
 
+def prefetchIngested(dbh, filetype, files):
+    """ Find how many rows have already been ingested from each of the files
+        with one query, so the files that can be skipped are known upfront
+
+    """
+    files = [f for f in files if f is not None]
+    if len(files) == 0:
+        return
+    counts = Ingest.prefetchIngested(dbh, filetype, files)
+    loaded = [f for f, c in counts.items() if c > 0]
+    printinfo("%i of %i %s files already ingested" % (len(loaded), len(files), filetype))
+
+
+def ingestDetection(stage, detcat, idDict, dbh):
+    """ Ingest the detection catalog, or get its ids if it is already loaded,
+        filling the id map used by all the other stages
+
+    """
     retval = 0
+    printinfo("Working on detection catalog " + detcat)
+    detobj = CoaddCatalog(
+        ingesttype='det', filetype=stage.filetype, datafile=detcat, idDict=idDict, dbh=dbh)
+
+    if stage.kwargs['alt_table'] is not None:
+        detobj.retrieveCoaddObjectIds(stage.kwargs['services'], stage.kwargs['alt_section'],
+                                      stage.kwargs['det_pfwid'], stage.kwargs['alt_table'])
+    else:
+        isLoaded = detobj.isLoaded()
+        if isLoaded:
+            detobj.retrieveCoaddObjectIds()
+            if stage.kwargs['healpix_filetype'] is not None:
+                retval += checkCoordHealpix(stage, detobj)
+        else:
+            detobj.getIDs()
+            if stage.kwargs['healpix_filetype'] is not None:
+                # the healpix table is filled from the same pass over the catalog
+                detobj.companions.append(CoordHealpix(stage.kwargs['healpix_filetype'], detobj,
+                                                      stage.kwargs['healpix_check']))
+            stat = detobj.executeIngest()
+            retval += detobj.getstatus()
+            printinfo("Ingest of detection catalog " + detcat + status[stat] + "\n")
+
+    # do a sanity check, as these numbers are needed for the following steps
+    if len(idDict) == 0:
+        raise Exception("Coadd Object Dict is empty, cannot continue")
+    return retval
+
+
+def checkCoordHealpix(stage, detobj):
+    """ With the detection catalog already loaded, check that its healpix rows
+        were computed from its coordinates. If not (e.g. an earlier run
+        ingested the catalog without --healpix_from_coords) the healpix stage
+        ingests the --healpix file instead. Returns the number of failures.
+
+    """
+    healpix = CoordHealpix(stage.kwargs['healpix_filetype'], detobj)
+    if healpix.numAlreadyIngested() > 0:
+        printinfo("Healpix rows of " + detobj.shortfilename + " already computed from its coordinates")
+        return 0
+    stage.kwargs['healpix_state']['fallback'] = True
+    if stage.kwargs['healpix_file'] is None:
+        printinfo("ERROR: the detection catalog " + detobj.shortfilename + " is already ingested without" +
+                  " its healpix rows, and no --healpix file was given to ingest them from")
+        return 1
+    printinfo("The detection catalog " + detobj.shortfilename + " is already ingested without its healpix" +
+              " rows, ingesting them from " + stage.kwargs['healpix_file'])
+    return 0
+
+
+def ingestHealpix(stage, datafile, idDict, dbh):
+    """ Ingest the healpix file, unless the healpix table was filled from the
+        coordinates of the detection catalog
+
+    """
+    if not stage.kwargs['healpix_state']['fallback']:
+        printinfo("Skipping %s %s, computed from the detection catalog" % (stage.label, datafile))
+        return 0
+    printinfo("Working on %s %s" % (stage.label, datafile))
+    obj = CoaddHealpix(filetype=stage.filetype, datafile=datafile, idDict=idDict, dbh=dbh)
+    isLoaded = obj.isLoaded()
+    if isLoaded:
+        return 0
+    stat = obj.executeIngest()
+    printinfo("Ingest of %s %s%s\n" % (stage.label, datafile, status[stat]))
+    return obj.getstatus()
+
+
+def getDetPfwids(dbh, detcats):
+    """ Get the pfw_attempt_id of each of the given detection catalogs from
+        desfile with a single query, as a dictionary keyed by catalog
+
+    """
+    names = {}
+    for detcat in detcats:
+        tcoadd_file = detcat.split('/')[-1]
+        if tcoadd_file.endswith('.fits'):
+            names[detcat] = (tcoadd_file, None)
+        else:
+            parts = tcoadd_file.split('.fits')
+            names[detcat] = (parts[0] + '.fits', parts[1])
+    binds = {}
+    for i, name in enumerate(sorted(set([n[0] for n in names.values()]))):
+        binds['f%d' % i] = name
+    results = {}
+    if len(binds) == 0:
+        return results
+    curs = dbh.cursor()
+    curs.execute("select filename, compression, pfw_attempt_id from desfile where filename in (%s)" %
+                 (', '.join([':' + b for b in sorted(binds.keys())])), binds)
+    found = {}
+    for filename, compression, pfwid in curs.fetchall():
+        found.setdefault((filename, compression), []).append(pfwid)
+    curs.close()
+    for detcat, name in names.items():
+        if len(found.get(name, [])) != 1:
+            raise Exception("Could not determine the pfw_attempt_id from the coadd_file " + detcat)
+        results[detcat] = found[name][0]
+    return results
+
+
+def ingestTile(dbh, args):
+    """ Ingest the detection catalog of a tile, then all the files which depend
+        on it. Returns the number of failures, and raises an exception if the
+        ingest could not go past the detection catalog.
+
+    """
+    # map of object NUMBER to COADD_OBJECT_ID
+    coaddObjectIdDict = IdMap()
+
+    detcat = checkParam(args, 'detcat', True)
+    section = checkParam(args, 'section', False)
+    services = checkParam(args, 'des_services', False)
+    alt_section = checkParam(args, 'alt_section', False)
+    det_pfwid = checkParam(args, 'det_pfwid', False)
+    alt_table = checkParam(args, 'alt_table', False)
+    if detcat is None:
+        raise Exception("No detection catalog given")
+
+    healpix_filetype = None
+    healpix_check = None
+    # set by the detection stage when the healpix table could not be filled
+    # from the coordinates, so the healpix stage ingests the healpix file
+    healpix_state = {'fallback': False}
+    if args['healpix_from_coords']:
+        if alt_table is not None:
+            raise Exception("--healpix_from_coords cannot be used with --alt_table, the detection catalog is not read")
+        healpix_filetype = args['coadd_hpix_filetype']
+        if args['healpix_check']:
+            if args['healpix'] is None:
+                raise Exception("--healpix_check needs the --healpix file to compare with")
+            healpix_check = args['healpix']
+
+    if alt_section is None:
+        alt_section = section
+    if alt_table is not None and det_pfwid is None:
+        print("Getting det_pfwid from database.")
+        det_pfwid = getDetPfwids(dbh, [detcat])[detcat]
+
+    scheduler = StageScheduler(coaddObjectIdDict)
+    scheduler.addStage(Stage('det', CoaddCatalog, args['coadd_object_filetype'], [detcat],
+                             label='detection catalog', local=True, required=True, function=ingestDetection,
+                             alt_table=alt_table, alt_section=alt_section, det_pfwid=det_pfwid,
+                             services=services, healpix_filetype=healpix_filetype,
+                             healpix_check=healpix_check, healpix_file=args['healpix'],
+                             healpix_state=healpix_state))
+
+    # the stages which follow the detection catalog only read the id map, so
+    # they only depend on it: name, ingest class, filetype argument, argument
+    # with the file or list of files, description of the files and extra
+    # arguments of the ingest class
+    stageGraph = [
+        ('band', CoaddCatalog, 'coadd_object_filetype', 'bandcat_list', 'band catalog', {'ingesttype': 'band'}),
+        ('healpix', CoaddHealpix, 'coadd_hpix_filetype', 'healpix', 'healpix catalog', {}),
+        ('wavg', Wavg, 'wavg_filetype', 'wavg_list', 'wavg catalog', {}),
+        ('wavg_oclink', Wavg, 'wavg_oclink_filetype', 'wavg_oclink_list', 'wavg_oclink catalog',
+         {'matchCount': False}),
+        ('ccdgon', Mangle, 'ccdgon_filetype', 'ccdgon_list', 'ccdgon file', {}),
+        ('molygon', Mangle, 'molygon_filetype', 'molygon_list', 'molygon file', {}),
+        ('molygon_ccdgon', Mangle, 'molygon_ccdgon_filetype', 'molygon_ccdgon_list', 'molygon_ccdgon file', {}),
+        ('coadd_object_molygon', Mangle, 'coadd_object_molygon_filetype', 'coadd_object_molygon_list',
+         'coadd_object_molygon file', {'replacecol': 3, 'checkcount': True, 'skipmissing': alt_table is not None}),
+        ('extinct', Extinction, 'extinct_filetype', 'extinct', 'extinction catalog', {}),
+        ('extinct_band', Extinction, 'extinct_band_filetype', 'extinct_band_list', 'extinction band catalog', {}),
+    ]
+    if healpix_filetype is not None:
+        # filled along with the detection catalog, the healpix file is only
+        # ingested if that could not be done
+        idx = [s[0] for s in stageGraph].index('healpix')
+        stageGraph[idx] = stageGraph[idx][:5] + ({'function': ingestHealpix, 'healpix_state': healpix_state},)
+    for name, ingestclass, filetype, filearg, label, kwargs in stageGraph:
+        if filearg.endswith('_list'):
+            files = listfiles(args[filearg])
+        else:
+            files = [args[filearg]]
+        scheduler.addStage(Stage(name, ingestclass, args[filetype], files, depends=['det'], label=label,
+                                 **kwargs))
+
+    # check which of the files have already been ingested, one query per filetype
+    try:
+        filetypes = {}
+        for stage in scheduler.stages:
+            filetypes.setdefault(stage.filetype, []).extend(stage.files)
+        for filetype, files in filetypes.items():
+            prefetchIngested(dbh, filetype, files)
+    except:
+        # not fatal, each file is then checked on its own
+        se = sys.exc_info()
+        e = se[1]
+        print("Could not check for already ingested files upfront:", e)
+
+    print("\n###################### COADD OBJECT INGESTION ########################\n")
+    retval = scheduler.run(dbh, args['jobs'], services, section)
+    scheduler.report()
+    if scheduler.aborted:
+        raise Exception("Ingest of the detection catalog %s failed, cannot continue" % detcat)
+    return retval
+
+
+def connect(dbh, services, section):
+    """ Get a working connection, reusing dbh if it is still alive
+
+    """
+    if dbh is not None:
+        try:
+            curs = dbh.cursor()
+            curs.execute("select 1 from dual")
+            curs.fetchall()
+            curs.close()
+            return dbh
+        except:
+            printinfo("Lost the database connection, reconnecting")
+    return desdbi.DesDbi(services, section, retry=True)
+
+
+def tileArgs(parser, args, tileline):
+    """ Get the arguments of one tile of a batch: the arguments of the command
+        line, overridden by those given for the tile
+
+    """
+    tileargs, unknown_args = parser.parse_known_args(shlex.split(tileline, comments=True))
+    tileargs = vars(tileargs)
+    result = dict(args)
+    for key, value in tileargs.items():
+        if value != parser.get_default(key):
+            result[key] = value
+    return result
+
+
+def spoolJobs(spool, poll):
+    """ Yield the job files put in a spool directory, in name order, until the
+        directory is empty (or, when polling, until a file named STOP appears)
+
+    """
+    while True:
+        jobs = sorted([f for f in os.listdir(spool) if f.endswith('.tile')])
+        if len(jobs) > 0:
+            for job in jobs:
+                yield os.path.join(spool, job)
+        elif poll is None or os.path.exists(os.path.join(spool, 'STOP')):
+            return
+        else:
+            time.sleep(poll)
+
+
+def readTileList(tile_list):
+    """ Read the arguments of the tiles in a list file, skipping blank lines
+        and comments
+
+    """
+    f = open(tile_list, 'r')
+    lines = [line.strip() for line in f.readlines() if len(shlex.split(line, comments=True)) > 0]
+    f.close()
+    return lines
+
+
+def runBatch(parser, args, dbh):
+    """ Ingest a batch of tiles, given in a list file (one line of arguments per
+        tile), as job files in a spool directory (each holding the arguments
+        of one tile, moved to done/ or failed/ once ingested) or claimed from a
+        work queue shared with other hosts (filled from the list file, if one
+        is given). The connection, ingest plans and metadata are kept for all
+        the tiles. Returns the number of tiles which failed.
+
+    """
+    failed = 0
+    queue = None
+    if args['queue'] is not None:
+        queue = WorkQueue(args['queue'], lease=args['lease'])
+        if args['tile_list'] is not None:
+            added = queue.add(readTileList(args['tile_list']))
+            printinfo("Added %i tiles to the queue %s" % (added, args['queue']))
+        jobs = queue.jobs(args['poll'])
+    elif args['tile_list'] is not None:
+        jobs = [(None, line) for line in readTileList(args['tile_list'])]
+    else:
+        for sub in ['done', 'failed']:
+            if not os.path.isdir(os.path.join(args['spool'], sub)):
+                os.mkdir(os.path.join(args['spool'], sub))
+        jobs = ((job, None) for job in spoolJobs(args['spool'], args['poll']))
+
+    pfwids = {}
+    if args['tile_list'] is not None and queue is None:
+        # look up the missing det_pfwid of all the tiles at once
+        alltiles = [tileArgs(parser, args, line) for job, line in jobs]
+        detcats = [t['detcat'] for t in alltiles if t['alt_table'] and not t['det_pfwid'] and t['detcat']]
+        try:
+            pfwids = getDetPfwids(dbh, detcats)
+        except:
+            # each tile then looks up its own
+            pfwids = {}
+
+    for job, line in jobs:
+        if args['spool'] is not None and queue is None:
+            f = open(job, 'r')
+            line = ' '.join(f.readlines())
+            f.close()
+        tile = tileArgs(parser, args, line)
+        if not tile['det_pfwid'] and tile['detcat'] in pfwids:
+            tile['det_pfwid'] = pfwids[tile['detcat']]
+        printinfo("Starting tile " + str(tile['detcat']))
+        start = time.time()
+        if queue is not None:
+            # keep the lease of the tile while it is ingested, and commit
+            # nothing once it is lost
+            heartbeat = Heartbeat(queue, job)
+            heartbeat.start()
+            Ingest.lease = heartbeat
+        try:
+            dbh = connect(dbh, args['des_services'], args['section'])
+            retval = ingestTile(dbh, tile)
+        except:
+            se = sys.exc_info()
+            e = se[1]
+            tb = se[2]
+            print("Exception raised:", e)
+            print("Traceback: ")
+            traceback.print_tb(tb)
+            print(" ")
+            retval = None
+        if retval != 0:
+            failed += 1
+        printinfo("Tile %s%s in %.2f seconds" % (tile['detcat'], status[int(retval != 0)], time.time() - start))
+        if queue is not None:
+            Ingest.lease = None
+            heartbeat.end()
+            if retval is None:
+                retval = 1
+            if heartbeat.lost.is_set():
+                # the tile is now another worker's job, which records its end
+                printinfo("Lost the lease of tile job %i, not recording it as complete" % (job))
+                if retval == 0:
+                    failed += 1
+            else:
+                queue.complete(job, retval)
+        elif args['spool'] is not None:
+            os.rename(job, os.path.join(args['spool'], ['done', 'failed'][int(retval != 0)],
+                                        os.path.basename(job)))
+    if queue is not None:
+        printinfo("Tiles in the queue: " + ', '.join(["%i %s" % (n, st) for st, n in sorted(queue.counts().items())]))
+    return failed
+
+
+status = [" completed", " aborted"]
+
+if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Ingest coadd objects from fits catalogs')
     parser.add_argument('--bandcat_list', action='store')
-    parser.add_argument('--detcat', action='store', required=True)
+    parser.add_argument('--detcat', action='store')
     parser.add_argument('--extinct', action='store')
     parser.add_argument('--extinct_band_list', action='store')
     parser.add_argument('--healpix', action='store')
@@ -80,50 +459,93 @@ if __name__ == '__main__':
     parser.add_argument('--alt_section', action='store')
     parser.add_argument('--det_pfwid', action='store')
     parser.add_argument('--alt_table', action='store')
-
+    parser.add_argument('--metadata_cache', action='store',
+                        help='local file used to cache the ingest metadata across runs')
+    parser.add_argument('--metadata_ttl', action='store', type=int, default=None,
+                        help='seconds for which entries of the metadata cache file are used')
+    parser.add_argument('--ledger', action='store',
+                        help='ingest ledger table, used to skip files which are already loaded')
+    parser.add_argument('--pipeline_depth', action='store', type=int, default=0,
+                        help='number of batches to read ahead of the inserts in a separate thread')
+    parser.add_argument('--jobs', action='store', type=int, default=1,
+                        help='number of processes ingesting the files which follow the detection catalog')
+    parser.add_argument('--batch_memory', action='store', type=int, default=256,
+                        help='MB of bind buffer a single insert batch may use')
+    parser.add_argument('--batch_errors', action='store_true',
+                        help='write the rows rejected by the database to a reject file instead of rolling '
+                             'back the whole file')
+    parser.add_argument('--error_budget', action='store', type=float, default=0,
+                        help='with --batch_errors, number of rejected rows (or fraction of the rows, if '
+                             'below 1) up to which the other rows are committed')
+    parser.add_argument('--reject_dir', action='store', default='.',
+                        help='directory the reject files are written to')
+    parser.add_argument('--checkpoint_rows', action='store', type=int, default=0,
+                        help='commit every this many rows, so an interrupted load is resumed from the '
+                             'last commit (0 to commit each file once)')
+    parser.add_argument('--checkpoint_dir', action='store', default='.',
+                        help='directory of the checkpoint files, used when there is no --ledger')
+    parser.add_argument('--healpix_from_coords', action='store_true',
+                        help='compute the healpix table from the coordinates of the detection catalog, '
+                             'while it is ingested, instead of ingesting the --healpix file')
+    parser.add_argument('--healpix_check', action='store_true',
+                        help='with --healpix_from_coords, compare the computed pixels to those of the '
+                             '--healpix file, failing the detection catalog on any difference')
+    parser.add_argument('--sort_key', action='store',
+                        help='columns (comma separated, or CLUSTER for the primary key of the table) to sort '
+                             'the rows on before they are inserted, e.g. COADD_OBJECT_ID. On the SQLite '
+                             'stand-in of tests/benchmark_sort.py this halves the time spent inserting, but '
+                             'every sorted mode makes the whole load slower (3M rows: 39.5 seconds unsorted, '
+                             '40.8 sorted per batch, 50.5 with --sort_file), so only use it where updating '
+                             'the indexes dominates the load')
+    parser.add_argument('--sort_file', action='store_true',
+                        help='with --sort_key, sort all the rows of each file rather than each batch')
+    parser.add_argument('--sort_memory', action='store', type=int, default=512,
+                        help='MB of rows held in memory by --sort_file, larger files are sorted in runs '
+                             'spilled to --sort_dir and merged')
+    parser.add_argument('--sort_dir', action='store',
+                        help='directory of the sorted runs of --sort_file (default the temp directory)')
+    parser.add_argument('--range_jobs', action='store', type=int, default=1,
+                        help='number of processes sharing the rows of each large fits table, each '
+                             'inserting a range of them')
+
+    parser.add_argument('--tile_list', action='store',
+                        help='file with the arguments of one tile per line, to ingest many tiles in one run')
+    parser.add_argument('--spool', action='store',
+                        help='directory of tile job files (*.tile) to ingest in one run')
+    parser.add_argument('--queue', action='store',
+                        help='SQLite work queue file shared by the hosts ingesting tiles, tiles of '
+                             '--tile_list are added to it')
+    parser.add_argument('--lease', action='store', type=int, default=600,
+                        help='seconds a tile claimed from the queue is held without a heartbeat')
+    parser.add_argument('--poll', action='store', type=float, default=None,
+                        help='seconds to wait for new jobs when the spool or queue is empty. The run '
+                             'ends when a file named STOP is put in the spool, or when no tile of the '
+                             'queue is left running')
     args, unknown_args = parser.parse_known_args()
     args = vars(args)
 
-    bandcat = checkParam(args, 'bandcat_list', False)
-    detcat = checkParam(args, 'detcat', True)
-    extinct = checkParam(args, 'extinct', False)
-    extinct_band = checkParam(args, 'extinct_band_list', False)
-    healpix = checkParam(args, 'healpix', False)
-    wavg = checkParam(args, 'wavg_list', False)
-    wavg_oclink = checkParam(args, 'wavg_oclink_list', False)
-    ccdgon = checkParam(args, 'ccdgon_list', False)
-    molygon = checkParam(args, 'molygon_list', False)
-    molygon_ccdgon = checkParam(args, 'molygon_ccdgon_list', False)
-    coadd_object_molygon = checkParam(args, 'coadd_object_molygon_list', False)
-    section = checkParam(args, 'section', False)
-    services = checkParam(args, 'des_services', False)
-    alt_section = checkParam(args, 'alt_section', False)
-    det_pfwid = checkParam(args, 'det_pfwid', False)
-    alt_table = checkParam(args, 'alt_table', False)
-
-    status = [" completed", " aborted"]
-    dbh = desdbi.DesDbi(services, section, retry=True)
-    # do some quick checking
+    Ingest.pipeline_depth = args['pipeline_depth']
+    AdaptiveBatcher.memory_cap = args['batch_memory'] * 1024 * 1024
+    Ingest.batch_errors = args['batch_errors']
+    Ingest.error_budget = args['error_budget']
+    Ingest.reject_dir = args['reject_dir']
+    Ingest.checkpoint_rows = args['checkpoint_rows']
+    Ingest.checkpoint_dir = args['checkpoint_dir']
+    Ingest.sort_key = args['sort_key']
+    Ingest.sort_file = args['sort_file']
+    Ingest.sort_memory = args['sort_memory'] * 1024 * 1024
+    Ingest.sort_dir = args['sort_dir']
+    FitsIngest.range_jobs = args['range_jobs']
+    FitsIngest.services = args['des_services']
+    FitsIngest.section = args['section']
+    if args['ledger']:
+        Ingest.ledger = IngestLedger(args['ledger'])
+
+    dbh = desdbi.DesDbi(args['des_services'], args['section'], retry=True)
+    MetadataCache.configure(args['metadata_cache'], args['metadata_ttl'])
     try:
-        if alt_section is None:
-            alt_section = section
-        if alt_table is not None and det_pfwid is None:
-            print("Getting det_pfwid from database.")
-            curs = dbh.cursor()
-            tcoadd_file = detcat.split('/')[-1]
-            if tcoadd_file.endswith('.fits'):
-                temp = "'%s' and compression is null" % tcoadd_file
-            else:
-                parts = tcoadd_file.split('.fits')
-                temp = "'%s.fits' and compression='%s'" % (parts[0], parts[1])
-            sql = "select pfw_attempt_id from desfile where filename=%s" % temp
-
-            curs.execute(sql)
-            results = curs.fetchall()
-            if len(results) != 1:
-                raise Exception("Could not determine the pfw_attempt_id from the coadd_file")
-            det_pfwid = results[0][0]
-
+        # get the metadata for all of the filetypes in one query
+        MetadataCache.prefetch(dbh, [v for k, v in args.items() if k.endswith('_filetype')])
     except:
         se = sys.exc_info()
         e = se[1]
@@ -134,23 +556,13 @@ if __name__ == '__main__':
         print(" ")
         exit(1)
 
-    print("\n###################### COADD OBJECT INGESTION ########################\n")
-    try:
-        printinfo("Working on detection catalog " + detcat)
-        detobj = CoaddCatalog(
-            ingesttype='det', filetype=args['coadd_object_filetype'], datafile=detcat, idDict=coaddObjectIdDict, dbh=dbh)
+    if args['tile_list'] is not None or args['spool'] is not None or args['queue'] is not None:
+        failed = runBatch(parser, args, dbh)
+        print("EXITING WITH %i FAILED TILES" % failed)
+        exit(1 if failed else 0)
 
-        if alt_table is not None:
-            detobj.retrieveCoaddObjectIds(args['des_services'], alt_section, det_pfwid, alt_table)
-        else:
-            isLoaded = detobj.isLoaded()
-            if isLoaded:
-                detobj.retrieveCoaddObjectIds()
-            else:
-                detobj.getIDs()
-                stat = detobj.executeIngest()
-                retval += detobj.getstatus()
-                printinfo("Ingest of detection catalog " + detcat + status[stat] + "\n")
+    try:
+        retval = ingestTile(dbh, args)
     except:
         se = sys.exc_info()
         e = se[1]
@@ -161,254 +573,5 @@ if __name__ == '__main__':
         print(" ")
         exit(1)
 
-    # do a sanity check, as these numbers are needed for the following steps
-    if len(coaddObjectIdDict) == 0:
-        print("Coadd Object Dict is empty, cannot continue")
-        exit(1)
-
-    if bandcat is not None:
-        bandfiles = getfilelist(bandcat)
-        for bandfile in bandfiles:
-            try:
-                bfile = bandfile[0]
-                printinfo("Working on band catalog " + bfile)
-                bandobj = CoaddCatalog(
-                    ingesttype='band', filetype=args['coadd_object_filetype'], datafile=bfile, idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = bandobj.isLoaded()
-                if not isLoaded:
-                    stat = bandobj.executeIngest()
-                    retval += bandobj.getstatus()
-                    printinfo("Ingest of band catalog " + bfile + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Coadd Band catalog ingestion, none specified on command line")
-
-    print("\n###################### HEALPIX INGESTION ########################\n")
-    if healpix is not None:
-        try:
-            printinfo("Working on healpix catalog " + healpix)
-            healobj = CoaddHealpix(filetype=args['coadd_hpix_filetype'],
-                                   datafile=healpix, idDict=coaddObjectIdDict, dbh=dbh)
-            isLoaded = healobj.isLoaded()
-            if not isLoaded:
-                stat = healobj.executeIngest()
-                retval += healobj.getstatus()
-                printinfo("Ingest of healpix catalog " + healpix + status[stat] + "\n")
-        except:
-            se = sys.exc_info()
-            e = se[1]
-            tb = se[2]
-            print("Exception raised:", e)
-            print("Traceback: ")
-            traceback.print_tb(tb)
-            print(" ")
-            retval += 1
-    else:
-        print("Skipping Healpix ingestion, none specified on command line")
-
-    print("\n###################### WEIGHTED AVERAGE INGESTION ########################\n")
-
-    if wavg is not None:
-        wavgfiles = getfilelist(wavg)
-        for file in wavgfiles:
-            try:
-                printinfo("Working on wavg catalog " + file[0])
-                wavgobj = Wavg(filetype=args['wavg_filetype'], datafile=file[0],
-                               idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = wavgobj.isLoaded()
-                if not isLoaded:
-                    stat = wavgobj.executeIngest()
-                    retval += wavgobj.getstatus()
-                    printinfo("Ingest of wavg catalog " + file[0] + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Weighted Average ingestion, none specified on command line")
-
-    if wavg_oclink is not None:
-        wavgfiles = getfilelist(wavg_oclink)
-        for file in wavgfiles:
-            try:
-                printinfo("Working on wavg_oclink catalog " + file[0])
-                wavgobj = Wavg(filetype=args['wavg_oclink_filetype'], datafile=file[0],
-                               idDict=coaddObjectIdDict, dbh=dbh, matchCount=False)
-                isLoaded = wavgobj.isLoaded()
-                if not isLoaded:
-                    stat = wavgobj.executeIngest()
-                    retval += wavgobj.getstatus()
-                    printinfo("Ingest of wavg_oclink catalog " + file[0] + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Weighted Average OCLink ingestion, none specified on command line")
-
-    print("\n###################### MANGLE INGESTION ########################\n")
-
-    if ccdgon is not None:
-        ccdfiles = getfilelist(ccdgon)
-        for file in ccdfiles:
-            try:
-                printinfo("Working on ccdgon file " + file[0])
-                ccdobj = Mangle(datafile=file[0], filetype=args['ccdgon_filetype'],
-                                idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = ccdobj.isLoaded()
-                if not isLoaded:
-                    stat = ccdobj.executeIngest()
-                    retval += ccdobj.getstatus()
-                    printinfo("Ingest of ccdgon file " + file[0] + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping CCDgon ingestion, none specified on command line")
-
-    if molygon is not None:
-        molyfiles = getfilelist(molygon)
-        for file in molyfiles:
-            try:
-                printinfo("Working on molygon file " + file[0])
-                molyobj = Mangle(datafile=file[0], filetype=args['molygon_filetype'],
-                                 idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = molyobj.isLoaded()
-                if not isLoaded:
-                    stat = molyobj.executeIngest()
-                    retval += molyobj.getstatus()
-                    printinfo("Ingest of molygon file " + file[0] + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Molygon ingestion, none specified on command line")
-
-    if molygon_ccdgon is not None:
-        mcfiles = getfilelist(molygon_ccdgon)
-        for file in mcfiles:
-            try:
-                printinfo("Working on molygon_ccdgon file " + file[0])
-                mcobj = Mangle(datafile=file[0], filetype=args['molygon_ccdgon_filetype'],
-                               idDict=coaddObjectIdDict, dbh=dbh)
-                isLoaded = mcobj.isLoaded()
-                if not isLoaded:
-                    stat = mcobj.executeIngest()
-                    retval += mcobj.getstatus()
-                    printinfo("Ingest of molygon_ccdgon file " + file[0] + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Molygon CCDgon ingestion, none specified on command line")
-
-    if coadd_object_molygon is not None:
-        cmfiles = getfilelist(coadd_object_molygon)
-        for file in cmfiles:
-            try:
-                printinfo("Working on coadd_object_molygon file " + file[0])
-                cmobj = Mangle(datafile=file[0], filetype=args['coadd_object_molygon_filetype'],
-                               idDict=coaddObjectIdDict, dbh=dbh, replacecol=3, checkcount=True, skipmissing=alt_table is not None)
-                isLoaded = cmobj.isLoaded()
-                if not isLoaded:
-                    stat = cmobj.executeIngest()
-                    retval += cmobj.getstatus()
-                    printinfo("Ingest of coadd_object_molygon file " + file[0] + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Coadd Object Molygon ingestion, none specified on command line")
-
-    print("\n###################### EXTINCTION INGESTION ########################\n")
-
-    if extinct is not None:
-        try:
-            printinfo("Working on extinction catalog " + extinct)
-            extobj = Extinction(datafile=extinct, idDict=coaddObjectIdDict,
-                                filetype=args['extinct_filetype'], dbh=dbh)
-            isLoaded = extobj.isLoaded()
-            if not isLoaded:
-                stat = extobj.executeIngest()
-                retval += extobj.getstatus()
-                printinfo("Ingest of detection catalog " + extinct + status[stat] + "\n")
-        except:
-            se = sys.exc_info()
-            e = se[1]
-            tb = se[2]
-            print("Exception raised:", e)
-            print("Traceback: ")
-            traceback.print_tb(tb)
-            print(" ")
-            retval += 1
-    else:
-        print("Skipping Excintion ingestion, none specified on command line")
-
-    if extinct_band is not None:
-        exfiles = getfilelist(extinct_band)
-        for file in exfiles:
-            try:
-                printinfo("Working on extinction catalog " + file[0])
-                extobj = Extinction(datafile=file[0], idDict=coaddObjectIdDict,
-                                    filetype=args['extinct_band_filetype'], dbh=dbh)
-                isLoaded = extobj.isLoaded()
-                if not isLoaded:
-                    stat = extobj.executeIngest()
-                    retval += extobj.getstatus()
-                    printinfo("Ingest of detection catalog " + file[0] + status[stat] + "\n")
-            except:
-                se = sys.exc_info()
-                e = se[1]
-                tb = se[2]
-                print("Exception raised:", e)
-                print("Traceback: ")
-                traceback.print_tb(tb)
-                print(" ")
-                retval += 1
-    else:
-        print("Skipping Extinction Band ingestion, none specified on command line")
-
     print("EXITING WITH RETVAL", retval)
     exit(retval)
@@ -0,0 +1,123 @@
+import time
+
+
+class AdaptiveBatcher(object):
+    """ Collects rows into batches for executemany, choosing the number of rows
+        per batch. The first size comes from the estimated bind buffer size of
+        a row, so that narrow rows (healpix) start with large batches and wide
+        rows (coadd objects) with small ones. The size is then tuned from the
+        measured insert rate, aiming at target_seconds per executemany, and is
+        never allowed to need more than memory_cap bytes of bind buffer.
+
+    """
+    # bind buffer allowed for a single batch, in bytes
+    memory_cap = 256 * 1024 * 1024
+    # bind buffer size of the first batch, in bytes
+    start_bytes = 16 * 1024 * 1024
+    # time aimed at for one executemany, in seconds
+    target_seconds = 2.0
+    min_rows = 1000
+    max_rows = 1000000
+    # print the decisions made
+    verbose = True
+
+    # approximate bind buffer bytes per value of each metadata datatype
+    typeBytes = {'INT': 22, 'FLOAT': 8, 'DOUBLE': 8}
+    defaultBytes = 32
+
+    def __init__(self, rowbytes, name='', maxrows=None):
+        """ rowbytes is the estimated bind buffer size of one row, name what is
+            being inserted (for the messages), and maxrows an upper limit of the
+            batch size on top of max_rows
+
+        """
+        self.rowbytes = max(int(rowbytes), 1)
+        self.name = name
+        self.maxrows = min(self.max_rows, max(self.memory_cap // self.rowbytes, 1))
+        if maxrows is not None:
+            self.maxrows = min(self.maxrows, maxrows)
+        self.minrows = min(self.min_rows, self.maxrows)
+        self.size = self.clamp(self.start_bytes // self.rowbytes)
+        self.rate = None
+        self.pending = []
+        # number of rows recorded as inserted
+        self.total = 0
+        self.info("Starting with batches of %d rows (%d bytes per row, at most %d rows within %.0f MB)" %
+                  (self.size, self.rowbytes, self.maxrows, self.memory_cap / 1048576.))
+
+    @classmethod
+    def estimateRowBytes(cls, datatypes, constvalues=()):
+        """ Estimate the bind buffer size of a row from the metadata datatypes of
+            its columns, and the values of the constants bound with it
+
+        """
+        size = 0
+        for dtype in datatypes:
+            if dtype is None:
+                size += cls.defaultBytes
+            else:
+                size += cls.typeBytes.get(dtype.upper(), cls.defaultBytes)
+        for value in constvalues:
+            if isinstance(value, basestring):
+                size += len(value)
+            else:
+                size += cls.typeBytes['INT']
+        return size
+
+    def info(self, msg):
+        if self.verbose:
+            print time.strftime('%Y-%m-%d %H:%M:%S') + " - Batches of " + self.name + ": " + msg
+
+    def clamp(self, size):
+        return int(max(self.minrows, min(self.maxrows, size)))
+
+    def add(self, rows):
+        """ Add rows to the pending batch
+
+        """
+        self.pending.extend(rows)
+
+    def ready(self):
+        """ Whether a full batch is waiting
+
+        """
+        return len(self.pending) >= self.size
+
+    def next(self):
+        """ Take the next batch, of the current size (or less when flushing the
+            remaining rows)
+
+        """
+        batch = self.pending[:self.size]
+        del self.pending[:self.size]
+        return batch
+
+    def flush(self):
+        """ Take all of the remaining rows
+
+        """
+        batch = self.pending
+        self.pending = []
+        return batch
+
+    def record(self, nrows, seconds):
+        """ Record the time taken to insert a batch, and resize the following
+            batches so they take about target_seconds. The size changes by at
+            most a factor two at a time, so one slow batch cannot collapse it.
+
+        """
+        self.total += nrows
+        if nrows == 0 or seconds <= 0:
+            return
+        rate = nrows / seconds
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.5 * self.rate + 0.5 * rate
+        wanted = self.rate * self.target_seconds
+        wanted = max(self.size / 2., min(self.size * 2., wanted))
+        newsize = self.clamp(wanted)
+        if abs(newsize - self.size) > 0.1 * self.size:
+            self.info("%d -> %d rows (%.0f rows/s, last batch of %d rows took %.2f seconds)" %
+                      (self.size, newsize, self.rate, nrows, seconds))
+            self.size = newsize
@@ -1,3 +1,4 @@
+import numpy
 from FitsIngest import FitsIngest
 from despydb import desdbi
 
@@ -93,6 +94,10 @@ class CoaddCatalog(FitsIngest):
             cursor = self.dbh.cursor()
         cursor.execute(sqlstr)
         records = cursor.fetchall()
-        for r in records:
-            if not self.idDict.has_key(r[0]):
-                self.idDict[r[0]] = r[1]
+        if len(records) == 0:
+            return
+        numbers = numpy.array([r[0] for r in records], dtype=numpy.int64)
+        ids = numpy.array([r[1] for r in records], dtype=numpy.int64)
+        # keep any ids which are already in the map
+        missing = self.idDict.lookup(numbers)[1]
+        self.idDict.add(numbers[missing], ids[missing])
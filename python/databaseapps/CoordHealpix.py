@@ -0,0 +1,206 @@
+import collections
+import fitsio
+import numpy
+from Ingest import Ingest
+from RowBuilder import RowBuilder
+from AdaptiveBatcher import AdaptiveBatcher
+from DerivedColumns import DerivedColumns
+
+
+class CoordHealpix(Ingest):
+    """ Fill the healpix table of a tile from the coordinates of its detection
+        catalog, instead of from a separate healpix file. The detection catalog
+        ingest hands over each chunk it reads, with the COADD_OBJECT_IDs of its
+        rows, so the pixels are computed in the same pass as the catalog is
+        ingested, and their rows are committed or rolled back with it.
+
+        The columns are those of the healpix filetype in ops_datafile_metadata:
+        NUMBER gets the COADD_OBJECT_ID, an attribute with a DerivedColumns
+        function (e.g. HPIX_4096) is computed from ALPHAWIN_J2000 and
+        DELTAWIN_J2000, and any other attribute is copied from the detection
+        catalog column of the same name.
+
+        If a checkfile is given, the computed pixels are compared to those of
+        that healpix file (as made by the pipeline today) and any difference
+        fails the ingest.
+
+    """
+
+    def __init__(self, filetype, catalog, checkfile=None):
+        """ catalog is the FitsIngest of the detection catalog the rows come from
+
+        """
+        Ingest.__init__(self, filetype, catalog.fullfilename, 'OBJECTS', '1,2,3', catalog.dbh)
+        self.layout = self.plan.getLayout()
+        self.orderedColumns = list(self.layout.attributes)
+        self.constants = {
+            "FILENAME": self.shortfilename,
+        }
+        # function and input columns of the computed attributes
+        self.functions = {}
+        for att in self.layout.sourceColumns:
+            entry = DerivedColumns.lookup(att)
+            if entry is not None and entry[1] is not None:
+                self.functions[att.upper()] = entry
+        # converted chunks waiting to be inserted, filled by the thread reading
+        # the catalog when it reads ahead
+        self.pending = collections.deque()
+        self.batcher = None
+        self.cursor = None
+        self.sizes = None
+        self.checkfile = checkfile
+        self.check = None
+        if checkfile is not None:
+            self.check = self.readCheckFile(checkfile)
+
+    def readCheckFile(self, checkfile):
+        """ Read the pixels of a healpix file, sorted by NUMBER, as a dictionary
+            of arrays keyed by attribute, with counts of the differences found
+
+        """
+        fits = fitsio.FITS(checkfile)
+        try:
+            columns = ["NUMBER"] + [att for att in self.functions.keys() if att != "NUMBER"]
+            data = fits[self.objhdu].read(columns=columns)
+        finally:
+            fits.close()
+        order = numpy.argsort(data["NUMBER"], kind='mergesort')
+        check = dict([(col, data[col][order]) for col in columns])
+        check["diffs"] = dict([(col, 0) for col in columns if col != "NUMBER"])
+        check["missing"] = 0
+        check["rows"] = 0
+        return check
+
+    def sourceColumns(self, allcols):
+        """ Get the columns of the catalog needed to make the rows, allcols being
+            all the columns of the catalog
+
+        """
+        fitsnames = dict([(col.upper(), col) for col in allcols])
+        needed = []
+        for att in self.layout.sourceColumns:
+            if att.upper() in self.functions:
+                inputs = self.functions[att.upper()][1]
+            elif att.upper() == "NUMBER":
+                continue
+            else:
+                inputs = [att.upper()]
+            for col in inputs:
+                if col not in fitsnames:
+                    raise Exception("Column %s needed for %s is not in %s" % (col, att, self.shortfilename))
+                if fitsnames[col] not in needed:
+                    needed.append(fitsnames[col])
+        return needed
+
+    def addChunk(self, data, ids):
+        """ Convert a chunk of the catalog into rows of the healpix table, ids
+            being the COADD_OBJECT_ID of each row of the chunk
+
+        """
+        columns = dict([(name.upper(), name) for name in data.dtype.names])
+        if self.check is not None:
+            # rows of the check file holding the objects of the chunk
+            numbers = data[columns["NUMBER"]]
+            known = self.check["NUMBER"]
+            idx = numpy.minimum(numpy.searchsorted(known, numbers), len(known) - 1)
+            found = known[idx] == numbers
+            self.check["missing"] += int((~found).sum())
+            self.check["rows"] += len(data)
+        bindcols = []
+        for att in self.layout.sourceColumns:
+            if att.upper() == "NUMBER":
+                bindcols.append(ids)
+            elif att.upper() in self.functions:
+                func, inputs = self.functions[att.upper()]
+                values = func(*[data[columns[col]] for col in inputs])
+                if self.check is not None:
+                    self.check["diffs"][att.upper()] += int(
+                        (self.check[att.upper()][idx[found]] != values[found]).sum())
+                bindcols.append(values)
+            else:
+                bindcols.append(data[columns[att.upper()]])
+        self.pending.append(RowBuilder.toRows(bindcols))
+
+    def insertPending(self):
+        """ Insert the rows converted so far, returning the time taken
+
+        """
+        seconds = 0.
+        while len(self.pending) > 0:
+            rows = self.pending.popleft()
+            if self.cursor is None:
+                constnames, self.constvalues = self.getConstants()
+                self.cursor = self.getCursor()
+                self.sizes = self.layout.inputSizes(self.constvalues)
+                self.batcher = AdaptiveBatcher(
+                    AdaptiveBatcher.estimateRowBytes(self.layout.datatypes, self.constvalues),
+                    self.targettable, self.batchsize)
+            self.batcher.add(rows)
+            while self.batcher.ready():
+                seconds += self.insertBatch(self.cursor, self.sizes, self.constvalues,
+                                            self.batcher.next(), self.batcher)
+        return seconds
+
+    def finish(self):
+        """ Insert the remaining rows once the whole catalog has been read, and
+            check the pixels against the check file. Returns the time taken.
+
+        """
+        seconds = self.insertPending()
+        if self.batcher is not None:
+            rows = self.batcher.flush()
+            if len(rows) > 0:
+                seconds += self.insertBatch(self.cursor, self.sizes, self.constvalues, rows, self.batcher)
+            self.inserted = self.batcher.total
+        if self.check is not None:
+            self.checkResult()
+        self.recordLoad()
+        self.info("Inserted %d rows computed from the coordinates of %s into table %s" %
+                  (self.inserted, self.shortfilename, self.targettable))
+        return seconds
+
+    def recordLoad(self):
+        """ Record the rows inserted in the ledger, if there is one. This is
+            done in the same transaction as the catalog, so that a later run
+            finds these rows. When the catalog is ingested in ranges of rows it
+            is done by the parent, with the rows of all the ranges.
+
+        """
+        if self.ledger is not None:
+            self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                               self.inserted, fullfilename=self.fullfilename)
+
+    def checkResult(self):
+        """ Report the comparison with the check file, raising an exception if
+            any pixel differs
+
+        """
+        diffs = self.check["diffs"]
+        self.info("Compared %d rows with %s: %s, %d objects missing from it" % (
+            self.check["rows"], self.checkfile,
+            ', '.join(["%d %s differences" % (diffs[att], att) for att in sorted(diffs.keys())]),
+            self.check["missing"]))
+        if self.check["missing"] > 0 or sum(diffs.values()) > 0:
+            raise Exception("The pixels computed for %s do not match %s" % (self.shortfilename,
+                                                                            self.checkfile))
+
+    def setConnection(self, dbh):
+        """ Use another connection, e.g. that of a worker process ingesting a
+            range of rows of the catalog
+
+        """
+        self.dbh = dbh
+        self.cursor = None
+
+    def removeRows(self):
+        """ Remove the rows of the catalog, the caller commits
+
+        """
+        cursor = self.dbh.cursor()
+        cursor.execute("delete from %s where filename=:fname" % (self.targettable),
+                       {"fname": self.shortfilename})
+        self.info("Removed %d rows of %s from %s" % (cursor.rowcount, self.shortfilename,
+                                                    self.targettable))
+        if self.ledger is not None:
+            self.ledger.remove(self.dbh, self.shortfilename, self.targettable)
+        cursor.close()
@@ -0,0 +1,117 @@
+import itertools
+import numpy
+
+
+class CsvReader(object):
+    """ Class to read a comma separated file in chunks of lines, parsing each chunk
+        straight into numpy arrays, one per column
+
+    """
+    # numpy type used for each of the converters used by the ingest plans
+    dtypes = {int: numpy.int64, float: numpy.float64, str: str}
+
+    def __init__(self, filename, converters, chunksize=100000):
+        """ converters is the list of types (int, float or str) of the columns
+
+        """
+        self.filename = filename
+        self.types = [self.dtypes.get(conv, str) for conv in converters]
+        self.ncols = len(self.types)
+        self.numeric = str not in self.types
+        self.chunksize = chunksize
+        # number of lines read so far
+        self.linecount = 0
+
+    @staticmethod
+    def countLines(filename, blocksize=1048576):
+        """ Count the lines of a file, reading it in blocks rather than building
+            a list of the lines
+
+        """
+        count = 0
+        last = '\n'
+        f = open(filename, 'rb')
+        try:
+            block = f.read(blocksize)
+            while block:
+                count += block.count('\n')
+                last = block[-1]
+                block = f.read(blocksize)
+        finally:
+            f.close()
+        # a last line without a newline is still a line
+        if last != '\n':
+            count += 1
+        return count
+
+    def __iter__(self):
+        """ Iterate over the file, yielding a list of column arrays per chunk
+
+        """
+        f = open(self.filename, 'r')
+        try:
+            while True:
+                lines = list(itertools.islice(f, self.chunksize))
+                if len(lines) == 0:
+                    break
+                columns = self.parse(lines)
+                self.linecount += len(lines)
+                yield columns
+        finally:
+            f.close()
+
+    def parse(self, lines):
+        """ Parse a list of lines into a list of column arrays
+
+        """
+        nlines = len(lines)
+        # check every line, as a flat parse of the chunk would shift the
+        # values of a short line into the next one
+        counts = numpy.char.count(numpy.array(lines), ',')
+        bad = numpy.flatnonzero(counts != self.ncols - 1)
+        if len(bad) > 0:
+            raise Exception("Incorrect number of columns, error in line %i of %s" %
+                            (self.linecount + bad[0] + 1, self.filename))
+        text = ''.join(lines)
+        if self.numeric:
+            columns = self.parseNumbers(text, nlines)
+            if columns is not None:
+                return columns
+        return self.parseFields(lines)
+
+    def parseNumbers(self, text, nlines):
+        """ Parse a chunk of all numeric text with a single numpy call. Returns
+            None if an integer column is too large to go through a double.
+
+        """
+        values = numpy.fromstring(text.rstrip('\r\n').replace('\n', ','), dtype=numpy.float64, sep=',')
+        if len(values) != nlines * self.ncols:
+            raise Exception("Could not parse lines %i to %i." %
+                            (self.linecount + 1, self.linecount + nlines))
+        values = values.reshape(nlines, self.ncols)
+        columns = []
+        for i, dtype in enumerate(self.types):
+            if dtype is numpy.int64:
+                if nlines > 0 and numpy.abs(values[:, i]).max() >= 2**53:
+                    return None
+                if (values[:, i] != numpy.floor(values[:, i])).any():
+                    raise Exception("Non integer value in column %i of lines %i to %i." %
+                                    (i + 1, self.linecount + 1, self.linecount + nlines))
+                columns.append(values[:, i].astype(numpy.int64))
+            else:
+                columns.append(values[:, i])
+        return columns
+
+    def parseFields(self, lines):
+        """ Parse a chunk of lines by splitting them, then converting each column
+            of text with numpy
+
+        """
+        fields = numpy.array([line.rstrip('\r\n').split(',') for line in lines])
+        columns = []
+        for i, dtype in enumerate(self.types):
+            if dtype is str:
+                columns.append(fields[:, i])
+            else:
+                columns.append(fields[:, i].astype(dtype))
+        return columns
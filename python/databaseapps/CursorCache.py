@@ -0,0 +1,46 @@
+class CursorCache(object):
+    """ Per connection cache of cursors prepared with an insert statement, keyed
+        by the table and the list of columns being inserted. Every file loaded
+        into the same table with the same columns (e.g. all the band catalogs
+        of a tile) then reuses one parsed statement, instead of preparing its
+        own.
+
+    """
+    # keyed by id of the db handle, holding the handle (so the id cannot be
+    # reused while the entry exists) and the dictionary of its cursors
+    connections = {}
+
+    @classmethod
+    def get(cls, dbh, table, columns, sqlstr):
+        """ Get the cursor prepared with sqlstr, the insert of columns into table
+
+        """
+        if id(dbh) not in cls.connections:
+            cls.connections[id(dbh)] = (dbh, {})
+        cursors = cls.connections[id(dbh)][1]
+        key = (table.upper(), tuple([c.upper() for c in columns]))
+        if key not in cursors:
+            cursor = dbh.cursor()
+            cursor.prepare(sqlstr)
+            cursors[key] = cursor
+        return cursors[key]
+
+    @classmethod
+    def clear(cls, dbh=None):
+        """ Close and forget the cursors of a connection, or of all of them
+
+        """
+        if dbh is None:
+            keys = cls.connections.keys()
+        elif id(dbh) in cls.connections:
+            keys = [id(dbh)]
+        else:
+            keys = []
+        for key in keys:
+            for cursor in cls.connections[key][1].values():
+                try:
+                    cursor.close()
+                except Exception:
+                    # the connection may already be gone
+                    pass
+            del cls.connections[key]
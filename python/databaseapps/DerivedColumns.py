@@ -0,0 +1,102 @@
+import re
+import numpy
+from Healpix import Healpix
+
+
+class DerivedColumns(object):
+    """ Registry of the functions computing the derived columns of a filetype,
+        those flagged derived='c' in ops_datafile_metadata, keyed by the name of
+        the column. Every function works on whole numpy arrays, so a chunk of
+        rows is converted in one call rather than one value at a time.
+
+        A header column gets the header keyword named by attribute_name of its
+        metadata (e.g. NITE from DATE-OBS, BAND from FILTER), as an array of one
+        value. A row column lists the table columns it is computed from when it
+        is registered (e.g. HEALPix indices from ALPHAWIN_J2000,DELTAWIN_J2000),
+        and its metadata only needs attribute_name equal to column_name.
+
+    """
+    # (function, input columns or None for a header column) of each column
+    functions = {}
+
+    # columns of the positions used by the pixel indices
+    radec = ('ALPHAWIN_J2000', 'DELTAWIN_J2000')
+
+    # HPIX_<nside> are NESTED pixels, HPIX_<nside>_RING are RING pixels
+    healpixPattern = re.compile(r'^HPIX_(\d+)(_RING)?$', re.IGNORECASE)
+
+    @classmethod
+    def register(cls, name, inputs=None):
+        """ Register the decorated function as the one computing column name.
+            inputs is the list of table columns of a row column, left None for
+            a column computed from a header keyword.
+
+        """
+        def decorator(func):
+            if inputs is None:
+                cls.functions[name.upper()] = (func, None)
+            else:
+                cls.functions[name.upper()] = (func, tuple([i.upper() for i in inputs]))
+            return func
+        return decorator
+
+    @classmethod
+    def lookup(cls, name):
+        """ Get the (function, inputs) of a column, or None if it has no function
+
+        """
+        name = name.upper()
+        if name in cls.functions:
+            return cls.functions[name]
+        m = cls.healpixPattern.match(name)
+        if m:
+            nside = int(m.group(1))
+            nest = m.group(2) is None
+            if not nest or Healpix.isPowerOfTwo(nside):
+                return (lambda ra, dec: Healpix.ang2pix(nside, ra, dec, nest), cls.radec)
+        return None
+
+    @classmethod
+    def get(cls, name):
+        """ Get the (function, inputs) of a column, raising an exception if there
+            is none
+
+        """
+        entry = cls.lookup(name)
+        if entry is None:
+            raise Exception("No function registered for derived column %s" % (name))
+        return entry
+
+    @classmethod
+    def fromHeader(cls, name, value):
+        """ Compute the value of a header column from its header keyword
+
+        """
+        func, inputs = cls.get(name)
+        if inputs is not None:
+            raise Exception("Derived column %s is computed from %s, not from a header keyword" %
+                            (name, ','.join(inputs)))
+        return func(numpy.array([value]))[0].tolist()
+
+
+@DerivedColumns.register('NITE')
+def nite(dateobs):
+    """ The nite of an observation is the date 15 hours before its DATE-OBS
+        (UT), so that the exposures of a night share one nite, as YYYYMMDD
+
+    """
+    times = numpy.char.strip(numpy.asarray(dateobs).astype(str)).astype('datetime64[s]')
+    days = (times - numpy.timedelta64(15, 'h')).astype('datetime64[D]')
+    return numpy.char.replace(days.astype(str), '-', '')
+
+
+@DerivedColumns.register('BAND')
+def band(filters):
+    """ The band is the first character of FILTER
+
+    """
+    bands = numpy.asarray(filters).astype('S1').astype(str)
+    bad = ~numpy.in1d(bands, ['u', 'g', 'r', 'i', 'z', 'Y'])
+    if bad.any():
+        raise KeyError("filter %s yields an invalid band" % (numpy.asarray(filters)[bad][0]))
+    return bands
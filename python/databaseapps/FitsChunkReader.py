@@ -0,0 +1,106 @@
+import time
+import fitsio
+from ingestutils import IngestUtils as ingestutils
+
+
+class FitsChunkReader(object):
+    """ Class to read a fits table in contiguous chunks of rows, keeping a single
+        file handle open for the whole read. Chunks can optionally be read ahead
+        in a background thread, so the next chunk is being read while the
+        current one is processed.
+
+    """
+
+    def __init__(self, fits, ext, columns=None, chunksize=10000, firstrow=0, lastrow=None,
+                 readahead=0):
+        """ fits is either an open fitsio.FITS object or the name of the file to
+            open, ext is the table hdu, columns the list of columns to read (all
+            of them if None), firstrow and lastrow the (0 based, end exclusive)
+            range of rows to read, and readahead the number of chunks to read in
+            advance (0 to disable)
+
+        """
+        if isinstance(fits, basestring):
+            self.filename = fits
+            self.fits = fitsio.FITS(fits)
+            self.ownhandle = True
+        else:
+            self.filename = fits._filename
+            self.fits = fits
+            self.ownhandle = False
+        self.hdu = self.fits[ext]
+        self.columns = columns
+        self.chunksize = chunksize
+        self.firstrow = firstrow
+        if lastrow is None:
+            lastrow = self.hdu.get_nrows()
+        self.lastrow = lastrow
+        self.readahead = readahead
+
+        # statistics
+        self.nrows = 0
+        self.nbytes = 0
+        self.readtime = 0.
+        self.starttime = None
+        self.endtime = None
+
+    def close(self):
+        """ Close the fits file, if it was opened by this object
+
+        """
+        if self.ownhandle and self.fits:
+            self.fits.close()
+            self.fits = None
+
+    def readChunk(self, startrow, endrow):
+        """ Read the contiguous rows [startrow, endrow) from the table
+
+        """
+        start = time.time()
+        if self.columns is None:
+            data = self.hdu[startrow:endrow]
+        else:
+            data = self.hdu[self.columns][startrow:endrow]
+        self.readtime += time.time() - start
+        self.nrows += len(data)
+        self.nbytes += data.nbytes
+        return data
+
+    def chunks(self):
+        """ Generator yielding (startrow, endrow) for each chunk to be read
+
+        """
+        endrow = self.firstrow
+        while endrow < self.lastrow:
+            startrow = endrow
+            endrow = min(startrow + self.chunksize, self.lastrow)
+            yield startrow, endrow
+
+    def __iter__(self):
+        """ Iterate over the chunks of the table, yielding numpy record arrays
+
+        """
+        self.starttime = time.time()
+        try:
+            chunks = (self.readChunk(startrow, endrow) for startrow, endrow in self.chunks())
+            if self.readahead > 0:
+                chunks = ingestutils.prefetch(chunks, self.readahead)
+            for data in chunks:
+                yield data
+        finally:
+            self.endtime = time.time()
+
+    def report(self):
+        """ Return a summary of the read rates for this file
+
+        """
+        elapsed = 0.
+        if self.starttime is not None:
+            elapsed = (self.endtime or time.time()) - self.starttime
+        rate = 0.
+        mbrate = 0.
+        if self.readtime > 0:
+            rate = self.nrows / self.readtime
+            mbrate = self.nbytes / self.readtime / 1048576.
+        return ("Read %d rows (%.1f MB) from %s in %.2f seconds (%.2f elapsed): %.0f rows/s, %.2f MB/s" %
+                (self.nrows, self.nbytes / 1048576., self.filename, self.readtime, elapsed, rate, mbrate))
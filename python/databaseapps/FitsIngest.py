@@ -1,17 +1,37 @@
 import fitsio
+import numpy
 import sys
+import time
 import traceback
-from Ingest import Ingest, Entry
+from Ingest import Ingest
+from RowBuilder import RowBuilder
+from RowRanges import RowRanges
+from FitsChunkReader import FitsChunkReader
 from despymisc import miscutils
+from despydb import desdbi
 
 
 class FitsIngest(Ingest):
     # maximum number of rows to grap from a fits table at a time
     fits_chunk = 10000
+    # number of chunks to read ahead in a background thread (0 to disable)
+    fits_readahead = 0
+    # build the rows with whole column operations, rather than row by row
+    columnar = True
+    # a resumed load starts reading the table at the first row not loaded
+    seekable = True
+    # number of processes splitting the rows of a table between them, each
+    # inserting a contiguous range of at least range_min_rows rows over its
+    # own connection, opened with services and section
+    range_jobs = 1
+    range_min_rows = 100000
+    services = None
+    section = None
 
     def __init__(self, filetype, datafile, idDict, generateID=False, dbh=None, matchCount=True,
                  hdu='OBJECTS'):
-        """ Base class used to ingest data from fits tables
+        """ Base class used to ingest data from fits tables, idDict is the IdMap
+            of object numbers to COADD_OBJECT_ID
 
         """
         Ingest.__init__(self, filetype, datafile, hdu, '1,2,3', dbh)
@@ -22,6 +42,15 @@ class FitsIngest(Ingest):
 
         self.generateID = generateID
         self.matchCount = matchCount
+        self.fitsColumns = []
+        self.linecount = 0
+        # end of the range of rows being ingested, None for the whole table
+        self.lastrow = None
+        # whether the whole id map was made before the rows are ingested
+        self.idsAssigned = False
+        # COADD_OBJECT_ID of the rows of the chunk being converted, handed to
+        # the companions
+        self.chunkIds = None
 
     def __del__(self):
         if hasattr(self, 'fits'):
@@ -34,96 +63,218 @@ class FitsIngest(Ingest):
         """
         return self.fits[self.objhdu].get_nrows()
 
-    def generateRows(self):
-        """ Convert the input fits data into a list of lists
+    def canCheckpoint(self):
+        """ The ids handed out while creating the id map depend on every row
+            before, so such a load cannot be resumed part way unless the whole
+            map was made first
 
         """
-        retval = 0
-        lastrow = self.fits[self.objhdu].get_nrows()
+        return not self.generateID or self.idsAssigned
 
-        # get the column headers to ingest
-        attrsToCollect = self.dbDict[self.objhdu]
-        linecount = 0
-        try:
-            attrs = attrsToCollect.keys()
+    def rejectFile(self):
+        if self.lastrow is None:
+            return Ingest.rejectFile(self)
+        return Ingest.rejectFile(self).replace('.rejects', '.%d-%d.rejects' % (self.firstrow, self.lastrow))
 
-            # get the actual columns in the fits table
-            allcols = self.fits[self.objhdu].get_colnames()
+    def setColumns(self):
+        """ Determine the fits columns to read, and the ordered list of attributes
+            being inserted
 
-            # trim down the columns to those that are acutally in the file
-            for col in allcols:
-                # need NUMBER to look up COADD_OBJECT_ID
-                if col.upper() in attrs or col.upper() == "NUMBER":
-                    self.orderedColumns.append(col)
+        """
+        # get the actual columns in the fits table
+        allcols = self.fits[self.objhdu].get_colnames()
+
+        self.layout = self.plan.getLayout(allcols, self.generateID)
+        self.fitsColumns = list(self.layout.sourceColumns)
+        self.orderedColumns = list(self.layout.attributes)
 
+    def generateBatches(self):
+        """ Convert the input fits data into lists of lists, yielding one list
+            per chunk of the fits table
+
+        """
+        self.linecount = self.firstrow
+        self.setColumns()
+        # the companions may need more columns, read after the ingested ones
+        readColumns = list(self.fitsColumns)
+        allcols = self.fits[self.objhdu].get_colnames()
+        for companion in self.companions:
+            readColumns += [col for col in companion.sourceColumns(allcols) if col not in readColumns]
+        reader = FitsChunkReader(self.fits, self.objhdu, readColumns, self.fits_chunk,
+                                 firstrow=self.firstrow, lastrow=self.lastrow,
+                                 readahead=self.fits_readahead)
+        try:
             # get the datatypes
             datatypes = self.fits[self.objhdu].get_rec_dtype()[0]
-
-            startrow = 0
-            endrow = 0
+            self.layout.checkArrays(datatypes)
+            if self.columnar:
+                builder = RowBuilder(self.fitsColumns, datatypes)
 
             # go through all the data
-            while endrow < lastrow:
-                startrow = endrow
-                endrow = min(startrow+self.fits_chunk, lastrow)
-
-                data = fitsio.read(
-                    self.fullfilename,
-                    rows=range(startrow, endrow),
-                    columns=self.orderedColumns, ext=self.objhdu
-                )
-
-                for row in data:
-                    linecount += 1
-                    # IMPORTANT! Must convert numpy array to python list, or
-                    # suffer big performance hit. This is due to numpy bug
-                    # fixed in more recent version than one in EUPS.
-                    row = row.tolist()
-
-                    # array to hold values for this FITS row
-                    outrow = []
-
-                    coadd_object_id = None
-
-                    for idx in range(0, len(self.orderedColumns)):
-                        # if the COADD_OBJECT_ID dictionary is being created
-                        if self.generateID and self.orderedColumns[idx] == "NUMBER":
-                            if self.idDict.has_key(row[idx]):
-                                outrow.insert(0, self.idDict[row[idx]])
-                            else:
-                                coadd_id = self.coadd_ids.pop()
-                                self.idDict[row[idx]] = coadd_id
-                                outrow.insert(0, coadd_id)
-
-                            outrow.append(row[idx])
-                        # if this is NUMBER column, look up COADD_OBJECT_ID and
-                        # then skip it
-                        elif self.orderedColumns[idx] == "NUMBER":
-                            try:
-                                outrow.append(self.idDict[row[idx]])
-                            except KeyError:
-                                miscutils.fwdebug_print(
-                                    "ERROR: Coadd number (%i) specified that does not have a corresponding coadd id, found in row %i." % (row[idx], linecount))
-                                return 1
-
-                        # if this column is an array of values
-                        elif datatypes[self.orderedColumns[idx]].subdtype:
-                            arrvals = row[idx]
-
-                            # convert the array to a python list, and append
-                            arrvals = arrvals.tolist()
-                            for elem in arrvals:
-                                outrow.append(elem)
-                            # try +=
-                        # else it is a scalar
-                        else:
-                            if 'S' in datatypes[self.orderedColumns[idx]].str:
-                                outrow.append(row[idx].strip())
-                            else:
-                                outrow.append(row[idx])
-                    self.sqldata.append(outrow)
+            for data in reader:
+                # ids of the objects of the chunk, kept by the conversion
+                self.chunkIds = None
+                if self.columnar:
+                    rows = self.convertChunk(builder, data, self.linecount)
+                else:
+                    rows = self.convertChunkByRow(datatypes, data, self.linecount)
+                if rows is None:
+                    raise Exception("Coadd number without a corresponding coadd id in %s" %
+                                    (self.shortfilename))
+                if len(self.companions) > 0 and self.chunkIds is None:
+                    self.chunkIds = self.idDict.lookup(data["NUMBER"])[0]
+                for companion in self.companions:
+                    companion.addChunk(data, self.chunkIds)
+                self.linecount += len(rows)
+                yield rows
+        except:
+            miscutils.fwdebug_print("Possible error in line %i of %s" % (self.linecount, self.shortfilename))
+            raise
+        self.info(reader.report())
+
+        if (not self.generateID and self.matchCount and self.lastrow is None and
+                len(self.idDict) != self.linecount):
+            raise Exception("Incorrect number of rows in %s. Count is %i, should be %i" % (
+                self.shortfilename, self.linecount, len(self.idDict)))
+
+    def getRanges(self):
+        """ Get the row ranges to ingest in parallel, or None if the table is
+            to be ingested by this process alone
+
+        """
+        if self.range_jobs <= 1 or not self.streaming:
+            return None
+        nrows = self.getNumObjects()
+        if nrows < 2 * self.range_min_rows:
+            return None
+        if self.resume is None:
+            self.resume = self.getCheckpoint()
+        if self.resume[0] > 0:
+            self.info("Resuming %s in a single process" % (self.shortfilename))
+            return None
+        if not RowRanges.canFork():
+            self.info("Ingesting %s in a single process, as this is already a worker process" %
+                      (self.shortfilename))
+            return None
+        return RowRanges.split(nrows, self.range_jobs, self.range_min_rows)
+
+    def assignIDs(self):
+        """ Make the ids of the whole table in the order of its rows, as a
+            single process would, before the ranges are ingested
+
+        """
+        linecount = 0
+        reader = FitsChunkReader(self.fits, self.objhdu, ["NUMBER"], self.fits_chunk)
+        for data in reader:
+            self.lookupIDs(data["NUMBER"], linecount)
+            linecount += len(data)
+        self.idsAssigned = True
+
+    def connectWorker(self):
+        """ Open the connection and the file of a worker process ingesting a
+            range of rows
+
+        """
+        # hold on to the connection of the parent, releasing it here would log
+        # it off for the parent as well
+        self.parentdbh = self.dbh
+        self.dbh = desdbi.DesDbi(self.services, self.section, retry=True)
+        self.fits = fitsio.FITS(self.fullfilename)
+        for companion in self.companions:
+            companion.setConnection(self.dbh)
+
+    def ingestRange(self, firstrow, lastrow):
+        """ Insert and commit the rows [firstrow, lastrow) of the table, in a
+            worker process. Returns the status, the number of rows inserted and
+            the list of the number of rows inserted by each companion.
+
+        """
+        self.resume = (firstrow, 0)
+        self.lastrow = lastrow
+        # the file and its companions are recorded by the parent once every
+        # range is committed
+        self.ledger = None
+        for companion in self.companions:
+            companion.ledger = None
+        self.checkpoint_rows = 0
+        status = Ingest.executeIngest(self)
+        return status, self.inserted, [companion.inserted for companion in self.companions]
+
+    def executeIngest(self):
+        """ Insert the data, splitting the rows of the table into ranges ingested
+            by range_jobs processes if set. The file is recorded in the ledger
+            once every range is committed, and if any range fails the rows of
+            the file are removed.
+
+        """
+        ranges = self.getRanges()
+        if ranges is None:
+            return Ingest.executeIngest(self)
+        start = time.time()
+        nrows = self.getNumObjects()
+        try:
+            if self.generateID:
+                self.assignIDs()
+            elif self.matchCount and len(self.idDict) != nrows:
+                raise Exception("Incorrect number of rows in %s. Count is %i, should be %i" % (
+                    self.shortfilename, nrows, len(self.idDict)))
+            self.info("Ingesting %s in %d ranges of rows with %d processes" %
+                      (self.shortfilename, len(ranges), min(self.range_jobs, len(ranges))))
+            results = RowRanges.run(self, ranges, self.range_jobs)
+            failed = ["%d-%d" % (r[0], r[1]) for r in results if r[2] != 0]
+            if len(failed) > 0:
+                raise Exception("Rows %s of %s failed" % (', '.join(failed), self.shortfilename))
+            self.inserted = sum([r[3] for r in results])
+            if self.ledger is not None:
+                # every row of a range which was not inserted was rejected
+                self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                                   self.inserted, pfw_attempt_id=getattr(self, 'pfw_attempt_id', None),
+                                   fullfilename=self.fullfilename, seconds=time.time() - start,
+                                   nrejects=nrows - self.inserted)
+            for i, companion in enumerate(self.companions):
+                companion.inserted = sum([r[4][i] for r in results])
+                companion.recordLoad()
+            self.commit()
+            self.info("Inserted %d rows into table %s in %.2f seconds" %
+                      (self.inserted, self.targettable, time.time() - start))
+            self.status = 0
+        except:
+            se = sys.exc_info()
+            e = str(se[1])
+            tb = se[2]
+            print "Exception raised: ", e.strip(), " while ingesting ", self.shortfilename
+            print "Traceback: "
+            traceback.print_tb(tb)
+            print " "
+            self.dbh.rollback()
+            self.removeRows()
+            self.status = 1
+        return self.status
+
+    def removeRows(self):
+        """ Remove the rows of the file committed by the ranges which succeeded,
+            and those of its companions
+
+        """
+        cursor = self.dbh.cursor()
+        cursor.execute("delete from %s where filename=:fname" % (self.targettable),
+                       {"fname": self.shortfilename})
+        self.info("Removed %d rows of %s from %s" % (cursor.rowcount, self.shortfilename,
+                                                    self.targettable))
+        cursor.close()
+        for companion in self.companions:
+            companion.removeRows()
+        self.commit()
+
+    def generateRows(self):
+        """ Convert the input fits data into a list of lists
+
+        """
+        try:
+            for rows in self.generateBatches():
+                self.sqldata.extend(rows)
+            return 0
         except:
-            miscutils.fwdebug_print("Possible error in line %i of %s" % (linecount, self.shortfilename))
             se = sys.exc_info()
             e = se[1]
             tb = se[2]
@@ -132,15 +283,111 @@ class FitsIngest(Ingest):
             traceback.print_tb(tb)
             print " "
             self.status = 1
-            retval = 1
-        finally:
+            return 1
+
+    def lookupIDs(self, numbers, linecount):
+        """ Get the COADD_OBJECT_ID for each of the given object numbers, assigning
+            new ids from self.coadd_ids if the id map is being created.
+            Returns None if a number has no corresponding id.
+
+        """
+        numbers = numpy.asarray(numbers)
+        ids, missing = self.idDict.lookup(numbers)
+        if not missing.any():
+            return ids
+        if self.generateID:
+            # hand out new ids in order of first appearance, popping them off
+            # the end of the list
+            newnums, first = numpy.unique(numbers[missing], return_index=True)
+            newnums = newnums[numpy.argsort(first)]
+            if len(self.coadd_ids) < len(newnums):
+                raise Exception("%d new objects in %s but only %d coadd ids left" % (
+                    len(newnums), self.shortfilename, len(self.coadd_ids)))
+            newids =self.coadd_ids[-len(newnums):][::-1]
+            del self.coadd_ids[-len(newnums):]
+            self.idDict.add(newnums, newids)
+            ids, missing = self.idDict.lookup(numbers)
+            return ids
+        i = numpy.nonzero(missing)[0][0]
+        miscutils.fwdebug_print(
+            "ERROR: Coadd number (%i) specified that does not have a corresponding coadd id, found in row %i." % (numbers[i], linecount + i + 1))
+        return None
+
+    def convertChunk(self, builder, data, linecount):
+        """ Convert a chunk of fits data into a list of lists using whole column
+            operations
+
+        """
+        number = None
+        if "NUMBER" in self.fitsColumns:
+            number = "NUMBER"
+        bindcols = builder.columnize(data, skip=[number])
+        if number is not None:
+            numbers = data[number]
+            ids = self.lookupIDs(numbers, linecount)
+            if ids is None:
+                return None
+            self.chunkIds = ids
+            idx = bindcols.index(None)
             if self.generateID:
-                self.dbDict[self.objhdu]['ID'] = Entry(column_name='ID', position=0)
-                self.orderedColumns = ['ID'] + self.orderedColumns
-            elif self.matchCount and len(self.idDict.keys()) != len(self.sqldata):
-                self.status = 1
-                retval = 1
-                miscutils.fwdebug_print("Incorrect number of rows in %s. Count is %i, should be %i" % (
-                    self.shortfilename, len(self.sqldata), len(self.idDict.keys())))
-
-            return retval
+                # COADD_OBJECT_ID goes first, NUMBER stays in place
+                bindcols[idx] = numbers
+                bindcols.insert(0, ids)
+            else:
+                bindcols[idx] = ids
+        return RowBuilder.toRows(bindcols)
+
+    def convertChunkByRow(self, datatypes, data, linecount):
+        """ Convert a chunk of fits data into a list of lists, one row and cell
+            at a time
+
+        """
+        rows = []
+        for row in data:
+            linecount += 1
+            # IMPORTANT! Must convert numpy array to python list, or
+            # suffer big performance hit. This is due to numpy bug
+            # fixed in more recent version than one in EUPS.
+            row = row.tolist()
+
+            # array to hold values for this FITS row
+            outrow = []
+
+            for idx in range(0, len(self.fitsColumns)):
+                # if the COADD_OBJECT_ID dictionary is being created
+                if self.generateID and self.fitsColumns[idx] == "NUMBER":
+                    if self.idDict.has_key(row[idx]):
+                        outrow.insert(0, self.idDict[row[idx]])
+                    else:
+                        coadd_id = self.coadd_ids.pop()
+                        self.idDict[row[idx]] = coadd_id
+                        outrow.insert(0, coadd_id)
+
+                    outrow.append(row[idx])
+                # if this is NUMBER column, look up COADD_OBJECT_ID and
+                # then skip it
+                elif self.fitsColumns[idx] == "NUMBER":
+                    try:
+                        outrow.append(self.idDict[row[idx]])
+                    except KeyError:
+                        miscutils.fwdebug_print(
+                            "ERROR: Coadd number (%i) specified that does not have a corresponding coadd id, found in row %i." % (row[idx], linecount))
+                        return None
+
+                # if this column is an array of values
+                elif datatypes[self.fitsColumns[idx]].subdtype:
+                    arrvals = row[idx]
+
+                    # convert the array to a python list, and append
+                    arrvals = arrvals.tolist()
+                    for elem in arrvals:
+                        outrow.append(elem)
+                    # try +=
+                # else it is a scalar
+                else:
+                    if 'S' in datatypes[self.fitsColumns[idx]].str:
+                        outrow.append(row[idx].strip())
+                    else:
+                        outrow.append(row[idx])
+            rows.append(outrow)
+        return rows
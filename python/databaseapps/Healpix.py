@@ -0,0 +1,109 @@
+import numpy
+
+
+class Healpix(object):
+    """ HEALPix pixel indices of positions, computed with whole array numpy
+        operations so that no compiled healpix library is needed. The pixel
+        numbers follow the reference implementation (healpix_base.cc), in the
+        NESTED or RING scheme.
+
+    """
+
+    @staticmethod
+    def isPowerOfTwo(nside):
+        return nside > 0 and (nside & (nside - 1)) == 0
+
+    @staticmethod
+    def spreadBits(values):
+        """ Spread the bits of values out to the even bits of the result, as
+            needed to interleave the x and y coordinates of a nested pixel
+
+        """
+        values = values.astype(numpy.int64)
+        values = (values | (values << 16)) & 0x0000FFFF0000FFFF
+        values = (values | (values << 8)) & 0x00FF00FF00FF00FF
+        values = (values | (values << 4)) & 0x0F0F0F0F0F0F0F0F
+        values = (values | (values << 2)) & 0x3333333333333333
+        values = (values | (values << 1)) & 0x5555555555555555
+        return values
+
+    @classmethod
+    def ang2pix(cls, nside, ra, dec, nest=True):
+        """ Get the pixel of each position, ra and dec being arrays of degrees
+
+        """
+        if nest and not cls.isPowerOfTwo(nside):
+            raise Exception("nside of a NESTED pixelization must be a power of 2, not %s" % (nside))
+        # colatitude as healpy computes it, so that positions on the boundary
+        # of a pixel land in the same pixel
+        theta = 0.5 * numpy.pi - numpy.radians(numpy.asarray(dec, dtype=numpy.float64))
+        ra = numpy.radians(numpy.asarray(ra, dtype=numpy.float64))
+        z = numpy.cos(theta)
+        za = numpy.abs(z)
+        # sin(theta), more accurate than sqrt(1 - z*z) near the poles
+        sth = numpy.sin(theta)
+        tt = numpy.mod(ra / (0.5 * numpy.pi), 4.0)
+        # fmod can round up to 4 for a tiny negative ra
+        tt = numpy.where(tt >= 4.0, 0.0, tt)
+        equator = za <= 2.0 / 3.0
+
+        # equatorial region, indices of the ascending and descending edge lines
+        temp1 = nside * (0.5 + tt)
+        temp2 = nside * z * 0.75
+        ejp = (temp1 - temp2).astype(numpy.int64)
+        ejm = (temp1 + temp2).astype(numpy.int64)
+
+        # polar caps
+        ntt = numpy.minimum(tt.astype(numpy.int64), 3)
+        tp = tt - ntt
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            tmp = numpy.where(za < 0.99, nside * numpy.sqrt(numpy.maximum(3 * (1 - za), 0.0)),
+                              nside * sth / numpy.sqrt((1. + za) / 3.))
+        pjp = (tp * tmp).astype(numpy.int64)
+        pjm = ((1.0 - tp) * tmp).astype(numpy.int64)
+
+        if nest:
+            return cls.nestPixels(nside, z, equator, ejp, ejm, ntt, pjp, pjm)
+        return cls.ringPixels(nside, z, tt, equator, ejp, ejm, pjp, pjm)
+
+    @classmethod
+    def nestPixels(cls, nside, z, equator, ejp, ejm, ntt, pjp, pjm):
+        order = int(nside).bit_length() - 1
+        # equatorial faces 4 to 7 and the corners of the polar faces
+        ifp = ejp >> order
+        ifm = ejm >> order
+        eface = numpy.where(ifp == ifm, ifp | 4, numpy.where(ifp < ifm, ifp, ifm + 8))
+        eix = ejm & (nside - 1)
+        eiy = nside - (ejp & (nside - 1)) - 1
+
+        # points too close to the boundary of a polar face
+        pjp = numpy.minimum(pjp, nside - 1)
+        pjm = numpy.minimum(pjm, nside - 1)
+        north = z >= 0
+        pface = numpy.where(north, ntt, ntt + 8)
+        pix = numpy.where(north, nside - pjm - 1, pjp)
+        piy = numpy.where(north, nside - pjp - 1, pjm)
+
+        face = numpy.where(equator, eface, pface).astype(numpy.int64)
+        ix = numpy.where(equator, eix, pix)
+        iy = numpy.where(equator, eiy, piy)
+        return (face << (2 * order)) + cls.spreadBits(ix) + (cls.spreadBits(iy) << 1)
+
+    @staticmethod
+    def ringPixels(nside, z, tt, equator, ejp, ejm, pjp, pjm):
+        nl4 = 4 * nside
+        ncap = 2 * nside * (nside - 1)
+        npix = 12 * nside * nside
+
+        # ring number counted from z=2/3, and the pixel within the ring
+        eir = nside + 1 + ejp - ejm
+        kshift = 1 - (eir & 1)
+        eip = ((ejp + ejm - nside + kshift + 1 + 2 * nl4) >> 1) % nl4
+        epix = ncap + (eir - 1) * nl4 + eip
+
+        # ring number counted from the closest pole
+        pir = pjp + pjm + 1
+        pip = (tt * pir).astype(numpy.int64) % (4 * pir)
+        ppix = numpy.where(z > 0, 2 * pir * (pir - 1) + pip, npix - 2 * pir * (pir + 1) + pip)
+
+        return numpy.where(equator, epix, ppix).astype(numpy.int64)
@@ -0,0 +1,123 @@
+import numpy
+
+
+class IdMap(object):
+    """ Compact map of object NUMBER to COADD_OBJECT_ID, held in numpy arrays
+
+        SExtractor numbers objects 1..N, so by default the ids are stored in an
+        array indexed directly by number. If the numbers turn out to be too sparse
+        for that, the map switches to a pair of arrays sorted by number, and
+        lookups are done with searchsorted. Whole arrays of numbers are mapped at
+        once with lookup(). The usual dictionary methods are also provided for
+        scalar access.
+
+    """
+    # value used for numbers without an id, coadd object ids are always positive
+    MISSING = -1
+    # the dense array may be at most this many times, plus DENSE_SLACK, larger
+    # than the number of entries in the map
+    DENSE_FACTOR = 2
+    DENSE_SLACK = 1024
+
+    def __init__(self):
+        self.dense = numpy.empty(0, dtype=numpy.int64)
+        self.numbers = None
+        self.ids = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, number):
+        return not self.lookup([number])[1][0]
+
+    def has_key(self, number):
+        return number in self
+
+    def __getitem__(self, number):
+        ids, missing = self.lookup([number])
+        if missing[0]:
+            raise KeyError(number)
+        return int(ids[0])
+
+    def __setitem__(self, number, coadd_id):
+        self.add([number], [coadd_id])
+
+    def keys(self):
+        return self.getNumbers().tolist()
+
+    def getNumbers(self):
+        """ Return the numbers in the map as a sorted array
+
+        """
+        if self.numbers is not None:
+            return self.numbers
+        return numpy.nonzero(self.dense != self.MISSING)[0]
+
+    def getIds(self):
+        """ Return the ids in the map, in the same order as getNumbers()
+
+        """
+        if self.ids is not None:
+            return self.ids
+        return self.dense[self.dense != self.MISSING]
+
+    def isDense(self):
+        return self.numbers is None
+
+    def lookup(self, numbers):
+        """ Map an array of numbers to their ids. Returns the array of ids and a
+            boolean mask which is True where a number is not in the map (the id is
+            set to MISSING there)
+
+        """
+        numbers = numpy.asarray(numbers, dtype=numpy.int64)
+        ids = numpy.empty(len(numbers), dtype=numpy.int64)
+        ids.fill(self.MISSING)
+        if self.isDense():
+            inrange = (numbers >= 0) & (numbers < len(self.dense))
+            ids[inrange] = self.dense[numbers[inrange]]
+        elif len(self.numbers) > 0:
+            idx = numpy.searchsorted(self.numbers, numbers)
+            idx[idx == len(self.numbers)] = 0
+            found = self.numbers[idx] == numbers
+            ids[found] = self.ids[idx[found]]
+        return ids, ids == self.MISSING
+
+    def add(self, numbers, ids):
+        """ Add (or replace) the ids for an array of numbers
+
+        """
+        numbers = numpy.asarray(numbers, dtype=numpy.int64)
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if len(numbers) == 0:
+            return
+        if self.isDense():
+            top = numbers.max() + 1
+            limit = self.DENSE_FACTOR * (self.count + len(numbers)) + self.DENSE_SLACK
+            if numbers.min() >= 0 and top <= limit:
+                if top > len(self.dense):
+                    # grow geometrically so repeated adds stay cheap
+                    size = max(top, min(2 * len(self.dense), limit))
+                    dense = numpy.empty(size, dtype=numpy.int64)
+                    dense.fill(self.MISSING)
+                    dense[:len(self.dense)] = self.dense
+                    self.dense = dense
+                new = numpy.unique(numbers[self.dense[numbers] == self.MISSING])
+                self.dense[numbers] = ids
+                self.count += len(new)
+                return
+            self.numbers = self.getNumbers()
+            self.ids = self.getIds()
+            self.dense = None
+        # sorted mode, later entries replace earlier ones
+        allnumbers = numpy.concatenate([self.numbers, numbers])
+        allids = numpy.concatenate([self.ids, ids])
+        order = numpy.argsort(allnumbers[::-1], kind='mergesort')
+        allnumbers = allnumbers[::-1][order]
+        allids = allids[::-1][order]
+        keep = numpy.ones(len(allnumbers), dtype=bool)
+        keep[1:] = allnumbers[1:] != allnumbers[:-1]
+        self.numbers = allnumbers[keep]
+        self.ids = allids[keep]
+        self.count = len(self.numbers)
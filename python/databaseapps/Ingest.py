@@ -1,6 +1,13 @@
+import os
+import glob
 import time
-from collections import OrderedDict
+import itertools
 from ingestutils import IngestUtils as ingestutils
+from IngestPlan import IngestPlan, Entry
+from CursorCache import CursorCache
+from AdaptiveBatcher import AdaptiveBatcher
+from MetadataCache import MetadataCache
+from RowSorter import RowSorter
 from despymisc import miscutils
 import traceback
 import sys
@@ -12,6 +19,57 @@ class Ingest(object):
     """
     debug = True
     debugDateFormat = '%Y-%m-%d %H:%M:%S'
+    # insert the data as it is generated, one batch at a time, rather than
+    # holding every row of the file in self.sqldata
+    streaming = True
+    # maximum number of rows to pass to a single executemany, within this the
+    # size of each batch is chosen by an AdaptiveBatcher
+    batchsize = 1000000
+    # number of batches a separate thread may generate ahead of the inserts
+    # when streaming (0 to generate and insert in the same thread)
+    pipeline_depth = 0
+
+    # number of rows already in the database for (table, filename), filled in
+    # bulk by prefetchIngested and used once by numAlreadyIngested
+    ingestedCounts = {}
+    # ledger entries of the partial loads found by prefetchIngested, keyed by
+    # (table, filename)
+    partialLoads = {}
+    # collect the rows rejected by the database, writing them to a reject file
+    # instead of rolling back the whole file on the first bad row
+    batch_errors = False
+    # number of rejected rows (or fraction of the rows of the file, if below 1)
+    # up to which the other rows are still committed
+    error_budget = 0
+    # directory the reject files (<filename>.rejects) are written to
+    reject_dir = '.'
+    # commit every checkpoint_rows rows (0 to commit once at the end), recording
+    # how far the load got so an interrupted load can be resumed from there.
+    # The checkpoint is kept in the ledger if there is one, else in a file in
+    # checkpoint_dir
+    checkpoint_rows = 0
+    checkpoint_dir = '.'
+    # whether generateBatches starts at self.firstrow itself, otherwise the rows
+    # before it are generated and dropped when resuming
+    seekable = False
+    # sort the rows on these destination columns (comma separated, or CLUSTER
+    # for the primary key of the target table) before they are inserted, so
+    # the index entries are added in order. Tables without the columns are
+    # loaded unsorted
+    sort_key = None
+    # sort the whole file rather than each batch, in sorted runs of at most
+    # sort_memory bytes spilled to sort_dir (the default temp directory if
+    # None) and merged
+    sort_file = False
+    sort_memory = 512 * 1024 * 1024
+    sort_dir = None
+
+    # IngestLedger recording each load, if set it is used instead of counting
+    # the rows of the target table to find whether a file is loaded
+    ledger = None
+    # Heartbeat of the work queue job the files are ingested for, if set
+    # nothing is committed once its lease is lost
+    lease = None
 
     def __init__(self, filetype, datafile, hdu=None, order=None, dbh=None):
         self.objhdu = hdu
@@ -19,10 +77,11 @@ class Ingest(object):
             dbh = desdbi.DesDbi()
         else:
             self.dbh = dbh
-        self.cursor = self.dbh.cursor()
-        # get the table name that is being filled, based on the input data type
-        self.cursor.execute("select table_name from ops_datafile_table where filetype='%s'" % (filetype))
-        self.targettable = self.cursor.fetchall()[0][0]
+        # the precompiled plan for this filetype, which holds the table being
+        # filled and the columns it gets filled from
+        self.plan = IngestPlan.get(self.dbh, filetype, hdu, order)
+        self.targettable = self.plan.targettable
+        self.layout = None
         self.filetype = filetype
         self.idColumn = None
         self.order = order
@@ -30,12 +89,29 @@ class Ingest(object):
         self.constants = {}
         self.orderedColumns = []
         self.sqldata = []
+        self.rejects = []
+        # (rows of the file, rows in the table) committed by an earlier load to
+        # resume from, None until looked up
+        self.resume = None
+        # number of rows rejected by the part of the load committed before it
+        # was interrupted
+        self.rejectsBefore = 0
+        self.firstrow = 0
+        # number of rows inserted by executeIngest
+        self.inserted = 0
+        # ingests of other tables filled from the same pass over the data (e.g.
+        # CoordHealpix), their rows are committed or rolled back with these
+        self.companions = []
+        # whether the batches being inserted carry the number in the file of
+        # each row as an extra last value, once they are sorted
+        self.numbered = False
         self.fullfilename = datafile
         self.shortfilename = ingestutils.getShortFilename(datafile)
         self.status = 0
 
-        # dictionary of table columns in db
-        self.dbDict = self.getObjectColumns()
+        # dictionary of table columns in db, shared with the plan so must not
+        # be modified
+        self.dbDict = self.plan.dbDict
 
     def getstatus(self):
         return self.status
@@ -47,40 +123,6 @@ class Ingest(object):
     def info(self, msg):
         print time.strftime(self.debugDateFormat) + " - " + msg
 
-    def getObjectColumns(self):
-        """ Get the database columns that are being filled, and their data type
-
-        """
-        results = {}
-        sqlstr = "select hdu, UPPER(attribute_name), position, column_name, datafile_datatype from ops_datafile_metadata where filetype = '%s'" % (
-            self.filetype)
-        if self.order is not None:
-            sqlstr += " order by %s" % (self.order)
-        cursor = self.dbh.cursor()
-        cursor.execute(sqlstr)
-        records = cursor.fetchall()
-
-        for rec in records:
-            hdr = None
-            if rec[0] == None:
-                hdr = self.objhdu
-            elif rec[0].upper() == 'PRIMARY':
-                hdr = 0
-            else:
-                if ingestutils.isInteger(rec[0]):
-                    hdr = int(rec[0])
-                else:
-                    hdr = rec[0]
-            if hdr not in results:
-                results[hdr] = OrderedDict()
-            if rec[1] not in results[hdr]:
-                results[hdr][rec[1]] = Entry(hdu=hdr, attribute_name=rec[1],
-                                             position=rec[2], column_name=rec[3], dtype=rec[4])
-            else:
-                results[hdr][rec[1]].append(rec[3], rec[2])
-        cursor.close()
-        return results
-
     def getNumObjects(self):
         """ Get the number of items to be ingested, must be overloaded by child classes
 
@@ -94,10 +136,61 @@ class Ingest(object):
         """
         return None
 
+    def generateBatches(self):
+        """ Generator yielding the input data as lists of lists of bounded size, so
+            they can be inserted as they are produced. Child classes should overload
+            this, the default generates all of the rows at once with generateRows
+
+        """
+        if self.generateRows() == 1:
+            raise Exception("Could not generate rows from %s" % (self.shortfilename))
+        for batch in self.sqldataBatches():
+            yield batch
+
+    def sqldataBatches(self):
+        """ Generator yielding self.sqldata in chunks of at most self.batchsize rows
+
+        """
+        offset = 0
+        while offset < len(self.sqldata):
+            chunk = min(self.batchsize, len(self.sqldata) - offset)
+            yield self.sqldata[offset:offset + chunk]
+            offset += chunk
+
+    @classmethod
+    def prefetchIngested(cls, dbh, filetype, datafiles):
+        """ Get the number of entries already ingested from each of a list of
+            files of the given filetype, with one query for the whole list.
+            Returns a dictionary of the counts keyed by short filename.
+
+        """
+        targettable = IngestPlan.getTargetTable(dbh, filetype)
+        filenames = [ingestutils.getShortFilename(f) for f in datafiles]
+        if cls.ledger is not None:
+            entries = cls.ledger.lookupMany(dbh, filenames, targettable)
+            counts = dict((fname, 0) for fname in filenames)
+            for fname, entry in entries.iteritems():
+                counts[fname] = entry["NROWS"]
+                if entry["CHECKPOINT"] is not None:
+                    cls.partialLoads[(targettable, fname)] = entry
+        else:
+            counts = ingestutils.numIngested(dbh, targettable, filenames)
+        for fname, count in counts.iteritems():
+            cls.ingestedCounts[(targettable, fname)] = count
+        return counts
+
     def numAlreadyIngested(self):
         """ Determine the number of entries already ingested from the data source
 
         """
+        key = (self.targettable, self.shortfilename)
+        if key in self.ingestedCounts:
+            return self.ingestedCounts.pop(key)
+        if self.ledger is not None:
+            entry = self.ledger.lookup(self.dbh, self.shortfilename, self.targettable)
+            if entry is None:
+                return 0
+            return entry["NROWS"]
         num = 0
         while num < 5:
             num += 1
@@ -121,6 +214,12 @@ class Ingest(object):
         """
         loaded = False
 
+        self.resume = self.getCheckpoint()
+        if self.resume[0] > 0:
+            self.info("Resuming the load of %s after row %d, %d rows already in %s" %
+                      (self.shortfilename, self.resume[0], self.resume[1], self.targettable))
+            return loaded
+
         numDbObjects = self.numAlreadyIngested()
         numCatObjects = self.getNumObjects()
         if numDbObjects > 0:
@@ -129,6 +228,10 @@ class Ingest(object):
                 self.info("INFO: file " + self.fullfilename +
                           " already ingested with the same number of" +
                           " objects. Skipping.")
+            elif numDbObjects + self.numRejected() == numCatObjects:
+                self.info("INFO: file " + self.fullfilename + " already ingested, with " +
+                          str(numCatObjects - numDbObjects) + " of its " + str(numCatObjects) +
+                          " objects rejected. Skipping.")
             else:
                 miscutils.fwdebug_print("ERROR: file " + self.fullfilename +
                                         " already ingested, but the number of objects is" +
@@ -137,44 +240,313 @@ class Ingest(object):
 
         return loaded
 
+    def numRejected(self):
+        """ Get the number of rows of the file rejected by the load committed
+            earlier, from the ledger if there is one, else from the reject files
+            it wrote
+
+        """
+        if self.ledger is not None:
+            entry = self.ledger.lookup(self.dbh, self.shortfilename, self.targettable)
+            if entry is None or entry["NREJECTS"] is None:
+                return 0
+            return int(entry["NREJECTS"])
+        count = 0
+        filename = Ingest.rejectFile(self)
+        # the ranges of rows ingested in parallel each have their own file
+        for name in [filename] + glob.glob(filename[:-len('.rejects')] + '.*-*.rejects'):
+            if os.path.exists(name):
+                f = open(name, 'r')
+                try:
+                    # less the header line
+                    count += len(f.readlines()) - 1
+                finally:
+                    f.close()
+        return count
+
+    def canCheckpoint(self):
+        """ Whether the rows of a partial load can be skipped when resuming it
+
+        """
+        return True
+
+    def checkpointFile(self):
+        return os.path.join(self.checkpoint_dir, "%s.%s.checkpoint" % (self.shortfilename,
+                                                                      self.targettable))
+
+    def getCheckpoint(self):
+        """ Find whether an earlier checkpointed load of the file was interrupted.
+            Returns the number of rows of the file committed by it, and the
+            number of rows they put in the table (both 0 if there is nothing to
+            resume). The number of rows it rejected is set in rejectsBefore.
+
+        """
+        self.rejectsBefore = 0
+        if self.ledger is not None:
+            key = (self.targettable, self.shortfilename)
+            if key in self.partialLoads:
+                self.ingestedCounts.pop(key, None)
+                entry = self.partialLoads.pop(key)
+            elif key in self.ingestedCounts:
+                # prefetched, and not a partial load
+                return 0, 0
+            else:
+                entry = self.ledger.lookup(self.dbh, self.shortfilename, self.targettable)
+            if entry is None or entry["CHECKPOINT"] is None:
+                return 0, 0
+            self.rejectsBefore = int(entry["NREJECTS"] or 0)
+            return int(entry["CHECKPOINT"]), int(entry["NROWS"])
+
+        filename = self.checkpointFile()
+        if not os.path.exists(filename):
+            return 0, 0
+        # the file holds the last checkpoint committed, and the one being
+        # committed if the load stopped during a commit, the one matching the
+        # rows in the table is the one which was committed
+        f = open(filename, 'r')
+        try:
+            states = [tuple([int(v) for v in line.split()]) for line in f if line.strip()]
+        finally:
+            f.close()
+        count = self.numAlreadyIngested()
+        for state in states:
+            if state[1] == count:
+                # files written before the rejected rows were counted have
+                # none
+                if len(state) > 2:
+                    self.rejectsBefore = state[2]
+                return state[0], state[1]
+        raise Exception("%s has %d rows from %s, which matches no checkpoint in %s" %
+                        (self.targettable, count, self.shortfilename, filename))
+
+    def writeCheckpoint(self, states):
+        """ Write the checkpoint file, replacing it in one step
+
+        """
+        filename = self.checkpointFile()
+        f = open(filename + '.tmp', 'w')
+        try:
+            for offset, nrows, nrejects in states:
+                f.write("%d %d %d\n" % (offset, nrows, nrejects))
+        finally:
+            f.close()
+        os.rename(filename + '.tmp', filename)
+
+    def checkpoint(self, offset, nrows, nrejects, committed):
+        """ Commit the rows inserted so far, with the file loaded up to row offset,
+            nrows rows in the table and nrejects rows rejected. committed is the
+            previous checkpoint.
+
+        """
+        if self.ledger is not None:
+            # recorded in the same transaction as the data
+            self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                               nrows, pfw_attempt_id=getattr(self, 'pfw_attempt_id', None),
+                               checkpoint=offset, nrejects=nrejects)
+            self.commit()
+        else:
+            self.writeCheckpoint([committed, (offset, nrows, nrejects)])
+            self.commit()
+            self.writeCheckpoint([(offset, nrows, nrejects)])
+        if len(self.rejects) > 0:
+            # so that a resumed load still reports the rows rejected before
+            self.writeRejects()
+        self.info("Checkpoint: %d rows of %s committed" % (offset, self.shortfilename))
+
+    @staticmethod
+    def skipRows(batches, nrows):
+        """ Generator dropping the first nrows rows of the batches
+
+        """
+        for rows in batches:
+            if nrows >= len(rows):
+                nrows -= len(rows)
+                continue
+            if nrows > 0:
+                rows = rows[nrows:]
+                nrows = 0
+            yield rows
+
+    def getClusteringKey(self):
+        """ Get the columns of the primary key of the target table, in order
+
+        """
+        schema, table = ingestutils.resolveDbObject(self.targettable.upper(), self.dbh)
+        sqlstr = """select cc.column_name from all_constraints c, all_cons_columns cc
+                    where c.owner=:owner and c.table_name=:tab and c.constraint_type='P'
+                    and cc.owner=c.owner and cc.constraint_name=c.constraint_name
+                    order by cc.position"""
+        records = MetadataCache.fetch(self.dbh, ('Ingest.getClusteringKey', schema, table), sqlstr,
+                                      {'owner': schema, 'tab': table})
+        return [rec[0].upper() for rec in records]
+
+    def getSortPositions(self):
+        """ Get the positions in a row of the sort_key columns, or None if the
+            rows of this table are not sorted
+
+        """
+        if self.sort_key.upper() == 'CLUSTER':
+            keycols = self.getClusteringKey()
+        else:
+            keycols = [col.strip().upper() for col in self.sort_key.split(',')]
+        columns = [col.upper() for col in self.layout.columns]
+        missing = [col for col in keycols if col not in columns]
+        if len(keycols) == 0 or len(missing) > 0:
+            self.info("Not sorting the rows of %s, %s has no %s column" % (
+                self.shortfilename, self.targettable, ','.join(missing or ['key'])))
+            return None
+        return [columns.index(col) for col in keycols]
+
+    def numberRows(self, batches):
+        """ Generator appending to each row its number in the file
+
+        """
+        rownum = self.firstrow
+        for rows in batches:
+            yield [row + [rownum + i + 1] for i, row in enumerate(rows)]
+            rownum += len(rows)
+
+    def sortBatches(self, batches):
+        """ Generator sorting the rows on sort_key, within each batch or across
+            the whole file. The columns are only known once the first batch has
+            been generated.
+
+        """
+        batches = iter(batches)
+        first = next(batches, None)
+        if first is None:
+            return
+        batches = itertools.chain([first], batches)
+        positions = self.getSortPositions()
+        if positions is not None:
+            sorter = RowSorter(positions, self.sort_file, self.sort_memory, self.sort_dir,
+                               self.shortfilename)
+            batches = sorter.sort(batches)
+        for rows in batches:
+            yield rows
+
+    def getConstants(self):
+        """ Get the names of the constants, in the order they are bound after the
+            data columns, and their values
+
+        """
+        constnames = sorted(self.constants.keys())
+        return constnames, [self.constants[c] for c in constnames]
+
+    def getInsertStatement(self):
+        """ Build the insert statement, with bind variables for the data columns
+            followed by the constants
+
+        """
+        return self.layout.insertStatement(self.getConstants()[0])
+
+    def getCursor(self):
+        """ Get the cursor prepared with the insert statement, shared by all the
+            files inserting the same columns into the same table over this
+            connection
+
+        """
+        constnames = self.getConstants()[0]
+        return CursorCache.get(self.dbh, self.targettable, list(self.layout.columns) + constnames,
+                               self.getInsertStatement())
+
     def executeIngest(self):
         """ Generic method to insert the data into the database
 
         """
-        if self.generateRows() == 1:
-            return 1
-        for k, v in self.constants.iteritems():
-            if isinstance(v, str):
-                self.constants[k] = "'" + v + "'"
-            else:
-                self.constants[k] = str(v)
-        columns = []
-
-        for att in self.orderedColumns:
-            columns += self.dbDict[self.objhdu][att].column_name
-        places = []
-        for i in range(len(columns)):
-            places.append(":%d" % (i+1))
-
-        sqlstr = "insert into %s ( " % (self.targettable)
-        sqlstr += ', '.join(self.constants.keys() + columns)
-        sqlstr += ") values ("
-        sqlstr += ', '.join(self.constants.values() + places)
-        sqlstr += ")"
-        cursor = self.dbh.cursor()
-        cursor.prepare(sqlstr)
-        #print sqlstr
-        offset = 0
+        if self.resume is None:
+            self.resume = self.getCheckpoint()
+        interval = 0
+        # the rows of the companions are not inserted in step with the
+        # checkpoints, and sorted rows not in file order, so such loads are
+        # committed once
+        if (self.checkpoint_rows > 0 and self.canCheckpoint() and len(self.companions) == 0 and
+                self.sort_key is None):
+            interval = self.checkpoint_rows
+        elif self.resume[0] > 0 and not self.canCheckpoint():
+            raise Exception("Cannot resume the partial load of %s" % (self.shortfilename))
+        self.firstrow = self.resume[0]
+        if self.streaming:
+            batches = self.generateBatches()
+            if self.pipeline_depth > 0:
+                # read and convert the following batches in a separate thread
+                # while the current one is being inserted
+                batches = ingestutils.prefetch(batches, self.pipeline_depth)
+        else:
+            if self.generateRows() == 1:
+                return 1
+            batches = self.sqldataBatches()
+        if self.firstrow > 0 and not (self.streaming and self.seekable):
+            batches = self.skipRows(batches, self.firstrow)
+        if self.sort_key is not None:
+            # the rejected rows are reported by their number in the file, which
+            # their position no longer gives once sorted
+            self.numbered = self.batch_errors
+            if self.numbered:
+                batches = self.numberRows(batches)
+            batches = self.sortBatches(batches)
+        cursor = None
+        batcher = None
+        constnames, constvalues = self.getConstants()
+        numrows = 0
+        inserttime = 0.
+        start = time.time()
+        # (row number in the file, error message, row) of the rejected rows
+        self.rejects = []
+        # (rows of the file, rows in the table, rows rejected) of the last
+        # checkpoint
+        committed = self.resume + (self.rejectsBefore,)
         try:
-            #for dt in self.sqldata:
-            #    print dt
-            while offset < len(self.sqldata):
-                chunk = min(1000000, len(self.sqldata) - offset)
-                cursor.executemany(None, self.sqldata[offset:offset + chunk])
-                offset += chunk
-            cursor.close()
-            self.dbh.commit()
-            self.info("Inserted %d rows into table %s" % (len(self.sqldata), self.targettable))
+            # the insert statement can only be built once the first batch has
+            # been generated, as that determines the columns being loaded
+            for rows in batches:
+                if cursor is None:
+                    cursor = self.getCursor()
+                    sizes = self.layout.inputSizes(constvalues)
+                    batcher = AdaptiveBatcher(
+                        AdaptiveBatcher.estimateRowBytes(self.layout.datatypes, constvalues),
+                        self.targettable, self.batchsize)
+                # the generated batches are regrouped into batches of the size
+                # chosen by the batcher
+                batcher.add(rows)
+                for companion in self.companions:
+                    inserttime += companion.insertPending()
+                while batcher.ready():
+                    inserttime += self.insertBatch(cursor, sizes, constvalues, batcher.next(), batcher)
+                    if interval > 0 and batcher.total - (committed[0] - self.firstrow) >= interval:
+                        state = (self.firstrow + batcher.total,
+                                 self.resume[1] + batcher.total - len(self.rejects),
+                                 self.rejectsBefore + len(self.rejects))
+                        self.checkpoint(state[0], state[1], state[2], committed)
+                        committed = state
+            if batcher is not None:
+                rows = batcher.flush()
+                if len(rows) > 0:
+                    inserttime += self.insertBatch(cursor, sizes, constvalues, rows, batcher)
+                numrows = batcher.total - len(self.rejects)
+            for companion in self.companions:
+                inserttime += companion.finish()
+            self.inserted = numrows
+            if len(self.rejects) > 0:
+                self.writeRejects()
+                budget = self.errorBudget(batcher.total)
+                if len(self.rejects) > budget:
+                    raise Exception("%d rows rejected, more than the error budget of %d rows" %
+                                    (len(self.rejects), budget))
+                self.info("Committing %d rows, %d rows rejected (error budget %d rows)" %
+                          (numrows, len(self.rejects), budget))
+            if self.ledger is not None:
+                # recorded in the same transaction as the data
+                self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                                   self.resume[1] + numrows,
+                                   pfw_attempt_id=getattr(self, 'pfw_attempt_id', None),
+                                   fullfilename=self.fullfilename, seconds=time.time() - start,
+                                   nrejects=self.rejectsBefore + len(self.rejects))
+            self.commit()
+            if self.ledger is None and os.path.exists(self.checkpointFile()):
+                os.remove(self.checkpointFile())
+            self.info("Inserted %d rows into table %s in %.2f seconds (%.2f seconds inserting)" %
+                      (numrows, self.targettable, time.time() - start, inserttime))
             self.status = 0
         except:
             se = sys.exc_info()
@@ -189,39 +561,121 @@ class Ingest(object):
         finally:
             return self.status
 
-    def printinfo(self, msg):
-        """ Generic print statement with time stamp
+    def commit(self):
+        """ Commit the transaction, unless the lease of the work queue job was
+            lost, in which case it is rolled back
 
         """
-        print time.strftime(self.debugDateFormat) + " - " + msg
+        if self.lease is not None and self.lease.lost.is_set():
+            self.dbh.rollback()
+            self.lease.check()
+        self.dbh.commit()
 
+    def insertBatch(self, cursor, sizes, constvalues, rows, batcher):
+        """ Insert one batch of rows with the prepared cursor, reporting the time
+            it took to the batcher. Returns the time taken.
 
-class Entry(object):
-    __slots__ = ["hdu", "attribute_name", "position", "column_name", "dtype"]
+        """
+        rownums = None
+        if self.numbered:
+            rownums = [row[-1] for row in rows]
+            rows = [row[:-1] for row in rows]
+        if len(constvalues) > 0:
+            bindrows = [row + constvalues for row in rows]
+        else:
+            bindrows = rows
+        t0 = time.time()
+        if self.batch_errors:
+            for offset, message in self.insertRows(cursor, sizes, bindrows):
+                if rownums is not None:
+                    rownum = rownums[offset]
+                else:
+                    rownum = self.firstrow + batcher.total + offset + 1
+                self.rejects.append((rownum, message, rows[offset]))
+        else:
+            self.executeBatch(cursor, sizes, bindrows)
+        seconds = time.time() - t0
+        batcher.record(len(rows), seconds)
+        return seconds
+
+    def executeBatch(self, cursor, sizes, rows, **kwargs):
+        if sizes is not None:
+            cursor.setinputsizes(*sizes)
+        cursor.executemany(None, rows, **kwargs)
+
+    def insertRows(self, cursor, sizes, rows):
+        """ Insert a batch of rows, letting the database reject individual rows.
+            Oracle reports them with batcherrors, other backends are handled by
+            retrying the halves of a failed batch until the failing rows are
+            isolated, each attempt after a savepoint so a failed attempt leaves
+            nothing behind. Returns (offset in the batch, error message) of the
+            rejected rows.
 
-    def __init__(self, **kwargs):
-        """ Simple light weight class to hold entries from the ops_datafile_metadata
-            table
+        """
+        if hasattr(cursor, 'getbatcherrors'):
+            self.executeBatch(cursor, sizes, rows, batcherrors=True)
+            return [(err.offset, str(err.message).strip()) for err in cursor.getbatcherrors()]
+        rejects = []
+        pending = [(0, len(rows))]
+        # the prepared cursor must only run the insert
+        curs = self.dbh.cursor()
+        try:
+            while len(pending) > 0:
+                first, last = pending.pop(0)
+                curs.execute("savepoint ingest_batch")
+                try:
+                    self.executeBatch(cursor, sizes, rows[first:last])
+                except Exception, e:
+                    curs.execute("rollback to savepoint ingest_batch")
+                    if last - first == 1:
+                        rejects.append((first, str(e).strip()))
+                    else:
+                        middle = (first + last) // 2
+                        pending[0:0] = [(first, middle), (middle, last)]
+        finally:
+            curs.close()
+        return rejects
+
+    def errorBudget(self, numrows):
+        """ Get the number of rejected rows allowed out of numrows
 
         """
-        self.hdu = None
-        self.attribute_name = None
-        self.position = [0]
-        self.column_name = []
-        self.dtype = None
+        if self.error_budget < 1:
+            return int(self.error_budget * numrows)
+        return int(self.error_budget)
+
+    def rejectFile(self):
+        return os.path.join(self.reject_dir, self.shortfilename + '.rejects')
 
-        for item in ["column_name", "position"]:
-            if item in kwargs:
-                setattr(self, item, [kwargs[item]])
-                del kwargs[item]
-        for kw, arg in kwargs.iteritems():
-            setattr(self, kw, arg)
-        if len(self.position) != len(self.column_name):
-            raise Exception("BAD MATCH %d  %d" % (len(self.position), len(self.column_name)))
+    def writeRejects(self):
+        """ Write the rejected rows to <reject_dir>/<filename>.rejects: a header
+            line with the columns, then a tab separated line per row with its
+            number in the file, the error and the values. The rows rejected
+            before a resumed load was interrupted are kept.
 
-    def append(self, column_name, position):
-        """ Method to append data to specific elements of the class
+        """
+        filename = self.rejectFile()
+        before = []
+        if self.rejectsBefore > 0 and os.path.exists(filename):
+            f = open(filename, 'r')
+            try:
+                before = f.readlines()[1:self.rejectsBefore + 1]
+            finally:
+                f.close()
+        f = open(filename, 'w')
+        try:
+            f.write('\t'.join(['#ROW', 'ERROR'] + list(self.layout.columns)) + '\n')
+            f.writelines(before)
+            for rownum, message, row in self.rejects:
+                f.write('\t'.join([str(rownum), ' '.join(message.split())] +
+                                   [str(v) for v in row]) + '\n')
+        finally:
+            f.close()
+        self.info("Wrote %d rejected rows to %s" % (len(self.rejects), filename))
+
+    @classmethod
+    def printinfo(cls, msg):
+        """ Generic print statement with time stamp
 
         """
-        self.column_name.append(column_name)
-        self.position.append(position)
+        print time.strftime(cls.debugDateFormat) + " - " + msg
@@ -0,0 +1,150 @@
+import os
+import datetime
+import hashlib
+import sqlite3
+
+
+class IngestLedger(object):
+    """ Bookkeeping of the files which have been loaded into the database, one row
+        per file and target table. The ledger row is written in the same
+        transaction as the data, so it exists exactly when the load was committed,
+        and checking whether a file is loaded does not need to scan the (large)
+        target table. A file loaded with checkpoints has its entry updated at
+        every checkpoint, with CHECKPOINT holding the number of rows of the file
+        committed so far, until the load completes and CHECKPOINT is cleared.
+        NREJECTS is the number of rows of the file rejected by the database
+        (see Ingest.batch_errors), which are not in NROWS. A ledger made before
+        it was added needs "alter table <ledger> add (NREJECTS NUMBER(12))".
+
+        The statements only use named binds, so the ledger works the same on an
+        Oracle connection and on a local sqlite3 connection (see sqlite()).
+
+    """
+    columns = ["FILENAME", "FILETYPE", "TARGETTABLE", "NROWS", "REQNUM", "PFW_ATTEMPT_ID",
+               "CHECKSUM", "LOAD_SECONDS", "INGEST_DATE", "CHECKPOINT", "NREJECTS"]
+
+    createStatement = '''
+        create table %s (
+            FILENAME VARCHAR2(200) not null,
+            FILETYPE VARCHAR2(50),
+            TARGETTABLE VARCHAR2(100) not null,
+            NROWS NUMBER(12),
+            REQNUM NUMBER(10),
+            PFW_ATTEMPT_ID NUMBER(22),
+            CHECKSUM VARCHAR2(32),
+            LOAD_SECONDS BINARY_FLOAT,
+            INGEST_DATE DATE,
+            CHECKPOINT NUMBER(12),
+            NREJECTS NUMBER(12),
+            primary key (FILENAME, TARGETTABLE)
+        ) '''
+
+    def __init__(self, table='INGEST_LEDGER', checksum=True):
+        """ table is the name of the ledger table, and checksum whether the md5sum
+            of each file is computed and recorded
+
+        """
+        self.table = table
+        self.checksum = checksum
+
+    @classmethod
+    def sqlite(cls, filename, table='INGEST_LEDGER', checksum=True):
+        """ Open (creating if needed) a local sqlite database holding a ledger
+            table. Returns the ledger and the sqlite3 connection to use with it.
+
+        """
+        dbh = sqlite3.connect(filename)
+        ledger = cls(table, checksum)
+        cursor = dbh.cursor()
+        cursor.execute("select count(*) from sqlite_master where type='table' and name=:tab",
+                       {'tab': table})
+        if cursor.fetchone()[0] == 0:
+            ledger.create(dbh)
+        cursor.close()
+        return ledger, dbh
+
+    def create(self, dbh):
+        """ Create the ledger table
+
+        """
+        cursor = dbh.cursor()
+        cursor.execute(self.createStatement % self.table)
+        cursor.close()
+        dbh.commit()
+
+    @staticmethod
+    def md5sum(filename, blocksize=8388608):
+        """ Compute the md5 checksum of a file, reading it in blocks
+
+        """
+        md5 = hashlib.md5()
+        f = open(filename, 'rb')
+        try:
+            block = f.read(blocksize)
+            while block:
+                md5.update(block)
+                block = f.read(blocksize)
+        finally:
+            f.close()
+        return md5.hexdigest()
+
+    def lookup(self, dbh, filename, targettable):
+        """ Get the ledger entry for a file as a dictionary, or None if the file
+            has not been loaded into targettable
+
+        """
+        entries = self.lookupMany(dbh, [filename], targettable)
+        return entries.get(filename)
+
+    def lookupMany(self, dbh, filenames, targettable, chunksize=1000):
+        """ Get the ledger entries of many files, as a dictionary keyed by filename
+            holding only the files which have been loaded
+
+        """
+        entries = {}
+        filenames = list(filenames)
+        cursor = dbh.cursor()
+        for start in range(0, len(filenames), chunksize):
+            binds = {'tab': targettable.upper()}
+            for i, fname in enumerate(filenames[start:start + chunksize]):
+                binds['f%d' % i] = fname
+            sqlstr = "select %s from %s where targettable=:tab and filename in (%s)" % (
+                ', '.join(self.columns), self.table,
+                ', '.join([':f%d' % i for i in range(len(binds) - 1)]))
+            cursor.execute(sqlstr, binds)
+            for rec in cursor.fetchall():
+                entries[rec[0]] = dict(zip(self.columns, rec))
+        cursor.close()
+        return entries
+
+    def record(self, dbh, filename, filetype, targettable, nrows, reqnum=None,
+               pfw_attempt_id=None, fullfilename=None, seconds=None, checkpoint=None, nrejects=None):
+        """ Record a load of a file, replacing any earlier entry. The caller is
+            responsible for the commit, which should be the one that commits the
+            data. checkpoint is set for a partial load, to the number of rows of
+            the file committed, and nrejects to the number of rows rejected.
+
+        """
+        checksum = None
+        if self.checksum and fullfilename is not None and os.path.exists(fullfilename):
+            checksum = self.md5sum(fullfilename)
+        self.remove(dbh, filename, targettable)
+        values = {"FILENAME": filename, "FILETYPE": filetype, "TARGETTABLE": targettable.upper(),
+                  "NROWS": nrows, "REQNUM": reqnum, "PFW_ATTEMPT_ID": pfw_attempt_id,
+                  "CHECKSUM": checksum, "LOAD_SECONDS": seconds,
+                  "INGEST_DATE": datetime.datetime.now().replace(microsecond=0),
+                  "CHECKPOINT": checkpoint, "NREJECTS": nrejects}
+        sqlstr = "insert into %s (%s) values (%s)" % (
+            self.table, ', '.join(self.columns), ', '.join([':' + c for c in self.columns]))
+        cursor = dbh.cursor()
+        cursor.execute(sqlstr, values)
+        cursor.close()
+
+    def remove(self, dbh, filename, targettable):
+        """ Remove the entry of a file, e.g. when its data are cleaned up
+
+        """
+        cursor = dbh.cursor()
+        cursor.execute("delete from %s where filename=:fname and targettable=:tab" % self.table,
+                       {'fname': filename, 'tab': targettable.upper()})
+        cursor.close()
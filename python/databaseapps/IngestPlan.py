@@ -0,0 +1,270 @@
+from collections import OrderedDict
+from ingestutils import IngestUtils as ingestutils
+from MetadataCache import MetadataCache
+try:
+    import cx_Oracle
+except ImportError:
+    # without the driver no input sizes are declared, and the types are
+    # guessed from the data
+    cx_Oracle = None
+
+
+class IngestPlan(object):
+    """ Precompiled description of how the data of a filetype are ingested, built
+        once from ops_datafile_table and ops_datafile_metadata and shared by every
+        file of that filetype in the process. Plans must be treated as read only.
+
+    """
+    # cache of plans, keyed by (filetype, hdu, order)
+    plans = {}
+
+    def __init__(self, filetype, hdu, targettable, dbDict):
+        self.filetype = filetype
+        self.hdu = hdu
+        self.targettable = targettable
+        self.dbDict = dbDict
+
+        entries = dbDict.get(hdu, OrderedDict())
+        # attributes of the data hdu, in metadata order
+        self.attributes = tuple(entries.keys())
+        # the function used to cast each attribute from text
+        self.converters = tuple([self.getConverter(entry.dtype) for entry in entries.values()])
+        # layouts for each set of source columns seen so far
+        self.layouts = {}
+
+    @classmethod
+    def get(cls, dbh, filetype, hdu, order=None):
+        """ Get the plan for the given filetype and hdu, building it on first use
+
+        """
+        key = (filetype, hdu, order)
+        if key not in cls.plans:
+            cls.plans[key] = cls.build(dbh, filetype, hdu, order)
+        return cls.plans[key]
+
+    @classmethod
+    def build(cls, dbh, filetype, hdu, order=None):
+        """ Get the target table and the columns being filled, from the metadata
+            cache or the database
+
+        """
+        targettable = cls.getTargetTable(dbh, filetype)
+
+        sqlstr = "select hdu, UPPER(attribute_name), position, column_name, datafile_datatype from ops_datafile_metadata where filetype = '%s'" % (
+            filetype)
+        records = MetadataCache.fetch(dbh, ('ops_datafile_metadata', filetype), sqlstr)
+        if order is not None:
+            records = cls.sortRecords(records, order)
+        return cls(filetype, hdu, targettable, cls.buildEntries(records, hdu))
+
+    @staticmethod
+    def getTargetTable(dbh, filetype):
+        """ Get the table name that is being filled, based on the input data type
+
+        """
+        records = MetadataCache.fetch(
+            dbh, ('ops_datafile_table', filetype),
+            "select table_name from ops_datafile_table where filetype='%s'" % (filetype))
+        return records[0][0]
+
+    @staticmethod
+    def sortRecords(records, order):
+        """ Sort metadata records as an sql "order by" of the given comma
+            separated column numbers would, with nulls last
+
+        """
+        idx = [int(col) - 1 for col in order.split(',')]
+
+        def key(rec):
+            return [(rec[i] is None, rec[i]) for i in idx]
+        return sorted(records, key=key)
+
+    @staticmethod
+    def buildEntries(records, objhdu):
+        """ Convert ops_datafile_metadata records into a dictionary, keyed by hdu,
+            of ordered dictionaries of Entry objects keyed by attribute name
+
+        """
+        results = {}
+        for rec in records:
+            hdr = None
+            if rec[0] == None:
+                hdr = objhdu
+            elif rec[0].upper() == 'PRIMARY':
+                hdr = 0
+            else:
+                if ingestutils.isInteger(rec[0]):
+                    hdr = int(rec[0])
+                else:
+                    hdr = rec[0]
+            if hdr not in results:
+                results[hdr] = OrderedDict()
+            if rec[1] not in results[hdr]:
+                results[hdr][rec[1]] = Entry(hdu=hdr, attribute_name=rec[1],
+                                             position=rec[2], column_name=rec[3], dtype=rec[4])
+            else:
+                results[hdr][rec[1]].append(rec[3], rec[2])
+        return results
+
+    @staticmethod
+    def getConverter(dtype):
+        """ Get the function used to cast a value of the given metadata datatype
+            from text
+
+        """
+        if dtype is not None and dtype.upper() == "INT":
+            return int
+        elif dtype is not None and dtype.upper() == "FLOAT":
+            return float
+        return str
+
+    def getLayout(self, filecolumns=None, generateID=False):
+        """ Get the layout for a file with the given columns (all attributes of the
+            plan if None). Layouts are cached, so every file with the same columns
+            shares one.
+
+        """
+        if filecolumns is None:
+            filecolumns = self.attributes
+        key = (tuple(filecolumns), generateID)
+        if key not in self.layouts:
+            self.layouts[key] = IngestLayout(self, filecolumns, generateID)
+        return self.layouts[key]
+
+
+class IngestLayout(object):
+    """ The part of an ingest plan which depends on the columns found in the file:
+        the ordered source columns, the attributes and destination columns they
+        fill, and the text of the insert statement
+
+    """
+    # bind type for each metadata datatype of the data columns, others are
+    # left for the driver to determine
+    if cx_Oracle is not None:
+        bindTypes = {'INT': cx_Oracle.NUMBER, 'FLOAT': cx_Oracle.NATIVE_FLOAT,
+                     'DOUBLE': cx_Oracle.NATIVE_FLOAT}
+    else:
+        bindTypes = {}
+
+    def __init__(self, plan, filecolumns, generateID=False):
+        entries = plan.dbDict.get(plan.hdu, OrderedDict())
+        self.targettable = plan.targettable
+
+        # trim down the columns to those that are actually being ingested
+        sourceColumns = []
+        for col in filecolumns:
+            # need NUMBER to look up COADD_OBJECT_ID
+            if col.upper() in entries or col.upper() == "NUMBER":
+                sourceColumns.append(col)
+        self.sourceColumns = tuple(sourceColumns)
+
+        attributes = list(self.sourceColumns)
+        columns = []
+        datatypes = []
+        if generateID:
+            attributes.insert(0, 'ID')
+            columns.append('ID')
+            datatypes.append('int')
+        self.arrayPositions = {}
+        for att in self.sourceColumns:
+            entry = entries[att.upper()]
+            columns += entry.column_name
+            datatypes += [entry.dtype] * len(entry.column_name)
+            if len(entry.column_name) > 1:
+                self.arrayPositions[att] = tuple(entry.position)
+        self.attributes = tuple(attributes)
+        self.columns = tuple(columns)
+        # metadata datatype of each destination column
+        self.datatypes = tuple(datatypes)
+        # insert statements, keyed by the names of the constants
+        self.statements = {}
+
+    def insertStatement(self, constnames):
+        """ Get the insert statement, with bind variables for the data columns
+            followed by one for each of the constants. The text only depends on
+            the names of the constants, so every file with the same columns
+            shares one statement.
+
+        """
+        constnames = tuple(constnames)
+        if constnames not in self.statements:
+            columns = list(self.columns) + list(constnames)
+            places = [":%d" % (i+1) for i in range(len(columns))]
+            sqlstr = "insert into %s ( " % (self.targettable)
+            sqlstr += ', '.join(columns)
+            sqlstr += ") values ("
+            sqlstr += ', '.join(places)
+            sqlstr += ")"
+            self.statements[constnames] = sqlstr
+        return self.statements[constnames]
+
+    def inputSizes(self, constvalues):
+        """ Get the types of the bind variables of the insert statement, to pass
+            to setinputsizes: from the metadata datatype of the data columns, and
+            from the values of the constants. Returns None if the driver is not
+            available.
+
+        """
+        if cx_Oracle is None:
+            return None
+        sizes = []
+        for dtype in self.datatypes:
+            if dtype is None:
+                sizes.append(None)
+            else:
+                sizes.append(self.bindTypes.get(dtype.upper()))
+        for value in constvalues:
+            if isinstance(value, basestring):
+                sizes.append(max(len(value), 1))
+            elif isinstance(value, (int, long)):
+                sizes.append(cx_Oracle.NUMBER)
+            elif isinstance(value, float):
+                sizes.append(cx_Oracle.NATIVE_FLOAT)
+            else:
+                sizes.append(None)
+        return sizes
+
+    def checkArrays(self, datatypes):
+        """ Make sure the array columns of the file have as many elements as there
+            are destination columns in the metadata
+
+        """
+        for att, positions in self.arrayPositions.items():
+            shape = datatypes[att].shape
+            size = 1
+            for dim in shape:
+                size *= dim
+            if size != len(positions):
+                raise Exception("Column %s has %d elements, but %d are listed in ops_datafile_metadata" %
+                                (att, size, len(positions)))
+
+
+class Entry(object):
+    __slots__ = ["hdu", "attribute_name", "position", "column_name", "dtype"]
+
+    def __init__(self, **kwargs):
+        """ Simple light weight class to hold entries from the ops_datafile_metadata
+            table
+
+        """
+        self.hdu = None
+        self.attribute_name = None
+        self.position = [0]
+        self.column_name = []
+        self.dtype = None
+
+        for item in ["column_name", "position"]:
+            if item in kwargs:
+                setattr(self, item, [kwargs[item]])
+                del kwargs[item]
+        for kw, arg in kwargs.iteritems():
+            setattr(self, kw, arg)
+        if len(self.position) != len(self.column_name):
+            raise Exception("BAD MATCH %d  %d" % (len(self.position), len(self.column_name)))
+
+    def append(self, column_name, position):
+        """ Method to append data to specific elements of the class
+
+        """
+        self.column_name.append(column_name)
+        self.position.append(position)
@@ -1,5 +1,8 @@
 from Ingest import Ingest
+from CsvReader import CsvReader
+from RowBuilder import RowBuilder
 import sys
+import numpy
 import traceback
 from despymisc import miscutils
 
@@ -8,12 +11,15 @@ class Mangle(Ingest):
     """ Class to ingest the outputs from a Mangle run
 
     """
+    # maximum number of lines to parse before handing the rows off for insertion
+    csv_chunk = 100000
 
     def __init__(self, datafile, filetype, idDict, dbh, replacecol=None, checkcount=False, skipmissing=False):
         Ingest.__init__(self, filetype, datafile, "CSV", '3', dbh)
         self.hdu = "CSV"
         self.idDict = idDict
         self.coadd_id = None
+        self.skip = 0
         self.constants = {"FILENAME": self.shortfilename}
         self.replacecol = replacecol
         self.checkcount = checkcount
@@ -22,47 +28,20 @@ class Mangle(Ingest):
         if "COADD_OBJECT_ID" in self.dbDict[self.hdu].keys():
             self.coadd_id = self.dbDict[self.hdu]["COADD_OBJECT_ID"].position[0]
 
-    def parseCSV(self, filename, types):
-        """ Parse a CSV file, casting as needed into a list of lists
+    def iterCSV(self, filename, types):
+        """ Parse a CSV file into typed columns, yielding lists of lists of at most
+            csv_chunk rows
 
         """
-        linecount = 0
+        reader = CsvReader(filename, types, self.csv_chunk)
         try:
-            f = open(filename, 'r')
-            lines = f.readlines()
-            skip = 0
-            for line in lines:
-                drop = False
-                linecount += 1
-                tdata = line.split(",")
-                if len(tdata) != len(types):
-                    raise Exception("Incorrect number of columns.")
-                # cast the data appropriately
-                for i, d in enumerate(tdata):
-                    if self.coadd_id is not None and i == self.coadd_id:
-                        try:
-                            tdata[i] = self.idDict[types[i](d)]
-                        except KeyError, ke:
-                            se = sys.exc_info()
-                            e = se[0]
-                            if self.skipmissing:
-                                skip += 1
-                                drop = True
-                            else:
-                                raise
-                    else:
-                        tdata[i] = types[i](d)
-                if self.replacecol is not None and tdata[self.replacecol] == -1:
-                    tdata[self.replacecol] = None
-                if not drop:
-                    self.sqldata.append(tdata)
-            if miscutils.fwdebug_check(10, "MANGLEINGEST_DEBUG"):
-                miscutils.fwdebug_print(self.shortfilename)
-                for d in self.sqldata:
-                    miscutils.fwdebug_print(d)
-            f.close()
-            if skip > 0:
-                print "Skipped %i items which were not found in the alternate table." % skip
+            self.skip = 0
+            for columns in reader:
+                rows = self.remapIDs(columns, reader.linecount - len(columns[0]))
+                self.debugRows(rows)
+                yield rows
+            if self.skip > 0:
+                print "Skipped %i items which were not found in the alternate table." % self.skip
         except:
             se = sys.exc_info()
             e = se[0]
@@ -71,29 +50,85 @@ class Mangle(Ingest):
             print "Traceback: "
             traceback.print_tb(tb)
 
-            miscutils.fwdebug_print("Error in line %i of %s" % (linecount, self.shortfilename))
+            miscutils.fwdebug_print("Error after line %i of %s" % (reader.linecount, self.shortfilename))
             raise
 
+    def remapIDs(self, columns, linecount):
+        """ Replace the object numbers in the COADD_OBJECT_ID column of a chunk of
+            columns with their ids, dropping rows without an id if skipmissing is
+            set, and apply the replacecol rule. Returns the list of rows.
+
+        """
+        if self.coadd_id is not None:
+            ids, missing = self.idDict.lookup(columns[self.coadd_id])
+            if missing.any():
+                if not self.skipmissing:
+                    i = numpy.nonzero(missing)[0][0]
+                    miscutils.fwdebug_print("Error in line %i of %s" % (linecount + i + 1, self.shortfilename))
+                    raise KeyError(columns[self.coadd_id][i])
+                self.skip += int(missing.sum())
+                keep = ~missing
+                columns = [col[keep] for col in columns]
+                ids = ids[keep]
+            columns[self.coadd_id] = ids
+        if self.replacecol is not None:
+            col = columns[self.replacecol]
+            nulls = numpy.nonzero(col == -1)[0]
+            if len(nulls) > 0:
+                col = col.tolist()
+                for i in nulls:
+                    col[i] = None
+                columns[self.replacecol] = col
+        return RowBuilder.toRows(columns)
+
+    def debugRows(self, rows):
+        """ Print the parsed rows when MANGLEINGEST_DEBUG is set
+
+        """
+        if miscutils.fwdebug_check(10, "MANGLEINGEST_DEBUG"):
+            miscutils.fwdebug_print(self.shortfilename)
+            for d in rows:
+                miscutils.fwdebug_print(d)
+
+    def parseCSV(self, filename, types):
+        """ Parse a CSV file, casting as needed into a list of lists
+
+        """
+        for rows in self.iterCSV(filename, types):
+            self.sqldata.extend(rows)
+
+    def setColumns(self):
+        """ Set the layout of the insert, all attributes are in the file
+
+        """
+        self.layout = self.plan.getLayout()
+        self.orderedColumns = list(self.layout.attributes)
+
+    def generateBatches(self):
+        """ Method to convert the input data into lists of lists, yielding one
+            list per chunk of the file
+
+        """
+        self.setColumns()
+        count = 0
+        for rows in self.iterCSV(self.fullfilename, self.plan.converters):
+            count += len(rows)
+            yield rows
+        if self.checkcount and len(self.idDict) != count:
+            raise Exception("Incorrect number of rows in %s. Count is %i, should be %i" % (
+                self.shortfilename, count, len(self.idDict)))
+
     def generateRows(self):
         """ Method to convert the input data into a list of lists
 
         """
         try:
-            types = []
-            # create a list of objects used to cast the data
-            for item in self.dbDict[self.hdu].values():
-                if item.dtype.upper() == "INT":
-                    types.append(int)
-                elif item.dtype.upper() == "FLOAT":
-                    types.append(float)
-                else:
-                    types.append(str)
-            self.parseCSV(self.fullfilename, types)
-            self.orderedColumns = self.dbDict[self.hdu].keys()
-            if self.checkcount and len(self.idDict.keys()) != len(self.sqldata):
+            self.parseCSV(self.fullfilename, self.plan.converters)
+            self.setColumns()
+            if self.checkcount and len(self.idDict) != len(self.sqldata):
                 self.status = 1
                 miscutils.fwdebug_print("Incorrect number of rows in %s. Count is %i, should be %i" % (
-                    self.shortfilename, len(self.sqldata), len(self.idDict.keys())))
+                    self.shortfilename, len(self.sqldata), len(self.idDict)))
                 return 1
             return 0
         except:
@@ -111,9 +146,4 @@ class Mangle(Ingest):
         """ Get the number of objects to ingest
 
         """
-        count = 0
-        f = open(self.fullfilename, 'r')
-        lines = f.readlines()
-        count += len(lines)
-        f.close()
-        return count
+        return CsvReader.countLines(self.fullfilename)
@@ -0,0 +1,189 @@
+import os
+import time
+import fcntl
+import cPickle
+import weakref
+
+
+class MetadataCache(object):
+    """ Process wide cache of the results of metadata queries (ops_datafile_table,
+        ops_datafile_metadata, dictionary view lookups), so that each is run at most
+        once per process. The results can also be persisted to a local file, so
+        that runs of many tiles in parallel do not all query the dictionary views.
+
+        Entries are keyed by a tuple naming the query and its parameters, plus the
+        schema and database of the connection. Entries read from the file are used
+        for ttl seconds after they were queried. Processes sharing the file merge
+        their entries into it under a lock, so none loses those of the others.
+
+    """
+    # in memory results, keyed by (schema, key) with values of (time, records)
+    memory = {}
+    # schema of each connection, keyed by the db handle, whose entry goes
+    # when the handle is released
+    schemas = weakref.WeakKeyDictionary()
+    # file to persist the cache to, None to keep it in memory only
+    cachefile = None
+    ttl = 86400
+    loaded = False
+
+    @classmethod
+    def configure(cls, cachefile=None, ttl=None):
+        """ Set the file used to persist the cache, and the time to live (in
+            seconds) of its entries
+
+        """
+        cls.cachefile = cachefile
+        if ttl is not None:
+            cls.ttl = ttl
+        cls.loaded = False
+
+    @classmethod
+    def getSchema(cls, dbh):
+        """ Get the current schema and database name of a connection, which is
+            part of every cache key
+
+        """
+        if dbh not in cls.schemas:
+            cursor = dbh.cursor()
+            cursor.execute("select sys_context('USERENV','CURRENT_SCHEMA') || '@' || sys_context('USERENV','DB_NAME') from dual")
+            cls.schemas[dbh] = cursor.fetchone()[0]
+            cursor.close()
+        return cls.schemas[dbh]
+
+    @classmethod
+    def load(cls):
+        """ Read the unexpired entries of the cache file into memory
+
+        """
+        cls.loaded = True
+        if cls.cachefile is None:
+            return
+        now = time.time()
+        for key, (stamp, records) in cls.readFile().iteritems():
+            if now - stamp < cls.ttl and key not in cls.memory:
+                cls.memory[key] = (stamp, records)
+
+    @classmethod
+    def readFile(cls):
+        """ Read all the entries of the cache file
+
+        """
+        if not os.path.exists(cls.cachefile):
+            return {}
+        try:
+            f = open(cls.cachefile, 'rb')
+            try:
+                return cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            # an unreadable cache is the same as an empty one
+            return {}
+
+    @classmethod
+    def save(cls, entries):
+        """ Merge new entries into the cache file. The file is read again and
+            rewritten while holding a lock, so that entries written by other
+            processes since it was loaded are kept, and replaced atomically so
+            that readers (which do not lock) always see a complete file.
+
+        """
+        if cls.cachefile is None:
+            return
+        lock = open(cls.cachefile + ".lock", 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time()
+            merged = dict([(key, entry) for key, entry in cls.readFile().iteritems()
+                           if now - entry[0] < cls.ttl])
+            merged.update(entries)
+            tmpfile = "%s.%d.tmp" % (cls.cachefile, os.getpid())
+            f = open(tmpfile, 'wb')
+            try:
+                cPickle.dump(merged, f, 2)
+            finally:
+                f.close()
+            os.rename(tmpfile, cls.cachefile)
+        finally:
+            # closing the file releases the lock
+            lock.close()
+
+    @classmethod
+    def lookup(cls, dbh, key):
+        """ Get the cached records for key, or None if they are not cached
+
+        """
+        if not cls.loaded:
+            cls.load()
+        entry = cls.memory.get((cls.getSchema(dbh), key))
+        if entry is None:
+            return None
+        return entry[1]
+
+    @classmethod
+    def store(cls, dbh, entries):
+        """ Add a dictionary of key: records to the cache, and persist it
+
+        """
+        now = time.time()
+        schema = cls.getSchema(dbh)
+        added = {}
+        for key, records in entries.iteritems():
+            added[(schema, key)] = (now, records)
+        cls.memory.update(added)
+        cls.save(added)
+
+    @classmethod
+    def fetch(cls, dbh, key, sqlstr, params=None):
+        """ Get the records of a metadata query, running it only if they are not
+            already cached
+
+        """
+        records = cls.lookup(dbh, key)
+        if records is None:
+            cursor = dbh.cursor()
+            if params is None:
+                cursor.execute(sqlstr)
+            else:
+                cursor.execute(sqlstr, params)
+            records = cursor.fetchall()
+            cursor.close()
+            cls.store(dbh, {key: records})
+        return records
+
+    @classmethod
+    def prefetch(cls, dbh, filetypes):
+        """ Get the target tables and ops_datafile_metadata of all the given
+            filetypes with one query, and cache them under the keys used by
+            IngestPlan
+
+        """
+        filetypes = [ft for ft in set(filetypes)
+                     if cls.lookup(dbh, ('ops_datafile_metadata', ft)) is None]
+        if len(filetypes) == 0:
+            return
+        binds = {}
+        for i, ft in enumerate(filetypes):
+            binds['ft%d' % i] = ft
+        sqlstr = '''
+            select t.filetype, t.table_name, m.hdu, UPPER(m.attribute_name), m.position,
+                m.column_name, m.datafile_datatype
+            from ops_datafile_table t, ops_datafile_metadata m
+            where m.filetype (+)= t.filetype
+                and t.filetype in (%s) ''' % (', '.join([':' + b for b in sorted(binds.keys())]))
+        cursor = dbh.cursor()
+        cursor.execute(sqlstr, binds)
+        records = cursor.fetchall()
+        cursor.close()
+
+        entries = {}
+        for rec in records:
+            tablekey = ('ops_datafile_table', rec[0])
+            metakey = ('ops_datafile_metadata', rec[0])
+            if tablekey not in entries:
+                entries[tablekey] = [(rec[1],)]
+                entries[metakey] = []
+            if rec[3] is not None:
+                entries[metakey].append(tuple(rec[2:]))
+        cls.store(dbh, entries)
@@ -0,0 +1,102 @@
+import os
+import time
+from multiprocessing.queues import SimpleQueue
+
+
+class PoolTasks(object):
+    """ Tasks run by a multiprocessing pool, polled rather than waited for. A
+        pool replaces a worker process which dies (e.g. killed by the OOM killer
+        or a signal), but the result of the task it was running never comes, so
+        a blocking get() on it would hang. Each task reports the process it
+        runs in when it starts, and a task whose process is gone is returned
+        as lost.
+
+        The queue of the reports must be made (with open()) before the pool is
+        created, so the workers get it, and every task must call started(key)
+        first thing.
+
+    """
+    # seconds to wait for a result before checking the workers again
+    poll = 0.2
+    # queue of the (key, pid) of the tasks started by the workers
+    queue = None
+
+    def __init__(self, pool):
+        self.pool = pool
+        # AsyncResult of each task not yet returned, by key
+        self.pending = {}
+        # process running each of the pending tasks, once it has started
+        self.running = {}
+        # number of tasks whose worker process died
+        self.lost = 0
+
+    @classmethod
+    def open(cls):
+        cls.queue = SimpleQueue()
+
+    @classmethod
+    def close(cls):
+        cls.queue = None
+
+    @classmethod
+    def started(cls, key):
+        """ Report, from a worker, that the task key is running in this process
+
+        """
+        if cls.queue is not None:
+            cls.queue.put((key, os.getpid()))
+
+    @staticmethod
+    def isAlive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, key, func, args):
+        self.pending[key] = self.pool.apply_async(func, args)
+
+    def wait(self):
+        """ Wait for at least one task to end, returning the (key, result) of
+            those which did, the result being None for a task whose worker
+            process died
+
+        """
+        while len(self.pending) > 0:
+            while not self.queue.empty():
+                key, pid = self.queue.get()
+                self.running[key] = pid
+            done = []
+            for key, res in self.pending.items():
+                if res.ready():
+                    done.append((key, res.get()))
+                elif key in self.running and not self.isAlive(self.running[key]):
+                    # the result may have been sent just before the process ended
+                    if res.ready():
+                        done.append((key, res.get()))
+                    else:
+                        done.append((key, None))
+                        self.lost += 1
+            if len(done) > 0:
+                for key, result in done:
+                    del self.pending[key]
+                    self.running.pop(key, None)
+                return done
+            time.sleep(self.poll)
+        return []
+
+    def shutdown(self):
+        """ Close the pool and wait for its workers to exit. The pool is
+            terminated if a task was lost, as closing it would wait for the
+            result of every task.
+
+        """
+        if self.lost > 0:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
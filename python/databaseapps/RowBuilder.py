@@ -0,0 +1,65 @@
+import numpy
+
+
+class RowBuilder(object):
+    """ Class to convert a chunk of FITS table data into columns of bind
+        values using whole-array numpy operations, rather than looping over
+        every row and cell in python
+
+    """
+    SCALAR = 0
+    STRING = 1
+    ARRAY = 2
+
+    def __init__(self, columns, datatypes):
+        """ columns is the ordered list of FITS columns being ingested and
+            datatypes is the record dtype of the FITS table
+
+        """
+        self.columns = list(columns)
+        self.kinds = []
+        for col in self.columns:
+            dtype = datatypes[col]
+            if dtype.subdtype:
+                self.kinds.append(self.ARRAY)
+            elif dtype.kind == 'S':
+                self.kinds.append(self.STRING)
+            else:
+                self.kinds.append(self.SCALAR)
+
+    def columnize(self, data, skip=None):
+        """ Convert a chunk of FITS data into a list of 1-d arrays, one per bind
+            position. Array columns (e.g. FLUX_APER) are flattened into one
+            array per element, string columns are stripped in bulk. Columns
+            named in skip are returned as None, so the caller can fill them in.
+
+        """
+        bindcols = []
+        for col, kind in zip(self.columns, self.kinds):
+            if skip is not None and col in skip:
+                bindcols.append(None)
+                continue
+            values = data[col]
+            if kind == self.ARRAY:
+                values = values.reshape(len(values), -1)
+                for pos in range(values.shape[1]):
+                    bindcols.append(values[:, pos])
+            elif kind == self.STRING:
+                bindcols.append(numpy.char.strip(values))
+            else:
+                bindcols.append(values)
+        return bindcols
+
+    @staticmethod
+    def toRows(bindcols):
+        """ Transpose a list of bind columns into a list of rows, each holding
+            native python values as expected by executemany
+
+        """
+        cols = []
+        for col in bindcols:
+            if hasattr(col, 'tolist'):
+                cols.append(col.tolist())
+            else:
+                cols.append(col)
+        return map(list, zip(*cols))
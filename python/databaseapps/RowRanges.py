@@ -0,0 +1,96 @@
+import sys
+import traceback
+import multiprocessing
+from PoolTasks import PoolTasks
+
+# object whose row ranges are ingested by the worker processes, set before
+# they are forked so that the workers get a copy of it
+current = None
+
+
+def openWorker():
+    """ Let the worker process open its own database connection and file
+        handle, those of the parent cannot be shared between processes
+
+    """
+    current.connectWorker()
+
+
+def runRange(firstrow, lastrow):
+    """ Ingest a range of rows of the current object in a worker process.
+        Returns the range, its status and the number of rows inserted,
+        followed by anything else ingestRange returned.
+
+    """
+    PoolTasks.started((firstrow, lastrow))
+    try:
+        result = tuple(current.ingestRange(firstrow, lastrow))
+    except:
+        se = sys.exc_info()
+        print "Exception raised: ", se[1], " while ingesting rows %d to %d" % (firstrow, lastrow)
+        print "Traceback: "
+        traceback.print_tb(se[2])
+        print " "
+        result = (1, 0)
+    sys.stdout.flush()
+    return (firstrow, lastrow) + result
+
+
+class RowRanges(object):
+    """ Ingest one table of a file with several processes, each inserting and
+        committing a contiguous range of its rows over its own connection. The
+        object being ingested provides connectWorker(), called once in each
+        worker process, and ingestRange(firstrow, lastrow), returning the
+        status and number of rows inserted for the range, and possibly other
+        counts of the range (e.g. the rows of other tables filled in the same
+        pass), which are only relevant if it succeeded. The caller decides
+        what to do once all the ranges are done, committing its bookkeeping if
+        all of them succeeded and removing the rows of the file otherwise.
+
+    """
+
+    @staticmethod
+    def split(nrows, parts, minrows=1):
+        """ Split nrows rows into at most parts contiguous (firstrow, lastrow)
+            ranges (0 based, end exclusive) of at least minrows rows
+
+        """
+        parts = max(1, min(parts, nrows // max(minrows, 1)))
+        bounds = [nrows * i // parts for i in range(parts + 1)]
+        return [(bounds[i], bounds[i + 1]) for i in range(parts)]
+
+    @staticmethod
+    def canFork():
+        """ The workers of a pool (e.g. of the StageScheduler) are daemons, which
+            cannot start processes of their own
+
+        """
+        return not multiprocessing.current_process().daemon
+
+    @staticmethod
+    def run(obj, ranges, jobs):
+        """ Ingest the ranges of obj with jobs worker processes. Returns the
+            (firstrow, lastrow, status, nrows, ...) of each range, in order. A
+            range whose worker process died has failed, with 0 rows.
+
+        """
+        global current
+        current = obj
+        PoolTasks.open()
+        pool = multiprocessing.Pool(min(jobs, len(ranges)), openWorker)
+        tasks = PoolTasks(pool)
+        try:
+            for r in ranges:
+                tasks.submit(r, runRange, r)
+            results = {}
+            while len(tasks) > 0:
+                for r, result in tasks.wait():
+                    if result is None:
+                        print "Worker process ingesting rows %d to %d died" % r
+                        result = r + (1, 0)
+                    results[r] = result
+            return [results[r] for r in ranges]
+        finally:
+            tasks.shutdown()
+            PoolTasks.close()
+            current = None
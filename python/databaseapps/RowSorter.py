@@ -0,0 +1,161 @@
+import time
+import heapq
+import operator
+import itertools
+import tempfile
+import cPickle
+import marshal
+import numpy
+
+
+class RowSorter(object):
+    """ Sort the rows of an ingest on the values at some positions of each row
+        (e.g. COADD_OBJECT_ID) before they are inserted, so the entries of the
+        table's indexes are added in order rather than scattered over the
+        index blocks. Either each batch is sorted on its own, or the whole file
+        is: rows are collected into runs of at most memory bytes, each run is
+        sorted and spilled to a temporary file once full, and the runs are
+        then merged. A file which fits in one run is sorted in memory.
+
+    """
+    # approximate bytes taken by a value of a row held in memory as a python
+    # object, with its slot in the row
+    valueBytes = 64
+    # rows written to, and read back from, a run file at a time
+    blockRows = 10000
+    # tags of the blocks of a run file: rows of native values are written with
+    # marshal, several times faster than pickle, anything else is pickled
+    marshalTag = 'M'
+    pickleTag = 'P'
+    # print the decisions made
+    verbose = True
+
+    def __init__(self, positions, wholefile=False, memory=512 * 1024 * 1024, tmpdir=None, name=''):
+        """ positions are the positions in a row of the values to sort on, name
+            what is being sorted (for the messages)
+
+        """
+        self.positions = list(positions)
+        self.key = operator.itemgetter(*positions)
+        self.wholefile = wholefile
+        self.memory = memory
+        self.tmpdir = tmpdir
+        self.name = name
+        # number of rows sorted, and of runs spilled to disk
+        self.nrows = 0
+        self.nruns = 0
+        self.sorttime = 0.
+
+    def info(self, msg):
+        if self.verbose:
+            print time.strftime('%Y-%m-%d %H:%M:%S') + " - Sorting " + self.name + ": " + msg
+
+    def sort(self, batches):
+        """ Generator yielding the rows of batches in order, in batches of the
+            size of the first one when the whole file is sorted
+
+        """
+        if not self.wholefile:
+            for rows in batches:
+                t0 = time.time()
+                rows = self.sortRows(rows)
+                self.sorttime += time.time() - t0
+                self.nrows += len(rows)
+                yield rows
+            return
+        runs = []
+        pending = []
+        runrows = None
+        try:
+            for rows in batches:
+                if len(rows) == 0:
+                    continue
+                if runrows is None:
+                    runrows = max(self.memory // (self.valueBytes * len(rows[0])), 1)
+                    outrows = len(rows)
+                pending.extend(rows)
+                while len(pending) >= runrows:
+                    runs.append(self.writeRun(pending[:runrows]))
+                    del pending[:runrows]
+            if runrows is None:
+                return
+            if len(runs) == 0:
+                # the whole file fits in memory
+                t0 = time.time()
+                pending = self.sortRows(pending)
+                self.sorttime += time.time() - t0
+                self.nrows = len(pending)
+                self.info("Sorted %d rows in memory in %.2f seconds" % (self.nrows, self.sorttime))
+                for start in range(0, len(pending), outrows):
+                    yield pending[start:start + outrows]
+                return
+            if len(pending) > 0:
+                runs.append(self.writeRun(pending))
+                pending = []
+            self.info("Merging %d sorted runs of up to %d rows (%d rows sorted in %.2f seconds)" %
+                      (len(runs), runrows, self.nrows, self.sorttime))
+            merged = heapq.merge(*[self.readRun(run, i) for i, run in enumerate(runs)])
+            while True:
+                rows = [entry[-1] for entry in itertools.islice(merged, outrows)]
+                if len(rows) == 0:
+                    break
+                yield rows
+        finally:
+            for run in runs:
+                run.close()
+
+    def sortRows(self, rows):
+        """ Get the rows in order, stably. The keys are sorted as numpy arrays,
+            which is much faster than comparing them as python objects, unless
+            they hold values numpy cannot order (e.g. None).
+
+        """
+        keys = [numpy.array([row[pos] for row in rows]) for pos in self.positions]
+        if len([k for k in keys if k.dtype == object]) > 0:
+            return sorted(rows, key=self.key)
+        # lexsort sorts on the last key first
+        order = numpy.lexsort(keys[::-1])
+        return [rows[i] for i in order]
+
+    def writeRun(self, rows):
+        """ Sort a run of rows and write it to a temporary file, which is deleted
+            once closed
+
+        """
+        t0 = time.time()
+        rows = self.sortRows(rows)
+        run = tempfile.TemporaryFile(dir=self.tmpdir)
+        for start in range(0, len(rows), self.blockRows):
+            block = rows[start:start + self.blockRows]
+            try:
+                data = marshal.dumps(block)
+                run.write(self.marshalTag)
+            except ValueError:
+                data = cPickle.dumps(block, cPickle.HIGHEST_PROTOCOL)
+                run.write(self.pickleTag)
+            run.write(data)
+        run.flush()
+        self.sorttime += time.time() - t0
+        self.nrows += len(rows)
+        self.nruns += 1
+        return run
+
+    def readRun(self, run, index):
+        """ Generator reading back the rows of a run, as (key, run index, row
+            index, row) so that the merge never has to compare the rows
+            themselves and rows with the same key keep their order
+
+        """
+        run.seek(0)
+        count = 0
+        while True:
+            tag = run.read(1)
+            if tag == '':
+                return
+            if tag == self.marshalTag:
+                rows = marshal.load(run)
+            else:
+                rows = cPickle.load(run)
+            for row in rows:
+                yield (self.key(row), index, count, row)
+                count += 1
@@ -0,0 +1,303 @@
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from despydb import desdbi
+from PoolTasks import PoolTasks
+from Ingest import Ingest
+
+# scheduler whose tasks are run by the worker processes, set before they are
+# forked so that the workers get a copy of it (including the id map)
+current = None
+
+
+def openWorker(services, section):
+    """ Give a worker process its own database connection, the connection of
+        the parent cannot be shared between processes
+
+    """
+    current.dbh = desdbi.DesDbi(services, section, retry=True)
+
+
+def runTask(stageindex, fileindex):
+    """ Run a task of the current scheduler in a worker process
+
+    """
+    PoolTasks.started((stageindex, fileindex))
+    return current.runTask(stageindex, fileindex)
+
+
+class Stage(object):
+    """ One stage of an ingest: a list of files of the same filetype, ingested
+        with the same class once the stages it depends on are complete
+
+    """
+
+    def __init__(self, name, ingestclass, filetype, files, depends=None, label=None, local=False,
+                 required=False, function=None, **kwargs):
+        """ name identifies the stage in the dependencies of other stages, label
+            describes its files in the messages. A local stage is run in the
+            main process, before any worker is started, so anything it fills in
+            (e.g. the id map) is seen by the later stages. An exception raised
+            while ingesting a file of a required stage aborts the run. function,
+            if given, is called as function(stage, datafile, idDict, dbh) in
+            place of the default ingest of a file. Any other keyword arguments
+            are passed on to the ingest class.
+
+        """
+        self.name = name
+        self.ingestclass = ingestclass
+        self.filetype = filetype
+        self.files = [f for f in files if f is not None]
+        self.depends = list(depends or [])
+        self.label = label or name
+        self.local = local
+        self.required = required
+        self.function = function
+        self.kwargs = kwargs
+
+        # status of the run
+        self.sizes = [self.getSize(f) for f in self.files]
+        # indices of the files not yet handed out
+        self.waiting = range(len(self.files))
+        self.finished = 0
+        self.failures = 0
+        self.worktime = 0.
+        self.readytime = None
+        self.endtime = None
+
+    @staticmethod
+    def getSize(filename):
+        """ Size of a file, used to start the largest files first
+
+        """
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def isDone(self):
+        return self.readytime is not None and self.finished == len(self.files)
+
+    def ingestFile(self, datafile, idDict, dbh):
+        """ Ingest one file, returning the number of failures
+
+        """
+        if self.function is not None:
+            return self.function(self, datafile, idDict, dbh)
+        Ingest.printinfo("Working on %s %s" % (self.label, datafile))
+        obj = self.ingestclass(filetype=self.filetype, datafile=datafile, idDict=idDict, dbh=dbh,
+                               **self.kwargs)
+        isLoaded = obj.isLoaded()
+        if isLoaded:
+            return 0
+        stat = obj.executeIngest()
+        Ingest.printinfo("Ingest of %s %s%s\n" % (self.label, datafile, [" completed", " aborted"][stat]))
+        return obj.getstatus()
+
+
+class StageScheduler(object):
+    """ Run a graph of ingest stages. Every stage whose dependencies are complete
+        is ready, and the files of the ready stages are ingested by a pool of
+        worker processes, largest file first so that the long ingests do not
+        end up at the tail of the run. With a single job the files are
+        ingested in the main process, in the order the stages were added.
+
+    """
+
+    def __init__(self, idDict):
+        self.idDict = idDict
+        self.stages = []
+        self.names = {}
+        self.dbh = None
+        self.failures = 0
+        self.aborted = False
+        self.starttime = None
+        self.endtime = None
+
+    def addStage(self, stage):
+        """ Add a stage to the graph, its dependencies must already be in it
+
+        """
+        if stage.name in self.names:
+            raise Exception("Stage %s is already defined" % stage.name)
+        for dep in stage.depends:
+            if dep not in self.names:
+                raise Exception("Stage %s depends on unknown stage %s" % (stage.name, dep))
+            if stage.local and not self.stages[self.names[dep]].local:
+                raise Exception("Local stage %s cannot depend on stage %s, which runs in a worker" %
+                                (stage.name, dep))
+        self.names[stage.name] = len(self.stages)
+        self.stages.append(stage)
+        return stage
+
+    def release(self):
+        """ Mark the stages whose dependencies have all completed as ready
+
+        """
+        if self.aborted:
+            return
+        now = time.time()
+        changed = True
+        while changed:
+            changed = False
+            for stage in self.stages:
+                if stage.readytime is not None:
+                    continue
+                if all([self.stages[self.names[dep]].isDone() for dep in stage.depends]):
+                    stage.readytime = now
+                    if len(stage.files) == 0:
+                        print "Skipping %s ingestion, none specified on command line" % (stage.label)
+                        stage.endtime = now
+                        changed = True
+
+    def nextTask(self, local, bysize):
+        """ Get the next (stage index, file index) to run, or None if no file of
+            a ready stage is waiting. If bysize is set the largest waiting file
+            is chosen, else the first one in the order of the stages.
+
+        """
+        if self.aborted:
+            return None
+        best = None
+        for i, stage in enumerate(self.stages):
+            if stage.readytime is None or stage.local != local or len(stage.waiting) == 0:
+                continue
+            if not bysize:
+                return (i, stage.waiting.pop(0))
+            j = max(stage.waiting, key=lambda k: stage.sizes[k])
+            if best is None or stage.sizes[j] > self.stages[best[0]].sizes[best[1]]:
+                best = (i, j)
+        if best is not None:
+            self.stages[best[0]].waiting.remove(best[1])
+        return best
+
+    def runTask(self, stageindex, fileindex):
+        """ Ingest one file of a stage. Returns the task, the number of failures,
+            whether the run must be aborted and the start and end times.
+
+        """
+        stage = self.stages[stageindex]
+        start = time.time()
+        abort = False
+        try:
+            failures = stage.ingestFile(stage.files[fileindex], self.idDict, self.dbh)
+        except:
+            se = sys.exc_info()
+            e = se[1]
+            tb = se[2]
+            print "Exception raised: ", e
+            print "Traceback: "
+            traceback.print_tb(tb)
+            print " "
+            failures = 1
+            abort = stage.required
+        sys.stdout.flush()
+        return (stageindex, fileindex, failures, abort, start, time.time())
+
+    def finish(self, result):
+        """ Record the result of a task, and release the stages which were
+            waiting on its stage
+
+        """
+        stageindex, fileindex, failures, abort, start, end = result
+        stage = self.stages[stageindex]
+        stage.finished += 1
+        stage.failures += failures
+        stage.worktime += end - start
+        stage.endtime = max(end, stage.endtime or end)
+        self.failures += failures
+        if abort:
+            self.aborted = True
+        if stage.isDone():
+            self.release()
+
+    def run(self, dbh, jobs=1, services=None, section=None):
+        """ Run all the stages, using jobs worker processes (each connecting with
+            services and section) for the stages which are not local. Returns
+            the total number of failures.
+
+        """
+        global current
+        self.dbh = dbh
+        self.starttime = time.time()
+        self.release()
+
+        # stages whose results are needed by the workers run first, here
+        task = self.nextTask(True, False)
+        while task is not None:
+            self.finish(self.runTask(*task))
+            task = self.nextTask(True, False)
+
+        if jobs <= 1 or self.aborted:
+            task = self.nextTask(False, False)
+            while task is not None:
+                self.finish(self.runTask(*task))
+                task = self.nextTask(False, False)
+        else:
+            current = self
+            PoolTasks.open()
+            pool = multiprocessing.Pool(jobs, openWorker, (services, section))
+            tasks = PoolTasks(pool)
+            try:
+                submitted = {}
+                # only keep as many tasks in flight as there are workers, so the
+                # largest waiting file is picked each time one finishes
+                while True:
+                    while len(tasks) < jobs:
+                        task = self.nextTask(False, True)
+                        if task is None:
+                            break
+                        tasks.submit(task, runTask, task)
+                        submitted[task] = time.time()
+                    if len(tasks) == 0:
+                        break
+                    for task, result in tasks.wait():
+                        if result is None:
+                            stage = self.stages[task[0]]
+                            print "Worker process ingesting %s %s died" % (stage.label, stage.files[task[1]])
+                            result = task + (1, stage.required, submitted[task], time.time())
+                        self.finish(result)
+            finally:
+                tasks.shutdown()
+                PoolTasks.close()
+                current = None
+        self.endtime = time.time()
+        return self.failures
+
+    def criticalPath(self):
+        """ Get the chain of stages which determined the end of the run, by
+            following back from the stage which finished last the dependency
+            which finished last
+
+        """
+        done = [s for s in self.stages if s.endtime is not None]
+        if len(done) == 0:
+            return []
+        stage = max(done, key=lambda s: s.endtime)
+        path = [stage]
+        while len(stage.depends) > 0:
+            stage = max([self.stages[self.names[dep]] for dep in stage.depends],
+                        key=lambda s: s.endtime)
+            path.insert(0, stage)
+        return path
+
+    def report(self):
+        """ Print the timing of each stage and of the critical path
+
+        """
+        Ingest.printinfo("Stage timing:")
+        for stage in self.stages:
+            if stage.readytime is None or stage.endtime is None:
+                print "    %-25s not run" % (stage.name)
+                continue
+            print "    %-25s %4i files %4i failures %9.2f seconds after start %9.2f seconds ingesting" % (
+                stage.name, len(stage.files), stage.failures, stage.endtime - self.starttime, stage.worktime)
+        path = self.criticalPath()
+        if len(path) > 0:
+            print "    Critical path: " + " -> ".join(["%s (%.2f s)" % (s.name, s.endtime - s.readytime)
+                                                        for s in path])
+        worktime = sum([s.worktime for s in self.stages])
+        print "    Total: %.2f seconds elapsed, %.2f seconds ingesting" % (
+            self.endtime - self.starttime, worktime)
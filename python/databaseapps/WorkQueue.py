@@ -0,0 +1,227 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+import multiprocessing
+
+
+class WorkQueue(object):
+    """ Table of jobs kept in a SQLite file on storage shared by all the hosts,
+        from which any number of worker processes claim jobs one at a time
+
+        A claimed job is leased to its worker for lease seconds, and the worker
+        extends the lease with heartbeats while it runs the job. A job whose
+        lease expires (its worker died or hung) is put back in the queue, up to
+        maxattempts times. Every operation is a short transaction on a fresh
+        connection, so no lock is held between them.
+
+    """
+    createStatement = '''
+        create table if not exists %s (
+            ID integer primary key autoincrement,
+            ARGS text not null unique,
+            STATUS text not null default 'queued',
+            WORKER text,
+            ATTEMPTS integer not null default 0,
+            LEASE_EXPIRES real,
+            HEARTBEAT real,
+            STARTED real,
+            FINISHED real,
+            RETVAL integer
+        ) '''
+
+    def __init__(self, filename, table='TILE_QUEUE', lease=600, maxattempts=3):
+        """ filename is the SQLite file (created if needed), lease the number of
+            seconds a job is held without a heartbeat, and maxattempts how many
+            times a job is tried before it is marked as failed
+
+        """
+        self.filename = filename
+        self.table = table
+        self.lease = lease
+        self.maxattempts = maxattempts
+        self.worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.execute(self.createStatement % self.table)
+
+    def connect(self):
+        """ Open a connection to the queue file, waiting for the locks of other
+            workers rather than failing
+
+        """
+        dbh = sqlite3.connect(self.filename, timeout=300)
+        dbh.isolation_level = None
+        return dbh
+
+    def execute(self, sqlstr, params=None):
+        """ Run a single statement in its own transaction, returning the records
+            it selected and the number of rows it changed
+
+        """
+        dbh = self.connect()
+        try:
+            cursor = dbh.cursor()
+            cursor.execute("begin immediate")
+            cursor.execute(sqlstr, params or {})
+            records = cursor.fetchall()
+            count = cursor.rowcount
+            cursor.execute("commit")
+            return records, count
+        finally:
+            dbh.close()
+
+    def add(self, jobs):
+        """ Add the given jobs (strings of arguments) to the queue. Jobs which
+            are already in it, whatever their status, are not added again.
+            Returns the number of jobs added.
+
+        """
+        added = 0
+        dbh = self.connect()
+        try:
+            cursor = dbh.cursor()
+            cursor.execute("begin immediate")
+            for job in jobs:
+                cursor.execute("insert or ignore into %s (ARGS) values (:args)" % self.table,
+                               {'args': job})
+                added += cursor.rowcount
+            cursor.execute("commit")
+        finally:
+            dbh.close()
+        return added
+
+    def claim(self):
+        """ Claim the next queued job, after putting back in the queue the jobs
+            whose lease has expired. Returns the id and arguments of the job, or
+            None if no job is waiting.
+
+        """
+        now = time.time()
+        dbh = self.connect()
+        try:
+            cursor = dbh.cursor()
+            cursor.execute("begin immediate")
+            cursor.execute("""update %s set STATUS = case when ATTEMPTS >= :maxattempts
+                                  then 'failed' else 'queued' end, WORKER = null
+                              where STATUS = 'running' and LEASE_EXPIRES < :now""" % self.table,
+                           {'maxattempts': self.maxattempts, 'now': now})
+            cursor.execute("select ID, ARGS from %s where STATUS = 'queued' order by ID limit 1" %
+                           self.table)
+            job = cursor.fetchone()
+            if job is not None:
+                cursor.execute("""update %s set STATUS = 'running', WORKER = :worker,
+                                      ATTEMPTS = ATTEMPTS + 1, LEASE_EXPIRES = :expires,
+                                      HEARTBEAT = :now, STARTED = :now
+                                  where ID = :id""" % self.table,
+                               {'worker': self.worker, 'expires': now + self.lease, 'now': now,
+                                'id': job[0]})
+            cursor.execute("commit")
+        finally:
+            dbh.close()
+        return job
+
+    def heartbeat(self, jobid):
+        """ Extend the lease of a job. Returns False if the job is no longer
+            leased to this worker (e.g. the lease expired and it was requeued).
+
+        """
+        now = time.time()
+        records, count = self.execute(
+            """update %s set LEASE_EXPIRES = :expires, HEARTBEAT = :now
+               where ID = :id and WORKER = :worker and STATUS = 'running'""" % self.table,
+            {'expires': now + self.lease, 'now': now, 'id': jobid, 'worker': self.worker})
+        return count == 1
+
+    def complete(self, jobid, retval):
+        """ Record the end of a job, it is done if retval is 0 and failed
+            otherwise
+
+        """
+        if retval == 0:
+            status = 'done'
+        else:
+            status = 'failed'
+        self.execute("""update %s set STATUS = :status, RETVAL = :retval, FINISHED = :now,
+                            LEASE_EXPIRES = null
+                        where ID = :id and WORKER = :worker""" % self.table,
+                     {'status': status, 'retval': retval, 'now': time.time(), 'id': jobid,
+                      'worker': self.worker})
+
+    def counts(self):
+        """ Get the number of jobs in each status
+
+        """
+        records, count = self.execute("select STATUS, count(*) from %s group by STATUS" % self.table)
+        return dict(records)
+
+    def jobs(self, poll=None):
+        """ Yield (id, arguments) of the jobs claimed one after the other, until
+            the queue is empty. With poll set, wait poll seconds and look again
+            as long as jobs are still running elsewhere, since their leases may
+            expire and put them back in the queue.
+
+        """
+        while True:
+            job = self.claim()
+            if job is not None:
+                yield job
+                continue
+            if poll is None or self.counts().get('running', 0) == 0:
+                return
+            time.sleep(poll)
+
+
+class Heartbeat(object):
+    """ Background thread extending the lease of a job while it runs. Once the
+        lease is lost the job may already be claimed and run by another
+        worker, so the work of the job must not be committed (see check()).
+
+    """
+
+    def __init__(self, queue, jobid, interval=None):
+        self.queue = queue
+        self.jobid = jobid
+        if interval is None:
+            interval = queue.lease / 4.
+        self.interval = interval
+        # set when the lease is lost, shared with the processes forked while
+        # the job runs (e.g. the workers of a pool)
+        self.lost = multiprocessing.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.jobid):
+                    print "Lost the lease of job %d" % (self.jobid)
+                    self.lost.set()
+                    return
+            except sqlite3.Error, e:
+                # a busy or briefly unavailable file, try again at the next beat
+                print "Heartbeat of job %d failed: %s" % (self.jobid, e)
+
+    def check(self):
+        """ Raise an exception if the lease was lost, called before committing
+            the work of the job
+
+        """
+        if self.lost.is_set():
+            raise Exception("Lost the lease of job %d, another worker may be running it" %
+                            (self.jobid))
+
+    def start(self):
+        self.thread.start()
+
+    def end(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end()
+        return False
@@ -10,6 +10,9 @@ from collections import OrderedDict
 from despydb import desdbi
 from despyserviceaccess import serviceaccess
 from databaseapps.ingestutils import IngestUtils as ingestutils
+from databaseapps.FitsChunkReader import FitsChunkReader
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.CursorCache import CursorCache
 import argparse
 
 
@@ -24,6 +27,7 @@ class CoaddCatalog:
     schema = None
     fits = None
     fits_chunk = 10000
+    fits_readahead = 0
     objhdu = 'OBJECTS'
     filetype = 'coadd_cat'
 
@@ -46,6 +50,9 @@ class CoaddCatalog:
     # dictionary of coadd object ids. master dict passed to __init__
     idDict = {}
 
+    # IngestLedger recording each load, used by isLoaded() if set
+    ledger = None
+
     debug = True
     debugDateFormat = '%Y-%m-%d %H:%M:%S'
 
@@ -105,15 +112,15 @@ class CoaddCatalog:
                 and atc.owner = :ownname
                 and dm.filetype (+)= :ftype
             order by 1,2,3 '''
-        cursor = self.dbh.cursor()
         params = {
             'ftype': self.filetype,
             'tabname': self.targettable,
             'ownname': self.schema
         }
 
-        cursor.execute(sqlstr, params)
-        records = cursor.fetchall()
+        records = MetadataCache.fetch(
+            self.dbh, ('CoaddCatalog.getObjectColumns', self.filetype, self.schema, self.targettable),
+            sqlstr, params)
         for rec in records:
             hdr = None
 
@@ -162,7 +169,6 @@ class CoaddCatalog:
             else:
                 results[hdr][rec[1]][self.COLUMN_NAME].append(rec[3])
                 results[hdr][rec[1]][self.POSITION].append(str(rec[2]))
-        cursor.close()
         return results
 
     ###########################################################################
@@ -213,8 +219,6 @@ class CoaddCatalog:
 
         attrsToCollect = self.dbDict[self.objhdu]
 
-        cursor = self.dbh.cursor()
-
         # array of arrays used to fill bind variables for executemany()
         sqldata = []
 
@@ -239,21 +243,13 @@ class CoaddCatalog:
 
             datatypes = self.fits[self.objhdu].get_rec_dtype()[0]
 
-            startrow = firstrow-1
-            endrow = firstrow-1
+            reader = FitsChunkReader(self.fits, self.objhdu, orderedFitsColumns, self.fits_chunk,
+                                     firstrow=firstrow-1, lastrow=lastrow,
+                                     readahead=self.fits_readahead)
 
             # grab FITS data in chunks of rows, and build array of arrays
             # of the rows to pass to executemany()
-            while endrow < lastrow:
-                startrow = endrow
-                endrow = min(startrow+self.fits_chunk, lastrow)
-
-                data = fitsio.read(
-                    self.fullfilename,
-                    rows=range(startrow, endrow),
-                    columns=orderedFitsColumns, ext=self.objhdu
-                )
-
+            for data in reader:
                 for row in data:
                     # IMPORTANT! Must convert numpy array to python list, or
                     # suffer big performance hit. This is due to numpy bug
@@ -293,7 +289,8 @@ class CoaddCatalog:
 
                     #self.info("outrow: " + ",".join(map(str, outrow)))
                 # end for row in data
-            # end while endrow < lastrow
+            # end for data in reader
+            self.info(reader.report())
         finally:
             self.info("constructing SQL string")
 
@@ -514,13 +511,13 @@ class CoaddCatalog:
                 ) values (
                 ''' % self.targettable
 
-            # add constants (band, tile, filename, and pfw_attempt_id) to sql
-            sqlstr = sqlstr + "'" + self.band + "', '" + self.tilename + "', '" + \
-                self.shortfilename + "', " + str(self.pfw_attempt_id) + ", "
-
-            # add bind variable placeholders to sql string
-            for i in range(1, len(sqldata[0])+1):
-                if i == len(sqldata[0]):
+            # add bind variable placeholders to sql string, the constants (band,
+            # tile, filename, and pfw_attempt_id) are bound ahead of the data so
+            # the statement is the same for every file
+            constvals = [self.band, self.tilename, self.shortfilename, self.pfw_attempt_id]
+            nbinds = len(constvals) + len(sqldata[0])
+            for i in range(1, nbinds+1):
+                if i == nbinds:
                     sqlstr += ":%d)" % i
                 else:
                     sqlstr += ":%d," % i
@@ -529,10 +526,15 @@ class CoaddCatalog:
 
             self.info("inserting rows")
 
-            # execute cursor for each row of FITS values contained in sqldata
-            cursor.prepare(sqlstr)
-            cursor.executemany(None, sqldata)
-            cursor.close()
+            # execute cursor for each row of FITS values contained in sqldata,
+            # reusing the cursor already prepared for an earlier file
+            columns = [c.strip() for c in sqlstr.split('(')[1].split(')')[0].split(',')]
+            cursor = CursorCache.get(self.dbh, self.targettable, columns, sqlstr)
+            cursor.executemany(None, [constvals + row for row in sqldata])
+            if self.ledger is not None:
+                self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                                   len(sqldata), pfw_attempt_id=self.pfw_attempt_id,
+                                   fullfilename=self.fullfilename)
             self.dbh.commit()
             self.info("row inserts complete")
 
@@ -557,6 +559,11 @@ class CoaddCatalog:
         return records
 
     def numAlreadyIngested(self):
+        if self.ledger is not None:
+            entry = self.ledger.lookup(self.dbh, self.shortfilename, self.targettable)
+            if entry is None:
+                return 0
+            return entry["NROWS"]
         sqlstr = '''
             select count(*)
             from %s
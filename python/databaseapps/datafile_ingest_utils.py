@@ -8,6 +8,7 @@ from astropy.io import fits
 
 import despymisc.miscutils as miscutils
 from despymisc.xmlslurp import Xmlslurper
+from databaseapps.ingestutils import IngestUtils
 
 DI_COLUMNS = 'columns'
 DI_DATATYPE = 'datatype'
@@ -150,6 +151,15 @@ def is_ingested(filename, tablename, dbh):
 # end is_ingested
 
 
+######################################################################
+def get_ingested_counts(filenames, tablename, dbh):
+    """ Get the number of rows already ingested for each of a list of files,
+        with one grouped query per chunk of filenames """
+
+    return IngestUtils.numIngested(dbh, tablename, filenames)
+# end get_ingested_counts
+
+
 ######################################################################
 def get_fits_data(fullname, whichhdu):
     """ Get data from fits file header"""
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
+import sys
+import time
 import math
 import calendar
+import threading
+import Queue
+from MetadataCache import MetadataCache
 
 
 class IngestUtils:
@@ -75,11 +80,83 @@ class IngestUtils:
                 UNION
                 select table_owner, synonym_name, 3 from all_synonyms where owner='PUBLIC' and synonym_name=:obj
                 order by 3 '''
-            cursor = dbh.cursor()
-            res = cursor.execute(sqlstmt, {'obj': objectname})
+            res = MetadataCache.fetch(dbh, ('resolveDbObject', objectname), sqlstmt, {'obj': objectname})
             for rec in res:
                 schema = rec[0]
                 obname = rec[1]
                 break
-            cursor.close()
         return (schema, obname)
+
+    @staticmethod
+    def numIngested(dbh, tablename, filenames, chunksize=1000):
+        ''' return a dictionary of the number of rows in tablename for each of
+            the given (short) filenames, using one grouped query per chunksize
+            filenames rather than one count per file
+        '''
+        counts = dict((fname, 0) for fname in filenames)
+        filenames = list(counts.keys())
+        for start in range(0, len(filenames), chunksize):
+            binds = {}
+            for i, fname in enumerate(filenames[start:start + chunksize]):
+                binds['f%d' % i] = fname
+            sqlstr = "select filename, count(*) from %s where filename in (%s) group by filename" % (
+                tablename, ', '.join([':' + b for b in binds.keys()]))
+            num = 0
+            while num < 5:
+                num += 1
+                try:
+                    cursor = dbh.cursor()
+                    cursor.execute(sqlstr, binds)
+                    for fname, count in cursor.fetchall():
+                        counts[fname] = count
+                    cursor.close()
+                    break
+                except:
+                    if num == 5:
+                        raise
+                    time.sleep(10)  # sleep 10 seconds and retry
+        return counts
+
+    @staticmethod
+    def prefetch(iterable, depth):
+        ''' iterate over iterable in a background thread, keeping up to depth
+            items queued ahead of the consumer. Exceptions raised while producing
+            are re-raised in the consumer, and the producer is stopped if the
+            consumer goes away
+        '''
+        queue = Queue.Queue(maxsize=depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.5)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in iterable:
+                    if not put((item, None)):
+                        return
+                put((done, None))
+            except:
+                put((None, sys.exc_info()))
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item, error = queue.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if item is done:
+                    break
+                yield item
+        finally:
+            stop.set()
+        thread.join()
@@ -3,6 +3,7 @@
 import os
 import sys
 import fitsio
+import numpy
 import subprocess
 import time
 import re
@@ -11,6 +12,13 @@ from collections import OrderedDict
 from despydb import desdbi
 from despyserviceaccess import serviceaccess
 from databaseapps.ingestutils import IngestUtils as ingestutils
+from databaseapps.FitsChunkReader import FitsChunkReader
+from databaseapps.MetadataCache import MetadataCache
+from databaseapps.IngestLedger import IngestLedger
+from databaseapps.AdaptiveBatcher import AdaptiveBatcher
+from databaseapps.RowRanges import RowRanges
+from databaseapps.CursorCache import CursorCache
+from databaseapps.DerivedColumns import DerivedColumns
 import argparse
 import random
 
@@ -50,20 +58,45 @@ class ObjectCatalog:
     targetschema = None
     dump = False
     objhdu = 'LDAC_OBJECTS'
+    # number of rows to read from the fits table at a time, and the number
+    # of chunks to read ahead in a background thread
+    fits_chunk = 50000
+    fits_readahead = 0
+    # in dump mode, the number of data files (and control files) the rows are
+    # split into, the field delimiter, and whether sqlldr is run on them
+    dump_parts = 1
+    dump_delimiter = '|'
+    run_sqlldr = False
+    # number of processes splitting the rows of the object hdu between them,
+    # each inserting a contiguous range of at least range_min_rows rows over
+    # its own connection
+    range_jobs = 1
+    range_min_rows = 100000
+    # Heartbeat of the work queue job the catalog is ingested for, if set
+    # nothing is committed once its lease is lost
+    lease = None
+    # datatypes of the columns of each (schema, temp table)
+    columnTypes = {}
 
     constDict = None
     constlist = []
-    funcDict = None
     dbDict = None
     fits = None
     dodebug = True
     debugDateFormat = '%Y-%m-%d %H:%M:%S'
 
     def __init__(self, request, filetype, datafile, temptable, targettable,
-                 fitsheader, dumponly, services, section):
+                 fitsheader, dumponly, services, section, ledger=None, dbh=None):
 
         self.debug("start CatalogIngest.init()")
-        self.dbh = desdbi.DesDbi(services, section)
+        # a connection given by the caller is shared with other catalogs, and
+        # is left open
+        self.owndbh = dbh is None
+        if dbh is None:
+            dbh = desdbi.DesDbi(services, section)
+        self.dbh = dbh
+        self.services = services
+        self.section = section
 
         self.debug("opening fits file")
         self.fits = fitsio.FITS(datafile)
@@ -71,6 +104,10 @@ class ObjectCatalog:
 
         self.request = request
         self.filetype = filetype
+        # table recording the loaded files, used for the isLoaded() check
+        self.ledger = None
+        if ledger:
+            self.ledger = IngestLedger(ledger)
         self.fullfilename = datafile
         self.shortfilename = ingestutils.getShortFilename(datafile)
 
@@ -81,6 +118,8 @@ class ObjectCatalog:
                 self.objhdu = fitsheader
         if dumponly:
             self.dump = True
+            # directory the data and control files are written to
+            self.dumpdir = dumponly
         else:
             self.dump = False
         self.consts = []
@@ -96,21 +135,21 @@ class ObjectCatalog:
         self.debug("target schema,table = %s, %s; temp= %s, %s" %
                    (self.targetschema, self.targettable, self.tempschema, self.temptable))
 
-        if self.dump:
-            self.constDict = {}
-        else:
-            self.constDict = {
-                "FILENAME": [self.shortfilename + str(random.randint(1, 10000)), True],
-                "REQNUM": [request, False]
-            }
-            self.constlist.append("FILENAME")
-            self.constlist.append("REQNUM")
+        self.constDict = {
+            "FILENAME": [self.shortfilename + str(random.randint(1, 10000)), True],
+            "REQNUM": [request, False]
+        }
+        # per instance, the class attribute would collect the constants of
+        # every catalog ingested by the process
+        self.constlist = ["FILENAME", "REQNUM"]
+        # (column name, function, input columns) of the derived row columns
+        self.derived = []
         self.debug("start getObjectColumns()")
         self.dbDict = self.getObjectColumns()
         self.debug("CatalogIngest.init() done")
 
     def __del__(self):
-        if self.dbh:
+        if self.dbh and self.owndbh:
             self.dbh.close()
         if self.fits:
             self.fits.close()
@@ -135,12 +174,11 @@ class ObjectCatalog:
             from ops_datafile_metadata 
             where filetype = :ftype
             order by 1,2,3 '''
-        cursor = self.dbh.cursor()
         params = {
             'ftype': self.filetype,
         }
-        cursor.execute(sqlstr, params)
-        records = cursor.fetchall()
+        records = MetadataCache.fetch(self.dbh, ('ObjectCatalog.getObjectColumns', self.filetype),
+                                      sqlstr, params)
         #print records
         if len(records) == 0:
             exit("No columns listed for filetype %s in ops_datafile_metadata, exiting" % (self.filetype))
@@ -163,7 +201,6 @@ class ObjectCatalog:
             else:
                 results[hdr][rec[1]][self.COLUMN_NAME].append(rec[3])
                 results[hdr][rec[1]][self.POSITION].append(str(rec[2]))
-        cursor.close()
         self.checkForArrays(results)
 
         return results
@@ -176,7 +213,8 @@ class ObjectCatalog:
                 attrname = None
                 pos = 0
                 m = pat.match(k)
-                if m:
+                # a derived column (e.g. HPIX_4096) is not an array element
+                if m and v[self.DERIVED] != 'c':
                     attrname = m.group(1)
                     pos = m.group(2)
                     if attrname not in results:
@@ -196,7 +234,7 @@ class ObjectCatalog:
         for attribute, dblist in self.dbDict[hduName].iteritems():
             for col in dblist[self.COLUMN_NAME]:
                 if dblist[self.DERIVED] == 'c':
-                    value = self.funcDict[col](hdr[attribute])
+                    value = DerivedColumns.fromHeader(col, hdr[attribute])
                 elif dblist[self.DERIVED] == 'h':
                     value = str(hdr[attribute]).strip()
                 if dblist[self.DATATYPE] == 'char':
@@ -219,6 +257,30 @@ class ObjectCatalog:
             #else:
             #    controlfile.write(colname + " CONSTANT " + str(val[self.VALUE]) + ",\n")
 
+    def writeControlfileHeader(self, controlfile, datafile):
+        controlfile.write("LOAD DATA\n")
+        controlfile.write("INFILE '%s'\n" % datafile)
+        controlfile.write("APPEND\n")
+        controlfile.write("INTO TABLE %s.%s\n" % (self.tempschema, self.temptable))
+        controlfile.write("FIELDS TERMINATED BY '%s'\n" % self.dump_delimiter)
+        controlfile.write("TRAILING NULLCOLS\n")
+        controlfile.write("(\n")
+
+    def writeControlfile(self, controlfile, datafile, datacolumns):
+        """ Write the control file loading datafile, with the constants as
+            CONSTANT fields followed by the data columns and their sqlldr types
+
+        """
+        self.writeControlfileHeader(controlfile, datafile)
+        fields = []
+        for colname in self.constlist:
+            val = str(self.constDict[colname][self.VALUE]).replace("'", "''")
+            fields.append("%s CONSTANT '%s'" % (colname, val))
+        for colname, sqlldrtype in datacolumns:
+            fields.append("%s %s" % (colname, sqlldrtype))
+        controlfile.write(",\n".join(fields) + "\n")
+        self.writeControlfileFooter(controlfile)
+
     def writeControlfileFooter(self, controlfile):
         controlfile.write(")\n")
 
@@ -257,63 +319,429 @@ class ObjectCatalog:
         orderedFitsColumns = []
         allcols = self.fits[self.objhdu].get_colnames()
         for col in allcols:
-            if col.upper() in attrs:
+            if col.upper() in attrs and attrsToCollect[col.upper()][self.DERIVED] != 'c':
                 orderedFitsColumns.append(col)
+        self.derived = self.getDerivedColumns(allcols)
+        # the columns the derived ones are computed from are read as well
+        readColumns = list(orderedFitsColumns)
+        for colname, func, inputs in self.derived:
+            readColumns += [col for col in inputs if col not in readColumns]
         datatypes = self.fits[self.objhdu].get_rec_dtype()[0]
-        startrow = 0
-        endrow = 0
-        outdata = []
-        while endrow < lastrow:
-            datarow = {}
-            startrow = endrow
-            endrow = min(startrow+50000, lastrow)
-            print startrow, endrow, lastrow
-            data = fitsio.read(
-                self.fullfilename,
-                rows=range(startrow, endrow),
-                columns=orderedFitsColumns, ext=self.objhdu
-            )
-            hdu = 'LDAC_OBJECTS'
-            for i, row in enumerate(data):
-                #print i
-                outrow = {}
-                for item, value in self.constDict.iteritems():
-                    outrow[item] = value[0]
-                #outrow = copy.deepcopy(self.constDict)
-                for idx in range(0, len(orderedFitsColumns)):
-                    # if this column is an array of values
-                    name = orderedFitsColumns[idx].upper()
-                    if datatypes[orderedFitsColumns[idx].upper()].subdtype:
-                        #arrvals = []
-                        for pos in attrsToCollect[orderedFitsColumns[idx]][self.POSITION]:
-                            #name = orderedFitsColumns[idx].upper()
-                            #for hdu in self.dbDict.keys():
-                            #    if name in self.dbDict[hdu].keys():
-                            #        print hdu
-                            outrow[self.dbDict[hdu][name][0][int(pos)]] = str(row[idx][int(pos)])
-                            #break
-                            #raise Exception('Error locating column')
-                            #print self.dbDict['LDAC_OBJECTS'].keys()
-                            #print self.dbDict[orderedFitsColumns[idx].upper()][0]
-                            #outrow[orderedFitsColumns[idx].upper() + "_" + str(int(pos) + 1)] = str(row[idx][int(pos)])
-                    # else it is a scalar
-                    else:
-                        #for hdu in self.dbDict.keys():
-                        #    if name in self.dbDict[hdu].keys():
-                        #print hdu
-                        outrow[self.dbDict[hdu][name][0][0]] = str(row[idx])
-                        #break
-
-                        #outrow[orderedFitsColumns[idx].upper()] = str(row[idx])
-                # else if we are writing to a file
-                outdata.append(outrow)
-            # end for row in data
-        # end while endrow < lastrow
-        if len(outdata) > 0:
-            self.insert_many(self.tempschema + '.' + self.temptable, columns, outdata)
+        # kept for the worker processes of a range ingest
+        self.insertColumns = (orderedFitsColumns, readColumns, datatypes)
+        if not self.dump and self.range_jobs > 1 and lastrow >= 2 * self.range_min_rows:
+            if RowRanges.canFork():
+                self.executeRanges(RowRanges.split(lastrow, self.range_jobs, self.range_min_rows))
+                return
+        reader = FitsChunkReader(self.fits, self.objhdu, readColumns, self.fits_chunk,
+                                 readahead=self.fits_readahead)
+        if self.dump:
+            nrows, controlfiles = self.dumpData(reader, orderedFitsColumns, datatypes)
+            self.info(reader.report())
+            if self.run_sqlldr:
+                self.runSqlldr(controlfiles)
+                if self.ledger is not None:
+                    self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                                       nrows, reqnum=self.request, fullfilename=self.fullfilename)
+                    self.commit()
+            return
+        nrows = self.insertRows(reader, orderedFitsColumns, datatypes)
+        self.info(reader.report())
+        if nrows > 0:
+            if self.ledger is not None:
+                # recorded in the same transaction as the data
+                self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                                   nrows, reqnum=self.request, fullfilename=self.fullfilename)
+            self.commit()
             #self.execute('COMMIT WRITE BATCH NOWAIT')
             #self.dbh.commit()
 
+    def getColumnTypes(self):
+        """ Get the datatype of each column of the temp table, looked up once
+            per process as every catalog of a request loads the same table
+
+        """
+        key = (self.tempschema.upper(), self.temptable.upper())
+        if key not in self.columnTypes:
+            sqlstr = """select column_name, data_type from all_tab_columns
+                        where owner=:schema and table_name=:tab"""
+            cursor = self.dbh.cursor()
+            try:
+                cursor.execute(sqlstr, {'schema': key[0], 'tab': key[1]})
+                self.columnTypes[key] = dict([(rec[0].upper(), rec[1]) for rec in cursor.fetchall()])
+            finally:
+                cursor.close()
+        return self.columnTypes[key]
+
+    def getDerivedColumns(self, allcols):
+        """ Get the columns of the object hdu computed from other columns by
+            their DerivedColumns function, as (column name, function, fits
+            columns it is computed from)
+
+        """
+        fitsnames = dict([(col.upper(), col) for col in allcols])
+        derived = []
+        for attribute, dblist in self.dbDict[self.objhdu].iteritems():
+            if dblist[self.DERIVED] != 'c':
+                continue
+            for colname in dblist[self.COLUMN_NAME]:
+                func, inputs = DerivedColumns.get(colname)
+                if inputs is None:
+                    raise Exception("Derived column %s of the %s hdu is computed from a header keyword" %
+                                    (colname, self.objhdu))
+                missing = [col for col in inputs if col not in fitsnames]
+                if len(missing) > 0:
+                    raise Exception("Derived column %s needs the missing columns %s in %s" %
+                                    (colname, ','.join(missing), self.shortfilename))
+                derived.append((colname, func, [fitsnames[col] for col in inputs]))
+        return derived
+
+    def getBindLayout(self, orderedFitsColumns, datatypes):
+        """ Get the destination columns of the data, in bind order, and for each
+            fits column the element positions (None for a scalar) and whether
+            the values of each of its destination columns go through their
+            shortest decimal form
+
+            Up to now every value was bound as str(value), which for a float32
+            is its shortest decimal form. Bound natively, a float32 becomes the
+            exact double of the float32, which lands the same in a BINARY_FLOAT
+            column but not in a NUMBER or BINARY_DOUBLE one, so those still get
+            the double of the decimal form (see decimalValues).
+
+            The destination columns of an array are listed in the order of the
+            metadata query, which is not that of the elements (FLUX_APER_10
+            comes before FLUX_APER_2), and each goes with the position listed
+            at the same index.
+
+        """
+        attrsToCollect = self.dbDict[self.objhdu]
+        coltypes = self.getColumnTypes()
+        datacolumns = []
+        layout = []
+        for col in orderedFitsColumns:
+            name = col.upper()
+            colnames = attrsToCollect[name][self.COLUMN_NAME]
+            dtype = datatypes[name]
+            positions = None
+            if dtype.subdtype:
+                positions = [int(pos) for pos in attrsToCollect[name][self.POSITION]]
+                basetype = dtype.subdtype[0]
+            else:
+                basetype = dtype
+            float32 = basetype.kind == 'f' and basetype.itemsize == 4
+            decimals = [float32 and coltypes.get(c.upper()) != 'BINARY_FLOAT' for c in colnames]
+            datacolumns += colnames
+            layout.append((col, positions, decimals))
+        datacolumns += [colname for colname, func, inputs in self.derived]
+        return datacolumns, layout
+
+    def columnize(self, data, layout):
+        """ Convert a chunk of fits data into a list of 1-d arrays, one per bind
+            position, the derived columns coming last
+
+        """
+        bindcols = []
+        for col, positions, decimals in layout:
+            values = data[col]
+            if positions is None:
+                columns = [values]
+            else:
+                values = values.reshape(len(values), -1)
+                columns = [values[:, pos] for pos in positions]
+            for values, decimal in zip(columns, decimals):
+                if decimal:
+                    values = self.decimalValues(values)
+                bindcols.append(values)
+        for colname, func, inputs in self.derived:
+            bindcols.append(func(*[data[col] for col in inputs]))
+        return bindcols
+
+    @staticmethod
+    def decimalValues(values):
+        """ Get the doubles of the shortest decimal forms of an array of float32,
+            the same as values.astype(str).astype(numpy.float64) without
+            formatting every value
+
+            A value is scaled by a power of 10 to 9 significant digits and
+            rounded to an integer, and one digit less is tried as long as the
+            result still rounds back to the value. This gives the decimal
+            str() would as long as the power of 10 is exact and the scaled
+            value is not close to a tie, and the value is not a power of 2
+            (where the float32 below is closer than the one above). The
+            other values, and those out of range, are converted through str().
+
+        """
+        values = numpy.asarray(values, dtype=numpy.float32)
+        exact = values.astype(numpy.float64)
+        result = exact.copy()
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            magnitude = numpy.abs(exact)
+            exponent = numpy.floor(numpy.log10(magnitude))
+            fast = (exponent >= -14) & (exponent <= 8) & (numpy.frexp(magnitude)[0] != 0.5)
+            slow = [numpy.flatnonzero(~fast & numpy.isfinite(exact) & (exact != 0))]
+        todo = numpy.flatnonzero(fast)
+        x = exact[todo]
+        target = values[todo]
+        power = 8 - exponent[todo]
+        for digits in range(9, 0, -1):
+            if len(todo) == 0:
+                break
+            # a large value scaled to few digits is divided by the power of 10
+            down = power < 0
+            scale = 10.0 ** numpy.abs(power)
+            scaled = numpy.where(down, x / scale, x * scale)
+            nearest = numpy.rint(scaled)
+            tie = numpy.abs(numpy.abs(scaled - nearest) - 0.5) < 1e-6
+            decimal = numpy.where(down, nearest * scale, nearest / scale)
+            same = decimal.astype(numpy.float32) == target
+            if digits == 9:
+                slow.append(todo[~same | tie])
+            else:
+                slow.append(todo[same & tie])
+            same &= ~tie
+            result[todo[same]] = decimal[same]
+            todo, x, target, power = todo[same], x[same], target[same], power[same] - 1
+        slow = numpy.concatenate(slow)
+        if len(slow) > 0:
+            result[slow] = values[slow].astype(str).astype(numpy.float64)
+        return result
+
+    def insertRows(self, reader, orderedFitsColumns, datatypes):
+        """ Insert the rows read by reader into the temp table, returning the
+            number of rows inserted. The data are bound by position with their
+            native types, followed by the constants.
+
+        """
+        datacolumns, layout = self.getBindLayout(orderedFitsColumns, datatypes)
+        columns = datacolumns + self.constlist
+        consts = tuple([self.constDict[c][self.VALUE] for c in self.constlist])
+        table = self.tempschema + '.' + self.temptable
+        cursor = CursorCache.get(self.dbh, table, columns, self.insertStatement(table, columns))
+        batcher = None
+        for data in reader:
+            bindcols = [col.tolist() for col in self.columnize(data, layout)]
+            if batcher is None:
+                bindtypes = []
+                for col in bindcols:
+                    if len(col) > 0 and isinstance(col[0], (int, long)):
+                        bindtypes.append('INT')
+                    elif len(col) > 0 and isinstance(col[0], float):
+                        bindtypes.append('DOUBLE')
+                    else:
+                        bindtypes.append(None)
+                batcher = AdaptiveBatcher(AdaptiveBatcher.estimateRowBytes(bindtypes, consts), table)
+            # the constants are shared by every row of the batch, executemany
+            # still needs a value for each bind of each row
+            batcher.add([row + consts for row in zip(*bindcols)])
+            while batcher.ready():
+                self.insertBatch(cursor, batcher.next(), batcher)
+        if batcher is None:
+            return 0
+        self.insertBatch(cursor, batcher.flush(), batcher)
+        return batcher.total
+
+    @staticmethod
+    def insertStatement(table, columns):
+        return "INSERT INTO %s (%s) VALUES (%s)" % (
+            table, ','.join(columns), ','.join([':%d' % (i + 1) for i in range(len(columns))]))
+
+    def connectWorker(self):
+        """ Open the connection and the file of a worker process ingesting a
+            range of rows
+
+        """
+        # hold on to the connection of the parent, releasing it here would log
+        # it off for the parent as well
+        self.parentdbh = self.dbh
+        self.dbh = desdbi.DesDbi(self.services, self.section)
+        self.fits = fitsio.FITS(self.fullfilename)
+
+    def ingestRange(self, firstrow, lastrow):
+        """ Insert and commit the rows [firstrow, lastrow) of the object hdu, in
+            a worker process. Returns the status and the number of rows inserted.
+
+        """
+        orderedFitsColumns, readColumns, datatypes = self.insertColumns
+        reader = FitsChunkReader(self.fits, self.objhdu, readColumns, self.fits_chunk,
+                                 firstrow=firstrow, lastrow=lastrow, readahead=self.fits_readahead)
+        nrows = self.insertRows(reader, orderedFitsColumns, datatypes)
+        self.info(reader.report())
+        self.commit()
+        return 0, nrows
+
+    def executeRanges(self, ranges):
+        """ Insert the rows with range_jobs processes, each committing one range
+            of rows. The file is recorded in the ledger once every range is
+            committed, and if any range fails the rows of the file are removed
+            from the temp table.
+
+        """
+        self.info("Ingesting %s in %d ranges of rows with %d processes" %
+                  (self.shortfilename, len(ranges), min(self.range_jobs, len(ranges))))
+        results = RowRanges.run(self, ranges, self.range_jobs)
+        failed = ["%d-%d" % (r[0], r[1]) for r in results if r[2] != 0]
+        if len(failed) > 0:
+            self.removeRows()
+            raise Exception("Rows %s of %s failed" % (', '.join(failed), self.shortfilename))
+        nrows = sum([r[3] for r in results])
+        if self.ledger is not None:
+            self.ledger.record(self.dbh, self.shortfilename, self.filetype, self.targettable,
+                               nrows, reqnum=self.request, fullfilename=self.fullfilename)
+            self.commit()
+        self.info("Inserted %d rows into %s.%s" % (nrows, self.tempschema, self.temptable))
+
+    def removeRows(self):
+        """ Remove the rows of this file committed by the ranges which succeeded
+
+        """
+        cursor = self.dbh.cursor()
+        try:
+            cursor.execute("delete from %s.%s where FILENAME=:fname" % (self.tempschema, self.temptable),
+                           {"fname": self.constDict["FILENAME"][self.VALUE]})
+            self.info("Removed %d rows of %s from %s.%s" % (cursor.rowcount, self.shortfilename,
+                                                           self.tempschema, self.temptable))
+        finally:
+            cursor.close()
+        # the rows of the file may be those of another worker once the lease
+        # of the job is lost
+        self.commit()
+
+    def dumpData(self, reader, orderedFitsColumns, datatypes):
+        """ Write the rows of the object hdu to dump_parts delimited data files of
+            contiguous rows, with a control file for each. Returns the number of
+            rows and the list of control files.
+
+        """
+        attrsToCollect = self.dbDict[self.objhdu]
+        # data columns in file order: (fits column, position in an array
+        # column or None, destination column, sqlldr type, printf format)
+        fields = []
+        for col in orderedFitsColumns:
+            entry = attrsToCollect[col.upper()]
+            dtype = datatypes[col.upper()]
+            if dtype.subdtype:
+                basetype = dtype.subdtype[0]
+                # the column and the position of each element are listed in
+                # the same order, which is not that of the positions
+                columns = zip(entry[self.COLUMN_NAME], [int(pos) for pos in entry[self.POSITION]])
+            else:
+                basetype = dtype
+                columns = [(entry[self.COLUMN_NAME][0], None)]
+            if basetype.kind in 'iub':
+                fmt = '%d'
+            elif basetype.kind == 'f' and basetype.itemsize <= 4:
+                fmt = '%.9g'
+            elif basetype.kind == 'f':
+                fmt = '%.17g'
+            else:
+                fmt = '%s'
+            for colname, pos in columns:
+                fields.append((col, pos, colname, entry[self.DATATYPE], fmt))
+        # derived columns are written after the data, as they are bound
+        for attribute, entry in attrsToCollect.iteritems():
+            if entry[self.DERIVED] == 'c':
+                for colname in entry[self.COLUMN_NAME]:
+                    fields.append((colname, None, colname, entry[self.DATATYPE], '%s'))
+        rowformat = self.dump_delimiter.join([f[4] for f in fields]) + "\n"
+
+        if not os.path.isdir(self.dumpdir):
+            os.makedirs(self.dumpdir)
+        base = os.path.join(self.dumpdir, self.shortfilename.split('.fits')[0])
+        nrows = reader.lastrow - reader.firstrow
+        parts = max(1, min(self.dump_parts, nrows))
+        # first row of each part, and of the row after the last part
+        bounds = [nrows * i // parts for i in range(parts + 1)]
+        datafiles = ["%s_%02d.dat" % (base, i + 1) for i in range(parts)]
+        controlfiles = ["%s_%02d.ctl" % (base, i + 1) for i in range(parts)]
+
+        part = 0
+        out = open(datafiles[part], 'w')
+        rowcount = 0
+        try:
+            for data in reader:
+                cols = []
+                derivedvalues = dict([(colname, func(*[data[col] for col in inputs]))
+                                      for colname, func, inputs in self.derived])
+                for col, pos, colname, sqlldrtype, fmt in fields:
+                    if col in derivedvalues:
+                        cols.append(derivedvalues[col].tolist())
+                        continue
+                    values = data[col]
+                    if pos is not None:
+                        values = values.reshape(len(data), -1)[:, pos]
+                    if fmt == '%s':
+                        values = numpy.char.strip(values)
+                    cols.append(values.tolist())
+                rows = zip(*cols)
+                start = 0
+                while start < len(rows):
+                    while rowcount + start >= bounds[part + 1]:
+                        out.close()
+                        part += 1
+                        out = open(datafiles[part], 'w')
+                    end = min(len(rows), bounds[part + 1] - rowcount)
+                    out.write(''.join([rowformat % row for row in rows[start:end]]))
+                    start = end
+                rowcount += len(rows)
+        finally:
+            out.close()
+
+        datacolumns = [(field[2], field[3]) for field in fields]
+        for datafile, controlfile in zip(datafiles, controlfiles):
+            f = open(controlfile, 'w')
+            try:
+                self.writeControlfile(f, datafile, datacolumns)
+            finally:
+                f.close()
+        self.info("Wrote %d rows to %d data files %s_*.dat" % (rowcount, parts, base))
+        return rowcount, controlfiles
+
+    def runSqlldr(self, controlfiles):
+        """ Load the data files with sqlldr in direct path mode, running one
+            parallel load per control file at the same time
+
+        """
+        dbinfo = serviceaccess.parse(self.services, self.section, 'DB')
+        userid = "%s/%s@//%s:%s/%s" % (dbinfo['user'], dbinfo['passwd'], dbinfo['server'],
+                                        dbinfo['port'], dbinfo.get('service', dbinfo.get('name')))
+        procs = []
+        parfiles = []
+        try:
+            for controlfile in controlfiles:
+                base = os.path.splitext(controlfile)[0]
+                # the password is passed in a parameter file readable only by
+                # the user, rather than on the command line
+                parfile = base + '.par'
+                fd = os.open(parfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                os.write(fd, "userid=%s\n" % userid)
+                os.close(fd)
+                parfiles.append(parfile)
+                cmd = ['sqlldr', 'parfile=' + parfile, 'control=' + controlfile, 'log=' + base + '.log',
+                       'bad=' + base + '.bad', 'direct=true', 'parallel=true', 'errors=0', 'silent=header,feedback']
+                self.info("Running " + ' '.join(cmd))
+                procs.append((controlfile, subprocess.Popen(cmd)))
+            failed = []
+            for controlfile, proc in procs:
+                if proc.wait() != 0:
+                    failed.append("%s (exit code %d)" % (controlfile, proc.returncode))
+        finally:
+            for parfile in parfiles:
+                os.remove(parfile)
+        if len(failed) > 0:
+            raise Exception("sqlldr failed for " + ', '.join(failed))
+        self.info("sqlldr loaded %d files" % len(controlfiles))
+
+    def insertBatch(self, cursor, rows, batcher):
+        """ Insert a batch of rows with the prepared cursor, reporting the time
+            it took to the batcher
+
+        """
+        if len(rows) == 0:
+            return
+        t0 = time.time()
+        cursor.executemany(None, rows)
+        batcher.record(len(rows), time.time() - t0)
+
     def insert_many(self, table, columns, rows):
         if len(rows) == 0:
             return
@@ -331,6 +759,15 @@ class ObjectCatalog:
         curs = self.dbh.cursor()
         try:
             curs.executemany(stmt, rows)
+        finally:
+            curs.close()
+
+    def commit(self):
+        if self.lease is not None and self.lease.lost.is_set():
+            self.dbh.rollback()
+            self.lease.check()
+        curs = self.dbh.cursor()
+        try:
             curs.execute('COMMIT WRITE BATCH NOWAIT')
         finally:
             curs.close()
@@ -379,13 +816,19 @@ class ObjectCatalog:
         self.debug("starting isLoaded()")
         loaded = False
         exitcode = 0
-        # short circuit the checking of loaded objects until a better query can be devised.
-        return (loaded, exitcode)
+        # counting the objects of the file in the target table is too slow, so
+        # the check is only done against the ingest ledger
+        if self.ledger is None:
+            return (loaded, exitcode)
         if self.dump:
             self.debug("dump=True so skipping isLoaded() check")
         else:
-            self.debug("starting numAlreadyIngested()")
-            (numDbObjects, dbReqnum) = self.numAlreadyIngested()
+            self.debug("starting ledger lookup")
+            entry = self.ledger.lookup(self.dbh, self.shortfilename, self.targettable)
+            if entry is None:
+                (numDbObjects, dbReqnum) = (0, 0)
+            else:
+                (numDbObjects, dbReqnum) = (entry["NROWS"], entry["REQNUM"])
             self.debug("starting getNumObjects()")
             numCatObjects = self.getNumObjects()
             if numDbObjects > 0:
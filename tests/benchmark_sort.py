@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+""" Benchmark of the presort of the rows (--sort_key of mepoch_ingest.py).
+    A coadd_object_molygon file with the objects in random order is loaded
+    into a SQLite stand-in for the database, whose table has a unique index on
+    (COADD_OBJECT_ID, MOLYGON_NUMBER) and a page cache small enough that the
+    index does not fit in it, unsorted and with each way of sorting.
+
+    Usage: benchmark_sort.py [number of rows] [work directory]
+
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import tempfile
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from databaseapps.IdMap import IdMap
+from databaseapps.Mangle import Mangle
+from databaseapps.Ingest import Ingest
+from databaseapps.AdaptiveBatcher import AdaptiveBatcher
+
+FILETYPE = 'mangle_csv_cobjmoly'
+TABLE = 'COBJMOLY'
+# ops_datafile_metadata of the filetype
+METADATA = [('CSV', 'COADD_OBJECT_ID', 0, 'COADD_OBJECT_ID', 'int'),
+            ('CSV', 'MOLYGON_NUMBER', 1, 'MOLYGON_NUMBER', 'int'),
+            ('CSV', 'TILENAME', 2, 'TILENAME', 'char')]
+PRIMARY_KEY = ['COADD_OBJECT_ID', 'MOLYGON_NUMBER']
+# pages of the SQLite cache, negative for KB
+CACHE_SIZE = -4096
+
+# label, sort_key, sort_file and sort_memory (MB) of each run
+RUNS = [
+    ('unsorted', None, False, 512),
+    ('per batch', 'COADD_OBJECT_ID', False, 512),
+    ('whole file, in memory', 'COADD_OBJECT_ID', True, 4096),
+    ('whole file, 64 MB runs', 'CLUSTER', True, 64),
+]
+
+
+class SqliteCursor(object):
+    """ Cursor answering the metadata queries of the ingest, and running the
+        others on the SQLite database
+
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statement = None
+        self.records = []
+        self.rowcount = 0
+
+    def execute(self, sqlstr, params=None):
+        if 'sys_context' in sqlstr:
+            self.records = [('BENCHMARK@SQLITE',)]
+        elif 'ops_datafile_table' in sqlstr:
+            self.records = [(TABLE,)]
+        elif 'ops_datafile_metadata' in sqlstr:
+            self.records = list(METADATA)
+        elif 'all_constraints' in sqlstr:
+            self.records = [(col,) for col in PRIMARY_KEY]
+        elif 'user_tables' in sqlstr:
+            self.records = [('BENCHMARK', params['obj'], 0)]
+        else:
+            cursor = self.conn.lite.execute(sqlstr, params or {})
+            self.records = cursor.fetchall()
+            self.rowcount = cursor.rowcount
+
+    def prepare(self, sqlstr):
+        # SQLite has no numbered binds
+        self.statement = re.sub(r':\d+', '?', sqlstr)
+
+    def setinputsizes(self, *args, **kwargs):
+        pass
+
+    def executemany(self, sqlstr, rows, **kwargs):
+        if sqlstr is not None:
+            self.prepare(sqlstr)
+        self.conn.lite.executemany(self.statement, rows)
+
+    def fetchall(self):
+        return self.records
+
+    def fetchone(self):
+        return self.records[0]
+
+    def close(self):
+        pass
+
+
+class SqliteConnection(object):
+    """ Stand-in for a desdbi connection
+
+    """
+
+    def __init__(self, filename):
+        self.lite = sqlite3.connect(filename)
+        self.lite.execute('pragma cache_size=%d' % (CACHE_SIZE))
+        self.lite.execute('pragma journal_mode=off')
+        self.lite.execute('pragma synchronous=off')
+
+    def cursor(self):
+        return SqliteCursor(self)
+
+    def commit(self):
+        self.lite.commit()
+
+    def rollback(self):
+        self.lite.rollback()
+
+    def close(self):
+        self.lite.close()
+
+
+def makeFile(filename, nrows):
+    """ Write a file of nrows objects in random order, each with a molygon
+
+    """
+    rng = numpy.random.RandomState(7)
+    numbers = rng.permutation(nrows) + 1
+    molygons = rng.randint(1, 1000000, nrows)
+    f = open(filename, 'w')
+    try:
+        for start in range(0, nrows, 100000):
+            f.write(''.join(['%d,%d,DES0001-0001\n' % (n, m) for n, m in
+                             zip(numbers[start:start + 100000], molygons[start:start + 100000])]))
+    finally:
+        f.close()
+
+
+def run(workdir, datafile, idDict, sort_key, sort_file, sort_memory):
+    """ Load the file into a new database, returning the status and seconds
+
+    """
+    dbfile = os.path.join(workdir, 'benchmark.sqlite')
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+    dbh = SqliteConnection(dbfile)
+    dbh.lite.execute("create table %s (COADD_OBJECT_ID, MOLYGON_NUMBER, TILENAME, FILENAME)" % (TABLE))
+    dbh.lite.execute("create unique index %s_PK on %s (%s)" % (TABLE, TABLE, ', '.join(PRIMARY_KEY)))
+    dbh.commit()
+    Ingest.sort_key = sort_key
+    Ingest.sort_file = sort_file
+    Ingest.sort_memory = sort_memory * 1024 * 1024
+    Ingest.sort_dir = workdir
+    mangle = Mangle(datafile, FILETYPE, idDict, dbh)
+    start = time.time()
+    stat = mangle.executeIngest()
+    seconds = time.time() - start
+    dbh.close()
+    os.remove(dbfile)
+    return stat, seconds
+
+
+if __name__ == '__main__':
+    nrows = 3000000
+    if len(sys.argv) > 1:
+        nrows = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        workdir = sys.argv[2]
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp()
+    AdaptiveBatcher.verbose = False
+
+    datafile = os.path.join(workdir, 'cobjmoly_%d.csv' % (nrows))
+    if not os.path.exists(datafile):
+        makeFile(datafile, nrows)
+    idDict = IdMap()
+    numbers = numpy.arange(1, nrows + 1)
+    idDict.add(numbers, numbers + 1000000000)
+
+    results = []
+    for label, sort_key, sort_file, sort_memory in RUNS:
+        stat, seconds = run(workdir, datafile, idDict, sort_key, sort_file, sort_memory)
+        results.append((label, stat, seconds))
+    print("%d rows:" % (nrows))
+    for label, stat, seconds in results:
+        print("    %-25s %s %8.1f seconds %8.0f rows/s" % (label, ["completed", "failed  "][stat != 0],
+                                                          seconds, nrows / seconds))
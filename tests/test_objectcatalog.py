@@ -0,0 +1,186 @@
+""" Check how ObjectCatalog maps the fits columns, and the elements of array
+    columns, to the columns of the temp table when it inserts the rows and when
+    it dumps them for sqlldr, and the decimal form of the float32 values
+
+"""
+
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+import numpy
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+
+def stubModule(name, **attrs):
+    """ Install an empty module in place of a dependency which is not
+        installed, the conversions do not use it
+
+    """
+    try:
+        __import__(name)
+        return
+    except ImportError:
+        pass
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(sys.modules[parent], child, module)
+
+stubModule('fitsio')
+stubModule('despydb')
+stubModule('despydb.desdbi')
+stubModule('despyserviceaccess')
+stubModule('despyserviceaccess.serviceaccess')
+stubModule('despymisc')
+stubModule('despymisc.miscutils', fwdebug_print=lambda msg: None)
+
+from databaseapps.objectcatalog import ObjectCatalog
+
+
+class Catalog(ObjectCatalog):
+    """ An ObjectCatalog without a file or a database
+
+    """
+
+    def __init__(self):
+        pass
+
+
+class ChunkReader(list):
+    """ Chunks of a fits table, as read by a FitsChunkReader
+
+    """
+
+    def __init__(self, chunks):
+        list.__init__(self, chunks)
+        self.firstrow = 0
+        self.lastrow = sum([len(chunk) for chunk in chunks])
+
+
+class TestObjectCatalog(unittest.TestCase):
+
+    nrows = 20
+    naper = 12
+
+    def setUp(self):
+        self.datatypes = numpy.dtype([('NUMBER', '>i4'), ('FLUX_APER', '>f4', (self.naper,)),
+                                      ('MAG_AUTO', '>f4'), ('ALPHAWIN_J2000', '>f8')])
+        rng = numpy.random.RandomState(7)
+        self.data = numpy.zeros(self.nrows, dtype=self.datatypes)
+        self.data['NUMBER'] = numpy.arange(1, self.nrows + 1)
+        # the element i of a row is 100 * row + i, to tell the elements apart
+        self.data['FLUX_APER'] = (numpy.arange(self.nrows)[:, None] * 100 +
+                                  numpy.arange(self.naper)[None, :] + rng.rand(self.nrows, self.naper) / 10)
+        self.data['MAG_AUTO'] = rng.rand(self.nrows) * 30
+        self.data['ALPHAWIN_J2000'] = rng.rand(self.nrows) * 360
+        self.columns = list(self.datatypes.names)
+        self.dumpdir = tempfile.mkdtemp()
+        self.coltypes = ObjectCatalog.columnTypes.copy()
+
+    def tearDown(self):
+        shutil.rmtree(self.dumpdir)
+        ObjectCatalog.columnTypes = self.coltypes
+
+    def getCatalog(self, coltypes):
+        """ An ObjectCatalog with the metadata of the columns in the order the
+            metadata query returns them (by column name, so FLUX_APER_10
+            comes before FLUX_APER_2)
+
+        """
+        catalog = Catalog()
+        names = (['NUMBER'] + ['FLUX_APER_%d' % (i + 1) for i in range(self.naper)] +
+                 ['MAG_AUTO', 'ALPHAWIN_J2000'])
+        records = OrderedDict()
+        for name in sorted(names):
+            column = name
+            if name == 'NUMBER':
+                column = 'COADD_OBJECT_ID'
+            records[name] = [[column], None, 'FLOAT EXTERNAL', ['0']]
+        catalog.dbDict = {catalog.objhdu: records}
+        catalog.checkForArrays(catalog.dbDict)
+        catalog.derived = []
+        catalog.constlist = []
+        catalog.constDict = {}
+        catalog.tempschema = 'SCHEMA'
+        catalog.temptable = 'TEMP'
+        catalog.shortfilename = 'cat.fits'
+        catalog.dumpdir = self.dumpdir
+        ObjectCatalog.columnTypes[('SCHEMA', 'TEMP')] = coltypes
+        return catalog
+
+    def element(self, colname):
+        """ The element of FLUX_APER which goes in the FLUX_APER_<n> column
+
+        """
+        return int(colname.split('_')[-1]) - 1
+
+    def testInsertColumns(self):
+        catalog = self.getCatalog({})
+        datacolumns, layout = catalog.getBindLayout(self.columns, self.datatypes)
+        bindcols = catalog.columnize(self.data, layout)
+        self.assertEqual(len(datacolumns), len(bindcols))
+        self.assertEqual(sorted(datacolumns[1:1 + self.naper]),
+                         sorted(['FLUX_APER_%d' % (i + 1) for i in range(self.naper)]))
+        for colname, values in zip(datacolumns, bindcols):
+            if colname.startswith('FLUX_APER'):
+                self.assertEqual(numpy.floor(values).tolist(),
+                                 (numpy.arange(self.nrows) * 100 + self.element(colname)).tolist())
+
+    def testDumpColumns(self):
+        catalog = self.getCatalog({})
+        chunks = [self.data[:7], self.data[7:]]
+        nrows, controlfiles = catalog.dumpData(ChunkReader(chunks), self.columns, self.datatypes)
+        self.assertEqual(nrows, self.nrows)
+        f = open(controlfiles[0], 'r')
+        fields = f.read().split('(\n')[1].split('\n)')[0].split(',\n')
+        f.close()
+        colnames = [field.split()[0] for field in fields]
+        f = open(os.path.join(self.dumpdir, 'cat_01.dat'), 'r')
+        rows = [line.rstrip('\n').split(catalog.dump_delimiter) for line in f]
+        f.close()
+        self.assertEqual(len(rows), self.nrows)
+        for i, colname in enumerate(colnames):
+            if colname.startswith('FLUX_APER'):
+                self.assertEqual([int(float(row[i])) for row in rows],
+                                 (numpy.arange(self.nrows) * 100 + self.element(colname)).tolist())
+
+    def testDecimalColumns(self):
+        # only the float32 values going into a column other than BINARY_FLOAT
+        # are converted
+        coltypes = dict([('FLUX_APER_%d' % (i + 1), 'BINARY_FLOAT') for i in range(self.naper)])
+        coltypes['FLUX_APER_11'] = 'NUMBER'
+        coltypes['MAG_AUTO'] = 'BINARY_FLOAT'
+        catalog = self.getCatalog(coltypes)
+        datacolumns, layout = catalog.getBindLayout(self.columns, self.datatypes)
+        bindcols = catalog.columnize(self.data, layout)
+        for colname, values in zip(datacolumns, bindcols):
+            if colname == 'FLUX_APER_11':
+                self.assertEqual(values.dtype, numpy.float64)
+                self.assertEqual(values.tolist(), self.data['FLUX_APER'][:, 10].astype(str).astype(float).tolist())
+            elif colname.startswith('FLUX_APER') or colname == 'MAG_AUTO':
+                self.assertEqual(values.dtype.kind, 'f')
+                self.assertEqual(values.dtype.itemsize, 4)
+
+    def testDecimalValues(self):
+        rng = numpy.random.RandomState(5)
+        bits = rng.randint(0, 2 ** 31 - 1, 200000).astype(numpy.uint32).view(numpy.float32)
+        powers = 2.0 ** numpy.arange(-149, 128)
+        for values in [rng.rand(200000) * 30, rng.rand(200000) * 1e10, bits, powers,
+                       numpy.nextafter(powers.astype(numpy.float32), numpy.float32(0)),
+                       10.0 ** numpy.arange(-45, 39),
+                       [0., -0., numpy.nan, numpy.inf, -numpy.inf, 99., -99., 0.1, 1e-40]]:
+            values = numpy.asarray(values).astype('>f4')
+            expected = values.astype(str).astype(numpy.float64)
+            result = ObjectCatalog.decimalValues(values)
+            self.assertEqual(repr(result.tolist()), repr(expected.tolist()))
+
+
+if __name__ == '__main__':
+    unittest.main()
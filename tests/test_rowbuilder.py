@@ -0,0 +1,163 @@
+""" Check that the whole-column conversion of a chunk of a fits table
+    (FitsIngest.convertChunk with a RowBuilder) gives the same rows as the
+    conversion one row and cell at a time (FitsIngest.convertChunkByRow)
+
+"""
+
+import os
+import sys
+import types
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python', 'databaseapps'))
+
+
+def stubModule(name, **attrs):
+    """ Install an empty module in place of a dependency which is not
+        installed, the conversions do not use it
+
+    """
+    try:
+        __import__(name)
+        return
+    except ImportError:
+        pass
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(sys.modules[parent], child, module)
+
+stubModule('fitsio')
+stubModule('despydb')
+stubModule('despydb.desdbi')
+stubModule('despymisc')
+stubModule('despymisc.miscutils', fwdebug_print=lambda msg: None)
+
+from FitsIngest import FitsIngest
+from RowBuilder import RowBuilder
+from IdMap import IdMap
+
+
+class TestRowBuilder(unittest.TestCase):
+
+    nrows = 50
+
+    def setUp(self):
+        self.datatypes = numpy.dtype([('NUMBER', '>i4'), ('FLAGS', '>i2'), ('FLUX_APER', '>f4', (3,)),
+                                      ('TILENAME', 'S12'), ('MAG_AUTO', '>f4'), ('MAG_APER', '>f4', (12,)),
+                                      ('ALPHAWIN_J2000', '>f8')])
+        rng = numpy.random.RandomState(3)
+        self.data = numpy.zeros(self.nrows, dtype=self.datatypes)
+        self.data['NUMBER'] = rng.permutation(self.nrows) + 1
+        self.data['FLAGS'] = rng.randint(0, 4, self.nrows)
+        self.data['FLUX_APER'] = rng.rand(self.nrows, 3)
+        self.data['MAG_APER'] = rng.rand(self.nrows, 12) * 30
+        tilenames = numpy.array(['DES0001-0001', ' DES0002-02 ', 'DES3', '', '   '])
+        self.data['TILENAME'] = tilenames[numpy.arange(self.nrows) % len(tilenames)]
+        self.data['MAG_AUTO'] = rng.rand(self.nrows) * 30
+        self.data['MAG_AUTO'][0] = 99.
+        # the values loaded as NULL: NaN and empty strings
+        self.data['MAG_AUTO'][1::7] = numpy.nan
+        self.data['MAG_APER'][2::5, 4] = numpy.nan
+        self.data['ALPHAWIN_J2000'] = rng.rand(self.nrows) * 360
+        self.columns = list(self.datatypes.names)
+
+    def getIngest(self, generateID, idDict):
+        """ A FitsIngest with only what the conversion needs, no file or
+            database
+
+        """
+        ingest = FitsIngest.__new__(FitsIngest)
+        ingest.fitsColumns = list(self.columns)
+        ingest.generateID = generateID
+        ingest.idDict = idDict
+        ingest.coadd_ids = range(1000, 1000 + self.nrows)
+        ingest.shortfilename = 'cat.fits'
+        return ingest
+
+    def convert(self, generateID, idDict):
+        """ Convert the data both ways, each with its own copy of the id map
+
+        """
+        ingest = self.getIngest(generateID, idDict())
+        columnar = ingest.convertChunk(RowBuilder(self.columns, self.datatypes), self.data, 0)
+        ingest = self.getIngest(generateID, idDict())
+        byrow = ingest.convertChunkByRow(self.datatypes, self.data, 0)
+        return columnar, byrow
+
+    def assertSameRows(self, columnar, byrow):
+        """ Compare the rows by their repr, which tells apart the numpy and
+            python types of the values and compares NaN equal to itself
+
+        """
+        self.assertEqual(len(columnar), len(byrow))
+        for crow, brow in zip(columnar, byrow):
+            self.assertEqual(repr(crow), repr(brow))
+
+    def knownIds(self):
+        idDict = IdMap()
+        numbers = numpy.arange(1, self.nrows + 1)
+        idDict.add(numbers, numbers * 10 + 7)
+        return idDict
+
+    def testLookupIds(self):
+        columnar, byrow = self.convert(False, self.knownIds)
+        self.assertEqual(len(columnar), self.nrows)
+        self.assertSameRows(columnar, byrow)
+        # NUMBER is replaced by the COADD_OBJECT_ID, the array columns are
+        # flattened and the strings are stripped
+        self.assertEqual(columnar[0][0], self.data['NUMBER'][0] * 10 + 7)
+        self.assertEqual(len(columnar[0]), len(self.columns) - 2 + 3 + 12)
+        self.assertEqual(columnar[1][5], 'DES0002-02')
+
+    def testGenerateIds(self):
+        columnar, byrow = self.convert(True, IdMap)
+        self.assertSameRows(columnar, byrow)
+        # COADD_OBJECT_ID goes first and NUMBER is kept
+        self.assertEqual(columnar[0][:2], [1000 + self.nrows - 1, self.data['NUMBER'][0]])
+
+    def testArrayColumns(self):
+        columnar, byrow = self.convert(False, self.knownIds)
+        self.assertSameRows(columnar, byrow)
+        # the elements of an array follow each other in order, past the tenth
+        first = 1 + 1 + 3 + 1 + 1
+        for i in range(self.nrows):
+            self.assertEqual(columnar[i][2:5], self.data['FLUX_APER'][i].tolist())
+            self.assertEqual(repr(columnar[i][first:first + 12]), repr(self.data['MAG_APER'][i].tolist()))
+
+    def testNullValues(self):
+        columnar, byrow = self.convert(False, self.knownIds)
+        self.assertSameRows(columnar, byrow)
+        self.assertTrue(numpy.isnan(columnar[1][6]))
+        self.assertTrue(numpy.isnan(columnar[2][7 + 4]))
+        # blank strings are stripped to the empty string
+        self.assertEqual(columnar[3][5], '')
+        self.assertEqual(columnar[4][5], '')
+
+    def testNativeTypes(self):
+        columnar, byrow = self.convert(False, self.knownIds)
+        self.assertEqual([[type(v) for v in row] for row in columnar],
+                         [[type(v) for v in row] for row in byrow])
+
+    def testMissingId(self):
+        def partialIds():
+            idDict = IdMap()
+            idDict.add(numpy.arange(2, self.nrows + 1), numpy.arange(2, self.nrows + 1))
+            return idDict
+        columnar, byrow = self.convert(False, partialIds)
+        self.assertIsNone(columnar)
+        self.assertIsNone(byrow)
+
+    def testTooFewIds(self):
+        ingest = self.getIngest(True, IdMap())
+        del ingest.coadd_ids[:2]
+        self.assertRaisesRegexp(Exception, 'cat.fits', ingest.convertChunk,
+                                RowBuilder(self.columns, self.datatypes), self.data, 0)
+        self.assertEqual(len(ingest.coadd_ids), self.nrows - 2)
+
+
+if __name__ == '__main__':
+    unittest.main()